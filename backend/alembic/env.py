@@ -8,6 +8,7 @@ from alembic import context
 from app.core.config import settings
 from app.models.user import User  # импортируем модели
 from app.models.chat import ChatSession, ChatMessage
+from app.models.job import GenerationJob
 from sqlmodel import SQLModel
 
 # this is the Alembic Config object, which provides
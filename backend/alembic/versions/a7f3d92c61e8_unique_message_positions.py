@@ -0,0 +1,38 @@
+"""Unique message positions
+
+Номер сообщения в сессии становится уникальным. Повторы, записанные
+одновременными добавлениями, перенумеровываются с сохранением порядка.
+
+Revision ID: a7f3d92c61e8
+Revises: d142aafade3c
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7f3d92c61e8'
+down_revision = 'd142aafade3c'
+branch_labels = None
+depends_on = None
+
+RENUMBER_MESSAGE_POSITIONS = (
+    "UPDATE chatmessage SET position = ("
+    "SELECT ordered.rn FROM ("
+    "SELECT id, ROW_NUMBER() OVER (PARTITION BY session_id ORDER BY position, timestamp, id) - 1 AS rn FROM chatmessage"
+    ") AS ordered WHERE ordered.id = chatmessage.id)"
+)
+
+
+def upgrade():
+    op.drop_index('ix_chatmessage_session_id_position', table_name='chatmessage')
+    op.execute(RENUMBER_MESSAGE_POSITIONS)
+    op.create_index('ix_chatmessage_session_id_position', 'chatmessage', ['session_id', 'position'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_chatmessage_session_id_position', table_name='chatmessage')
+    op.create_index('ix_chatmessage_session_id_position', 'chatmessage', ['session_id', 'position'])
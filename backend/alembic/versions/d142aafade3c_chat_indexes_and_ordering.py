@@ -0,0 +1,46 @@
+"""Chat indexes and message ordering
+
+Номер сообщения в сессии и версия сессии, номера для уже сохраненных
+сообщений по времени, составные индексы для загрузки истории: сообщения
+сессии по номеру и сессии пользователя от последних измененных.
+
+Revision ID: d142aafade3c
+Revises: 5b0e7c1f9a42
+Create Date: 2026-10-17 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = 'd142aafade3c'
+down_revision = '5b0e7c1f9a42'
+branch_labels = None
+depends_on = None
+
+BACKFILL_MESSAGE_POSITIONS = (
+    "UPDATE chatmessage SET position = ("
+    "SELECT ordered.rn FROM ("
+    "SELECT id, ROW_NUMBER() OVER (PARTITION BY session_id ORDER BY timestamp, id) - 1 AS rn FROM chatmessage"
+    ") AS ordered WHERE ordered.id = chatmessage.id)"
+)
+
+
+def upgrade():
+    op.add_column('chatsession', sa.Column('version', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('chatmessage', sa.Column('position', sa.Integer(), nullable=False, server_default='0'))
+    op.execute(BACKFILL_MESSAGE_POSITIONS)
+    op.create_index('ix_chatmessage_session_id_position', 'chatmessage', ['session_id', 'position'])
+    op.create_index('ix_chatsession_user_id_updated_at', 'chatsession', ['user_id', sa.text('updated_at DESC')])
+
+
+def downgrade():
+    op.drop_index('ix_chatsession_user_id_updated_at', table_name='chatsession')
+    op.drop_index('ix_chatmessage_session_id_position', table_name='chatmessage')
+    # SQLite до 3.35 не умеет DROP COLUMN: batch пересоздает таблицу
+    with op.batch_alter_table('chatmessage') as batch_op:
+        batch_op.drop_column('position')
+    with op.batch_alter_table('chatsession') as batch_op:
+        batch_op.drop_column('version')
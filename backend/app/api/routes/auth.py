@@ -1,9 +1,9 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlmodel import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Any
 
-from app.database.db import get_db
+from app.database.db import get_async_db
 from app.models.user import User
 from app.schemas.user import UserCreate, UserResponse
 from app.services.user_service import UserService
@@ -19,37 +19,37 @@ from datetime import timedelta
 router = APIRouter(tags=["auth"])
 
 @router.post("/register", response_model=UserResponse)
-def register_user(user_data: UserCreate, db: Session = Depends(get_db)) -> Any:
+async def register_user(user_data: UserCreate, db: AsyncSession = Depends(get_async_db)) -> Any:
     """
     Регистрация нового пользователя
     """
     user_service = UserService(db)
     
     # Проверка существования пользователя
-    if user_service.get_user_by_email(user_data.email):
+    if await user_service.get_user_by_email(user_data.email):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Пользователь с таким email уже существует"
         )
         
-    if user_service.get_user_by_username(user_data.username):
+    if await user_service.get_user_by_username(user_data.username):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Пользователь с таким именем уже существует"
         )
     
     # Создание пользователя
-    return user_service.create_user(user_data)
+    return await user_service.create_user(user_data)
 
 @router.post("/token", response_model=Token)
-def login_for_access_token(
+async def login_for_access_token(
     form_data: OAuth2PasswordRequestForm = Depends(),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ) -> Any:
     """
     Получение токена доступа OAuth2 через форму логина
     """
-    user = authenticate_user(db, form_data.username, form_data.password)
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -1,9 +1,9 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlmodel import Session
+from fastapi import APIRouter, BackgroundTasks, Depends, Header, HTTPException, Response, status
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
 from pydantic import BaseModel
 
-from app.database.db import get_db
+from app.database.db import get_async_db
 from app.models.chat import ChatSession
 from app.schemas.chat import (
     ChatSessionCreate,
@@ -11,50 +11,113 @@ from app.schemas.chat import (
     ChatSessionUpdate,
     MessageCreate,
     MessageResponse,
-    MessagesUpdate
+    MessagesUpdate,
+    MessagesDelta,
+    MessagesDeltaResponse
 )
-from app.services.chat_service import ChatService
+from app.services.chat_service import ChatService, VersionConflict
 from app.services.auth_service import get_current_user, get_current_active_user
+from app.services.generation_context import generation_contexts
+from app.services.residency import residency_manager
+from app.services.semantic_index import semantic_index
 
 # Создание роутера для чат-сессий
 router = APIRouter(prefix="/chat-sessions", tags=["chat"])
 
+# Максимум результатов семантического поиска
+SEARCH_MAX_RESULTS = 50
+
+def index_messages_in_background(background_tasks: BackgroundTasks, user_id: str, messages) -> None:
+    """Векторы сообщений для поиска считаются после ответа клиенту"""
+    background_tasks.add_task(
+        semantic_index.index_messages,
+        user_id,
+        [(message.id, message.session_id, message.content) for message in messages]
+    )
+
+def session_rows(session: ChatSession):
+    """Сообщения сессии в виде (id, id сессии, текст) для индекса поиска"""
+    return [(message.id, message.session_id, message.content) for message in session.messages]
+
 @router.post("/", response_model=ChatSessionResponse)
-def create_chat_session(
+async def create_chat_session(
     session_data: ChatSessionCreate,
-    db: Session = Depends(get_db),
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_async_db),
     current_user = Depends(get_current_active_user)
 ):
     """
     Создать новую сессию чата для текущего пользователя
     """
     chat_service = ChatService(db)
-    return chat_service.create_session(current_user.id, session_data)
+    session = await chat_service.create_session(current_user.id, session_data)
+    if session_data.messages:
+        background_tasks.add_task(semantic_index.index_messages, current_user.id, session_rows(session))
+    return session
 
 @router.get("/", response_model=List[ChatSessionResponse])
-def get_user_chat_sessions(
+async def get_user_chat_sessions(
     skip: int = 0,
     limit: int = 100,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user = Depends(get_current_active_user)
 ):
     """
     Получить список всех сессий чата текущего пользователя
     """
     chat_service = ChatService(db)
-    return chat_service.get_user_sessions(current_user.id, skip, limit)
+    return await chat_service.get_user_sessions(current_user.id, skip, limit)
+
+@router.get("/search")
+async def search_chat_messages(
+    q: str,
+    k: int = 10,
+    current_user = Depends(get_current_active_user)
+):
+    """
+    Семантический поиск по сообщениям всех сессий пользователя.
+    Возвращает до k сообщений, ближайших по смыслу к запросу, с id их сессий.
+    """
+    if not q.strip():
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Пустой поисковый запрос"
+        )
+    return await semantic_index.search(current_user.id, q, max(1, min(k, SEARCH_MAX_RESULTS)))
+
+@router.get("/search/text")
+async def search_chat_messages_text(
+    q: str,
+    limit: int = 20,
+    db: AsyncSession = Depends(get_async_db),
+    current_user = Depends(get_current_active_user)
+):
+    """
+    Поиск по словам в сообщениях всех сессий пользователя (полнотекстовый индекс).
+    Результаты упорядочены по релевантности, snippet - фрагмент текста
+    с найденными словами, выделенными **.
+    """
+    if not q.strip():
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Пустой поисковый запрос"
+        )
+    chat_service = ChatService(db)
+    return await chat_service.search_messages(current_user.id, q, max(1, min(limit, SEARCH_MAX_RESULTS)))
 
 @router.get("/{session_id}", response_model=ChatSessionResponse)
-def get_chat_session(
+async def get_chat_session(
     session_id: str,
-    db: Session = Depends(get_db),
+    response: Response,
+    db: AsyncSession = Depends(get_async_db),
     current_user = Depends(get_current_active_user)
 ):
     """
-    Получить конкретную сессию чата по ID
+    Получить конкретную сессию чата по ID.
+    Модель сессии прогревается в фоне, чтобы первый ответ не ждал ее загрузки.
     """
     chat_service = ChatService(db)
-    session = chat_service.get_session_by_id(session_id)
+    session = await chat_service.get_session_by_id(session_id, with_messages=True)
     
     if not session:
         raise HTTPException(
@@ -67,14 +130,17 @@ def get_chat_session(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="У вас нет доступа к этой сессии"
         )
-        
+    
+    # Повторные открытия сессии не запускают второй прогрев той же модели
+    residency_manager.schedule_warm(session.model)
+    response.headers["ETag"] = f'"{session.version}"'
     return session
 
 @router.put("/{session_id}", response_model=ChatSessionResponse)
-def update_chat_session(
+async def update_chat_session(
     session_id: str,
     session_data: ChatSessionUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user = Depends(get_current_active_user)
 ):
     """
@@ -82,7 +148,7 @@ def update_chat_session(
     """
     chat_service = ChatService(db)
     
-    session = chat_service.get_session_by_id(session_id)
+    session = await chat_service.get_session_by_id(session_id)
     if not session:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -95,13 +161,14 @@ def update_chat_session(
             detail="У вас нет доступа к этой сессии"
         )
     
-    updated_session = chat_service.update_session(session_id, session_data)
+    updated_session = await chat_service.update_session(session_id, session_data)
     return updated_session
 
 @router.delete("/{session_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_chat_session(
+async def delete_chat_session(
     session_id: str,
-    db: Session = Depends(get_db),
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_async_db),
     current_user = Depends(get_current_active_user)
 ):
     """
@@ -109,7 +176,7 @@ def delete_chat_session(
     """
     chat_service = ChatService(db)
     
-    session = chat_service.get_session_by_id(session_id)
+    session = await chat_service.get_session_by_id(session_id)
     if not session:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -122,14 +189,18 @@ def delete_chat_session(
             detail="У вас нет доступа к этой сессии"
         )
     
-    chat_service.delete_session(session_id)
+    await chat_service.delete_session(session_id)
+    # Сохраненный контекст Ollama для этой сессии больше не нужен
+    generation_contexts.forget(current_user.id, session_id)
+    background_tasks.add_task(semantic_index.remove_session, current_user.id, session_id)
     return None
 
 @router.post("/{session_id}/messages", response_model=MessageResponse)
-def add_message_to_session(
+async def add_message_to_session(
     session_id: str,
     message_data: MessageCreate,
-    db: Session = Depends(get_db),
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_async_db),
     current_user = Depends(get_current_active_user)
 ):
     """
@@ -138,7 +209,7 @@ def add_message_to_session(
     chat_service = ChatService(db)
     
     # Проверка существования и принадлежности
-    session = chat_service.get_session_by_id(session_id)
+    session = await chat_service.get_session_by_id(session_id)
     if not session:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -151,12 +222,14 @@ def add_message_to_session(
             detail="У вас нет доступа к этой сессии"
         )
     
-    return chat_service.add_message(session_id, message_data)
+    message = await chat_service.add_message(session_id, message_data)
+    index_messages_in_background(background_tasks, current_user.id, [message])
+    return message
 
 @router.get("/{session_id}/messages", response_model=List[MessageResponse])
-def get_session_messages(
+async def get_session_messages(
     session_id: str,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user = Depends(get_current_active_user)
 ):
     """
@@ -165,7 +238,52 @@ def get_session_messages(
     chat_service = ChatService(db)
     
     # Проверка существования и принадлежности
-    session = chat_service.get_session_by_id(session_id)
+    session = await chat_service.get_session_by_id(session_id)
+    if not session:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Сессия не найдена"
+        )
+        
+    if session.user_id != current_user.id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="У вас нет доступа к этой сессии"
+        )
+    
+    return await chat_service.get_session_messages(session_id)
+
+def parse_version(if_match: Optional[str]) -> Optional[int]:
+    """Версия из заголовка If-Match вида "5" или W/"5" """
+    if not if_match:
+        return None
+    value = if_match.strip()
+    if value.startswith("W/"):
+        value = value[2:]
+    value = value.strip('"')
+    return int(value) if value.isdigit() else None
+
+@router.patch("/{session_id}/messages", response_model=MessagesDeltaResponse)
+async def sync_session_messages(
+    session_id: str,
+    delta: MessagesDelta,
+    background_tasks: BackgroundTasks,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_async_db),
+    current_user = Depends(get_current_active_user)
+):
+    """
+    Изменить сообщения сессии относительно известной клиенту версии:
+    удалить сообщения начиная с номера truncate_from, изменить сообщения edits
+    по номеру и добавить сообщения append в конец. Все выполняется одной транзакцией.
+    Версия передается в заголовке If-Match (значение ETag из GET сессии) или в base_version.
+    Если сессию уже изменили, возвращается 412 с текущей версией.
+    """
+    chat_service = ChatService(db)
+    
+    # Проверка существования и принадлежности
+    session = await chat_service.get_session_by_id(session_id)
     if not session:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -178,22 +296,50 @@ def get_session_messages(
             detail="У вас нет доступа к этой сессии"
         )
     
-    return chat_service.get_session_messages(session_id)
+    base_version = parse_version(if_match)
+    if base_version is None:
+        base_version = delta.base_version
+    if base_version is None:
+        raise HTTPException(
+            status_code=status.HTTP_428_PRECONDITION_REQUIRED,
+            detail="Нужна версия сессии: заголовок If-Match или поле base_version"
+        )
+    
+    try:
+        result = await chat_service.apply_messages_delta(session_id, delta, base_version)
+    except VersionConflict as conflict:
+        raise HTTPException(
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            detail={"message": "Сессия изменена другим клиентом", "version": conflict.version},
+            headers={"ETag": f'"{conflict.version}"'} if conflict.version is not None else None
+        )
+    except ValueError as error:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(error))
+    
+    if result["removed_ids"]:
+        background_tasks.add_task(semantic_index.remove_messages, current_user.id, result["removed_ids"])
+    if result["changed"]:
+        background_tasks.add_task(semantic_index.index_messages, current_user.id, result["changed"])
+    
+    response.headers["ETag"] = f'"{result["version"]}"'
+    return MessagesDeltaResponse(version=result["version"], message_count=result["message_count"])
 
 @router.put("/{session_id}/messages", response_model=ChatSessionResponse)
-def update_session_messages(
+async def update_session_messages(
     session_id: str,
     messages_data: MessagesUpdate,
-    db: Session = Depends(get_db),
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_async_db),
     current_user = Depends(get_current_active_user)
 ):
     """
-    Обновить все сообщения в сессии чата
+    Обновить все сообщения в сессии чата.
+    Перезаписывает всю сессию; для изменений по ходу разговора используйте PATCH.
     """
     chat_service = ChatService(db)
     
     # Проверка существования и принадлежности
-    session = chat_service.get_session_by_id(session_id)
+    session = await chat_service.get_session_by_id(session_id)
     if not session:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -206,10 +352,10 @@ def update_session_messages(
             detail="У вас нет доступа к этой сессии"
         )
     
-    # Удаляем все существующие сообщения
-    chat_service.delete_session_messages(session_id)
-      # Добавляем новые сообщения
-    for message_data in messages_data.messages:
-        chat_service.add_message(session_id, message_data)
+    # Старые сообщения удаляются и новые вставляются одной транзакцией
+    rows = await chat_service.replace_session_messages(session_id, messages_data.messages)
     
-    return chat_service.get_session_by_id(session_id)
+    # Старые сообщения удалены из индекса поиска, новые добавятся в фоне
+    # (неизменившиеся тексты берутся из кэша эмбеддингов)
+    background_tasks.add_task(semantic_index.replace_session, current_user.id, session_id, rows)
+    return await chat_service.get_session_by_id(session_id, with_messages=True)
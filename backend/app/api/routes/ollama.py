@@ -1,21 +1,106 @@
-from fastapi import APIRouter, Depends, HTTPException, Body
-from typing import List, Dict, Optional
+from fastapi import APIRouter, Depends, HTTPException, Body, Response, Request
+from fastapi.responses import StreamingResponse
+from typing import List, Dict, Optional, Any, AsyncIterator
+import asyncio
+import json
+import logging
+import time
 from app.services.auth_service import get_current_active_user
 from app.services.ollama_service import (
     send_message,
     send_streaming_message,
+    stream_chat,
     get_available_models,
-    test_connection
+    get_embeddings,
+    history_stats,
+    cancellation_stats,
+    embedding_stats
 )
+from app.services.batch_service import run_batch
+from app.services.job_service import generation_jobs
+from app.services.ollama_client import get_backend_pool
+from app.services.model_registry import model_registry
+from app.services.health_monitor import health_monitor
+from app.services.scheduler import model_scheduler
+from app.services.single_flight import single_flight
+from app.services.response_cache import response_cache
+from app.services.generation_context import generation_contexts
+from app.services.residency import residency_manager
+from app.services.latency import latency_tracker
+from app.services.embedding_store import embedding_store
+from app.services.semantic_index import semantic_index
+from app.core.config import settings
 from pydantic import BaseModel
 
+logger = logging.getLogger(__name__)
+
 # Определение маршрута для Ollama API
 router = APIRouter(tags=["ollama"])
 
+# Интервал keep-alive комментариев в потоке статуса (секунды)
+STATUS_KEEPALIVE_SECONDS = 15
+
+# Заголовок, отключающий чтение из кэша ответов для одного запроса
+CACHE_BYPASS_HEADER = "X-Cache-Bypass"
+
+def use_response_cache(http_request: Request) -> bool:
+    """Можно ли отдать ответ из кэша: нет X-Cache-Bypass и Cache-Control: no-cache"""
+    if http_request.headers.get(CACHE_BYPASS_HEADER, "").lower() in ("1", "true", "yes"):
+        return False
+    return "no-cache" not in http_request.headers.get("Cache-Control", "").lower()
+
+async def wait_for_disconnect(http_request: Request) -> None:
+    """
+    Ждет сообщения http.disconnect от ASGI-сервера.
+    Тело запроса к этому моменту уже прочитано, поэтому следующий receive
+    завершится только при отключении клиента.
+    """
+    while True:
+        message = await http_request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+async def cancel_on_disconnect(http_request: Request, generation: "asyncio.Task[Any]") -> Any:
+    """
+    Ждет результат генерации, пока клиент на связи.
+    Если клиент отключился, отменяет генерацию: поток к Ollama закрывается, и она перестает генерировать.
+    """
+    disconnect = asyncio.create_task(wait_for_disconnect(http_request))
+    try:
+        await asyncio.wait({generation, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+        if generation.done():
+            return generation.result()
+        logger.info("Клиент отключился, генерация отменена")
+        # 499 - клиент закрыл запрос; ответ уже никто не получит
+        raise HTTPException(status_code=499, detail="Client closed request")
+    finally:
+        disconnect.cancel()
+        if not generation.done():
+            generation.cancel()
+            try:
+                await generation
+            except (asyncio.CancelledError, Exception):
+                pass
+
 # Схема для запроса чата
 class ChatRequest(BaseModel):
     model: str
     messages: List[Dict[str, str]]
+    # Параметры генерации Ollama (temperature, seed, num_predict и т.д.)
+    options: Optional[Dict[str, Any]] = None
+    # ID сессии чата: позволяет переиспользовать контекст Ollama с прошлого хода
+    session_id: Optional[str] = None
+
+# Схема для пакетного запроса чата
+class BatchChatRequest(BaseModel):
+    requests: List[ChatRequest]
+    # Одновременных запросов пакета на одну модель (по умолчанию OLLAMA_BATCH_CONCURRENCY)
+    concurrency: Optional[int] = None
+
+# Схема для запроса эмбеддингов
+class EmbeddingsRequest(BaseModel):
+    model: str
+    input: List[str]
 
 # Схема для ответа от модели
 class ChatResponse(BaseModel):
@@ -30,6 +115,7 @@ class OllamaModel(BaseModel):
 @router.post("/chat", response_model=ChatResponse)
 async def chat_with_model(
     request: ChatRequest,
+    http_request: Request,
     current_user = Depends(get_current_active_user)
 ):
     """
@@ -42,7 +128,15 @@ async def chat_with_model(
         print(f"Количество сообщений в истории: {len(request.messages)}")
         
         # Использование потокового режима для всех моделей для более стабильной работы
-        response = await send_streaming_message(model=request.model, messages=request.messages)
+        generation = asyncio.create_task(send_streaming_message(
+            model=request.model,
+            messages=request.messages,
+            user_id=current_user.id,
+            options=request.options,
+            use_cache=use_response_cache(http_request),
+            session_id=request.session_id
+        ))
+        response = await cancel_on_disconnect(http_request, generation)
         
         # Убедимся, что ответ не пустой
         if not response or response.strip() == "":
@@ -62,8 +156,223 @@ async def chat_with_model(
         # Остальные ошибки конвертируем в HTTP ошибки
         raise HTTPException(status_code=500, detail=str(e))
 
+async def ndjson_stream(
+    first_chunk: Optional[Dict[str, Any]],
+    chunks: AsyncIterator[Dict[str, Any]]
+) -> AsyncIterator[str]:
+    """Сериализует фрагменты ответа в NDJSON (один JSON-объект на строку)"""
+    try:
+        if first_chunk is not None:
+            yield json.dumps(first_chunk, ensure_ascii=False) + "\n"
+        async for chunk in chunks:
+            yield json.dumps(chunk, ensure_ascii=False) + "\n"
+    except HTTPException as e:
+        # Статус уже отправлен, поэтому сообщаем об ошибке последней строкой
+        yield json.dumps({"error": e.detail, "done": True}, ensure_ascii=False) + "\n"
+    except Exception as e:
+        yield json.dumps({"error": str(e), "done": True}, ensure_ascii=False) + "\n"
+    finally:
+        await chunks.aclose()
+
+@router.post("/chat/stream")
+async def stream_chat_with_model(
+    request: ChatRequest,
+    http_request: Request,
+    current_user = Depends(get_current_active_user)
+):
+    """
+    Потоковый чат с моделью Ollama.
+    Возвращает NDJSON: каждая строка - фрагмент ответа {"model", "content", "done"},
+    отправляемый сразу после генерации, без ожидания всего ответа.
+    Пока запрос ждет своей очереди, приходят строки {"queued": true, "position": N}.
+    Если очередь модели заполнена, возвращается 429 с заголовком Retry-After.
+    Детерминированные ответы (temperature 0 или seed) могут прийти из кэша,
+    это видно по заголовку X-Cache; X-Cache-Bypass: 1 отключает чтение из кэша.
+    При отключении клиента сервер отменяет отправку потока, закрытие генератора
+    закрывает поток к Ollama, и генерация останавливается.
+    """
+    chunks = stream_chat(
+        model=request.model,
+        messages=request.messages,
+        user_id=current_user.id,
+        options=request.options,
+        use_cache=use_response_cache(http_request),
+        session_id=request.session_id
+    )
+    
+    # Дожидаемся первого фрагмента, чтобы ошибки Ollama и 429 вернулись обычным HTTP статусом
+    try:
+        first_chunk = await chunks.__anext__()
+    except StopAsyncIteration:
+        first_chunk = None
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    cached = bool(first_chunk and first_chunk.get("cached"))
+    return StreamingResponse(
+        ndjson_stream(first_chunk, chunks),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Cache": "HIT" if cached else "MISS"}
+    )
+
+@router.post("/chat/batch")
+async def batch_chat_with_model(
+    batch: BatchChatRequest,
+    http_request: Request,
+    current_user = Depends(get_current_active_user)
+):
+    """
+    Выполняет много запросов чата за одно соединение.
+    Возвращает NDJSON: по строке на запрос в порядке завершения, с полями
+    index (номер запроса в пакете), content или error, prompt_tokens,
+    completion_tokens, duration_ms и ttft_ms. Последняя строка - {"summary": {...}}.
+    """
+    if not batch.requests:
+        raise HTTPException(status_code=400, detail="Batch is empty")
+    if len(batch.requests) > settings.OLLAMA_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch is too large: {len(batch.requests)} requests, maximum is {settings.OLLAMA_BATCH_MAX_ITEMS}"
+        )
+    
+    concurrency = max(1, min(batch.concurrency or settings.OLLAMA_BATCH_CONCURRENCY, settings.OLLAMA_BATCH_CONCURRENCY))
+    logger.info(f"Пакет из {len(batch.requests)} запросов от пользователя {current_user.username}, параллельность {concurrency}")
+    
+    results = run_batch(
+        [item.model_dump() for item in batch.requests],
+        user_id=current_user.id,
+        concurrency=concurrency,
+        use_cache=use_response_cache(http_request)
+    )
+    
+    async def batch_stream() -> AsyncIterator[str]:
+        start_time = time.monotonic()
+        failed = 0
+        try:
+            async for result in results:
+                if "error" in result:
+                    failed += 1
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+            summary = {
+                "total": len(batch.requests),
+                "failed": failed,
+                "duration_ms": round((time.monotonic() - start_time) * 1000, 1),
+            }
+            yield json.dumps({"summary": summary}, ensure_ascii=False) + "\n"
+        finally:
+            await results.aclose()
+    
+    return StreamingResponse(
+        batch_stream(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.post("/chat/jobs", status_code=202)
+async def create_chat_job(
+    request: ChatRequest,
+    current_user = Depends(get_current_active_user)
+):
+    """
+    Создает фоновое задание генерации и сразу возвращает его id.
+    Генерация не зависит от соединения клиента: ответ можно получить опросом
+    GET /chat/jobs/{id} или подключившись к потоку GET /chat/jobs/{id}/stream.
+    Подходит для больших моделей, где ответ может занимать минуты.
+    """
+    logger.info(f"Фоновое задание для модели {request.model} от пользователя {current_user.username}")
+    return await generation_jobs.submit(
+        user_id=current_user.id,
+        model=request.model,
+        messages=request.messages,
+        options=request.options,
+        session_id=request.session_id
+    )
+
+@router.get("/chat/jobs")
+async def list_chat_jobs(
+    limit: int = 50,
+    current_user = Depends(get_current_active_user)
+):
+    """
+    Последние задания генерации пользователя
+    """
+    return await generation_jobs.list_jobs(current_user.id, max(1, min(limit, 200)))
+
+@router.get("/chat/jobs/{job_id}")
+async def get_chat_job(
+    job_id: str,
+    offset: int = 0,
+    current_user = Depends(get_current_active_user)
+):
+    """
+    Состояние задания и сгенерированный текст. offset - число уже полученных
+    символов ответа: вернется только продолжение, content_length - полная длина.
+    """
+    return await generation_jobs.get(job_id, current_user.id, max(0, offset))
+
+@router.get("/chat/jobs/{job_id}/stream")
+async def stream_chat_job(
+    job_id: str,
+    offset: int = 0,
+    current_user = Depends(get_current_active_user)
+):
+    """
+    Подключение к потоку задания (NDJSON). Первая строка содержит уже
+    сгенерированный текст начиная с offset, дальше - новые фрагменты,
+    последняя строка - итог с "done": true. После обрыва соединения можно
+    подключиться снова с offset, равным длине уже полученного текста.
+    Отключение клиента не останавливает генерацию.
+    """
+    events = generation_jobs.attach(job_id, current_user.id, max(0, offset))
+    
+    # Первая строка до ответа, чтобы 404 вернулся обычным HTTP статусом
+    try:
+        first_event = await events.__anext__()
+    except StopAsyncIteration:
+        first_event = None
+    
+    return StreamingResponse(
+        ndjson_stream(first_event, events),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.delete("/chat/jobs/{job_id}")
+async def cancel_chat_job(
+    job_id: str,
+    current_user = Depends(get_current_active_user)
+):
+    """
+    Отменяет задание; уже сгенерированный текст сохраняется
+    """
+    logger.info(f"Отмена задания {job_id} пользователем {current_user.username}")
+    return await generation_jobs.cancel(job_id, current_user.id)
+
+@router.post("/embeddings")
+async def create_embeddings(
+    request: EmbeddingsRequest,
+    current_user = Depends(get_current_active_user)
+):
+    """
+    Возвращает эмбеддинги для списка текстов в том же порядке.
+    Тексты отправляются в Ollama /api/embed пакетами; уже посчитанные векторы
+    берутся из кэша по (модель, sha256 текста) и повторно не считаются.
+    В ответе cached и embedded - сколько уникальных текстов взято из кэша и посчитано.
+    """
+    if len(request.input) > settings.OLLAMA_EMBED_MAX_TEXTS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Too many texts: {len(request.input)}, maximum is {settings.OLLAMA_EMBED_MAX_TEXTS}"
+        )
+    
+    logger.debug(f"Эмбеддинги {len(request.input)} текстов моделью {request.model} для пользователя {current_user.username}")
+    return await get_embeddings(request.model, request.input, user_id=current_user.id)
+
 @router.get("/models", response_model=List[OllamaModel])
 async def list_models(
+    response: Response,
     current_user = Depends(get_current_active_user)
 ):
     """
@@ -72,16 +381,19 @@ async def list_models(
     try:
         print(f"Получение списка моделей для пользователя: {current_user.username}")
         
-        # Сначала проверяем соединение с Ollama
-        is_connected = await test_connection()
-        if not is_connected:
+        models = await get_available_models()
+        
+        # Каталог так и не удалось получить - Ollama недоступна
+        if not model_registry.is_loaded:
             print("Нет соединения с Ollama API")
             raise HTTPException(status_code=503, 
                                detail="Cannot connect to Ollama API. Please make sure Ollama is running.")
         
-        models = await get_available_models()
         print(f"Найдено моделей: {len(models)}")
         
+        # Возраст каталога, чтобы клиент видел, насколько свежий список
+        response.headers["X-Models-Catalog-Age"] = f"{model_registry.age():.1f}"
+        
         # Если моделей нет, возможно Ollama запущена, но нет загруженных моделей
         if len(models) == 0:
             print("Модели не найдены, хотя Ollama доступна")
@@ -101,11 +413,69 @@ async def check_status():
     """
     Проверяет статус подключения к Ollama.
     Эта конечная точка доступна без аутентификации для проверки доступности.
+    Статус берется из памяти фонового монитора, Ollama при этом не опрашивается.
     """
     try:
-        is_connected = await test_connection()
-        return {"status": "connected" if is_connected else "disconnected"}
+        return await health_monitor.get_status()
     except Exception as e:
         # Логируем ошибку, но всегда возвращаем 200 статус код
         print(f"Ошибка проверки статуса Ollama: {e}")
         return {"status": "disconnected", "error": str(e)}
+
+@router.get("/status/history", status_code=200)
+async def get_status_history():
+    """
+    История фоновых проверок Ollama (время, доступность, задержка)
+    """
+    return health_monitor.get_history()
+
+@router.get("/status/stream")
+async def stream_status(request: Request):
+    """
+    Server-Sent Events: отправляет статус Ollama после каждой фоновой проверки,
+    чтобы клиентам не нужно было опрашивать /status.
+    """
+    async def event_stream() -> AsyncIterator[str]:
+        queue = health_monitor.subscribe()
+        try:
+            status = await health_monitor.get_status()
+            yield f"data: {json.dumps(status, ensure_ascii=False)}\n\n"
+            while not await request.is_disconnected():
+                try:
+                    status = await asyncio.wait_for(queue.get(), timeout=STATUS_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    # Комментарий SSE не дает прокси закрыть простаивающее соединение
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"data: {json.dumps(status, ensure_ascii=False)}\n\n"
+        finally:
+            health_monitor.unsubscribe(queue)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.get("/stats")
+async def get_ollama_stats(
+    current_user = Depends(get_current_active_user)
+):
+    """
+    Возвращает статистику пула соединений с Ollama, кэша каталога моделей, очередей, кэша ответов, контекстов сессий, прогрева, задержек моделей, фоновых заданий, эмбеддингов и семантического поиска
+    """
+    return {
+        "pool": get_backend_pool().stats(),
+        "models_catalog": model_registry.stats(),
+        "scheduler": model_scheduler.stats(),
+        "single_flight": single_flight.stats(),
+        "response_cache": response_cache.stats(),
+        "generation_contexts": generation_contexts.stats(),
+        "history_trimming": dict(history_stats),
+        "residency": residency_manager.stats(),
+        "latency": latency_tracker.stats(),
+        "cancellations": dict(cancellation_stats),
+        "jobs": generation_jobs.stats(),
+        "embeddings": {**embedding_stats, "store": await embedding_store.stats()},
+        "semantic_search": semantic_index.stats(),
+    }
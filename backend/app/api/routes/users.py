@@ -1,8 +1,8 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlmodel import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
 
-from app.database.db import get_db
+from app.database.db import get_async_db
 from app.models.user import User
 from app.schemas.user import UserCreate, UserResponse, UserUpdate
 from app.services.user_service import UserService
@@ -11,43 +11,43 @@ from app.services.user_service import UserService
 router = APIRouter(prefix="/users", tags=["users"])
 
 @router.post("/", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
-def create_user(user_data: UserCreate, db: Session = Depends(get_db)):
+async def create_user(user_data: UserCreate, db: AsyncSession = Depends(get_async_db)):
     """
     Создать нового пользователя
     """
     user_service = UserService(db)
     
     # Проверка, что пользователь с таким email не существует
-    if user_service.get_user_by_email(user_data.email):
+    if await user_service.get_user_by_email(user_data.email):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Пользователь с таким email уже существует"
         )
     
     # Проверка, что пользователь с таким username не существует
-    if user_service.get_user_by_username(user_data.username):
+    if await user_service.get_user_by_username(user_data.username):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Пользователь с таким именем уже существует"
         )
     
-    return user_service.create_user(user_data)
+    return await user_service.create_user(user_data)
 
 @router.get("/", response_model=List[UserResponse])
-def get_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+async def get_users(skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_async_db)):
     """
     Получить список всех пользователей
     """
     user_service = UserService(db)
-    return user_service.get_users(skip=skip, limit=limit)
+    return await user_service.get_users(skip=skip, limit=limit)
 
 @router.get("/{user_id}", response_model=UserResponse)
-def get_user(user_id: str, db: Session = Depends(get_db)):
+async def get_user(user_id: str, db: AsyncSession = Depends(get_async_db)):
     """
     Получить пользователя по ID
     """
     user_service = UserService(db)
-    user = user_service.get_user_by_id(user_id)
+    user = await user_service.get_user_by_id(user_id)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -56,12 +56,12 @@ def get_user(user_id: str, db: Session = Depends(get_db)):
     return user
 
 @router.put("/{user_id}", response_model=UserResponse)
-def update_user(user_id: str, user_data: UserUpdate, db: Session = Depends(get_db)):
+async def update_user(user_id: str, user_data: UserUpdate, db: AsyncSession = Depends(get_async_db)):
     """
     Обновить данные пользователя
     """
     user_service = UserService(db)
-    user = user_service.update_user(user_id, user_data)
+    user = await user_service.update_user(user_id, user_data)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -70,12 +70,12 @@ def update_user(user_id: str, user_data: UserUpdate, db: Session = Depends(get_d
     return user
 
 @router.delete("/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_user(user_id: str, db: Session = Depends(get_db)):
+async def delete_user(user_id: str, db: AsyncSession = Depends(get_async_db)):
     """
     Удалить пользователя
     """
     user_service = UserService(db)
-    result = user_service.delete_user(user_id)
+    result = await user_service.delete_user(user_id)
     if not result:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -22,8 +22,130 @@ class Settings(BaseSettings):
         raise ValueError(v)
     
     DATABASE_URL: str = "sqlite:///./ollamachat.db"
+
+    # Пул соединений с БД (для SQLite в памяти не используется)
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30.0
+    # Соединения старше этого числа секунд пересоздаются (обрывы по таймауту на стороне сервера БД)
+    DB_POOL_RECYCLE: int = 1800
+    # Проверка соединения перед выдачей из пула
+    DB_POOL_PRE_PING: bool = True
+
+    # PRAGMA для каждого нового соединения SQLite
+    # WAL: читатели не ждут писателя; NORMAL при WAL не теряет целостность при сбое процесса
+    SQLITE_JOURNAL_MODE: str = "WAL"
+    SQLITE_SYNCHRONOUS: str = "NORMAL"
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024
+    # Отрицательное значение - размер кэша страниц в КиБ
+    SQLITE_CACHE_SIZE: int = -64 * 1024
+    # Сколько миллисекунд ждать блокировку записи вместо ошибки "database is locked"
+    SQLITE_BUSY_TIMEOUT: int = 5000
     
     OLLAMA_API_URL: str = "http://localhost:11434"
+    # Несколько экземпляров Ollama через запятую; если не задано, используется OLLAMA_API_URL
+    OLLAMA_API_URLS: str = ""
+    # Число ошибок соединения подряд, после которого экземпляр исключается из пула
+    OLLAMA_EJECT_AFTER_FAILURES: int = 3
+
+    # Пул соединений с Ollama
+    OLLAMA_MAX_CONNECTIONS: int = 20
+    OLLAMA_MAX_KEEPALIVE_CONNECTIONS: int = 10
+    OLLAMA_KEEPALIVE_EXPIRY: float = 60.0
+    OLLAMA_POOL_TIMEOUT: float = 10.0
+
+    # Таймауты служебных проверок (/api/version, /api/tags)
+    OLLAMA_PROBE_CONNECT_TIMEOUT: float = 2.0
+    OLLAMA_PROBE_READ_TIMEOUT: float = 5.0
+
+    # Таймауты генерации
+    OLLAMA_GENERATION_CONNECT_TIMEOUT: float = 5.0
+    OLLAMA_GENERATION_READ_TIMEOUT: float = 180.0
+    OLLAMA_LARGE_MODEL_READ_TIMEOUT: float = 1000.0
+    # Модели с таким числом параметров и больше считаются большими (по /api/show)
+    OLLAMA_LARGE_MODEL_PARAMETERS: int = 20_000_000_000
+
+    # Адаптивные таймауты потоковой генерации: p99 наблюдаемых задержек x множитель
+    OLLAMA_TIMEOUT_P99_FACTOR: float = 3.0
+    OLLAMA_LATENCY_WINDOW: int = 200
+    OLLAMA_LATENCY_MIN_SAMPLES: int = 20
+    OLLAMA_MIN_FIRST_BYTE_TIMEOUT: float = 15.0
+    OLLAMA_MIN_IDLE_TIMEOUT: float = 5.0
+
+    # Кэш каталога моделей (/api/tags)
+    OLLAMA_MODELS_CACHE_TTL: float = 60.0
+    OLLAMA_MODELS_REFRESH_INTERVAL: float = 30.0
+
+    # Фоновый мониторинг доступности Ollama
+    OLLAMA_HEALTH_CHECK_INTERVAL: float = 10.0
+    OLLAMA_HEALTH_HISTORY_SIZE: int = 360
+
+    # Ограничение одновременных генераций на модель и размер очереди ожидания
+    OLLAMA_MODEL_CONCURRENCY: int = 2
+    # Индивидуальные ограничения, например "llama3:70b=1,phi3=4"
+    OLLAMA_MODEL_CONCURRENCY_OVERRIDES: str = ""
+    OLLAMA_MODEL_QUEUE_SIZE: int = 32
+    # Ограничение для больших моделей, если для них нет индивидуального значения
+    OLLAMA_LARGE_MODEL_CONCURRENCY: int = 1
+
+    # Пакетный чат: одновременных запросов пакета на модель и максимум запросов в пакете
+    OLLAMA_BATCH_CONCURRENCY: int = 2
+    OLLAMA_BATCH_MAX_ITEMS: int = 500
+
+    # Фоновые задания генерации (/ollama/chat/jobs)
+    OLLAMA_JOB_WORKERS: int = 2
+    OLLAMA_JOB_QUEUE_SIZE: int = 100
+    # Как часто частичный ответ сохраняется в БД (секунды)
+    OLLAMA_JOB_CHECKPOINT_INTERVAL: float = 2.0
+    # Сколько хранить завершенные задания (секунды) и как часто их удалять
+    OLLAMA_JOB_RETENTION: float = 86400.0
+    OLLAMA_JOB_CLEANUP_INTERVAL: float = 600.0
+
+    # Эмбеддинги (/ollama/embeddings): текстов в одном запросе к /api/embed и в запросе клиента
+    OLLAMA_EMBED_BATCH_SIZE: int = 64
+    OLLAMA_EMBED_MAX_TEXTS: int = 2048
+    # SQLite-файл кэша векторов; пусто - кэш только в памяти
+    OLLAMA_EMBEDDING_CACHE_DB_PATH: str = "./embeddings.db"
+
+    # Семантический поиск по истории чатов (/chat-sessions/search);
+    # включается после ollama pull модели эмбеддингов
+    OLLAMA_SEARCH_ENABLED: bool = False
+    OLLAMA_SEARCH_EMBED_MODEL: str = "nomic-embed-text"
+    # Сколько индексов пользователей держать в памяти
+    OLLAMA_SEARCH_MAX_USERS: int = 100
+
+    # Кэш ответов для детерминированных генераций (temperature 0 или seed)
+    OLLAMA_RESPONSE_CACHE_ENABLED: bool = False
+    OLLAMA_RESPONSE_CACHE_MAX_BYTES: int = 32 * 1024 * 1024
+    OLLAMA_RESPONSE_CACHE_TTL: float = 86400.0
+    # Путь к SQLite-файлу дискового уровня кэша; пусто - только память
+    OLLAMA_RESPONSE_CACHE_DB_PATH: str = ""
+
+    # Контекст /api/generate, сохраняемый между ходами сессии (суммарно токенов)
+    OLLAMA_CONTEXT_CACHE_MAX_TOKENS: int = 4_000_000
+
+    # Обрезка истории по бюджету токенов
+    # Длина контекста моделей, например "llama3:70b=8192,phi3=4096"; остальные - 8192
+    OLLAMA_MODEL_CONTEXT_LENGTHS: str = ""
+    # Токены, оставляемые под ответ модели, если в запросе нет num_predict
+    OLLAMA_RESPONSE_TOKEN_RESERVE: int = 1024
+    # Жесткий предел токенов истории; 0 - весь контекст модели за вычетом резерва
+    OLLAMA_HISTORY_TOKEN_BUDGET: int = 0
+
+    # Прогрев моделей и keep_alive
+    # Модели через запятую, загружаемые при старте и постоянно закрепленные в памяти
+    OLLAMA_PRELOAD_MODELS: str = ""
+    OLLAMA_KEEP_ALIVE: str = "5m"
+    OLLAMA_PINNED_KEEP_ALIVE: str = "30m"
+    # Сколько запросов за OLLAMA_USAGE_WINDOW секунд нужно, чтобы закрепить модель
+    OLLAMA_PIN_THRESHOLD: int = 5
+    OLLAMA_USAGE_WINDOW: float = 900.0
+    OLLAMA_RESIDENCY_INTERVAL: float = 60.0
+
+    def get_ollama_urls(self) -> List[str]:
+        """Адреса всех экземпляров Ollama"""
+        urls = [url.strip() for url in self.OLLAMA_API_URLS.split(",") if url.strip()]
+        return urls or [self.OLLAMA_API_URL]
     
     class Config:
         case_sensitive = True
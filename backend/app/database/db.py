@@ -1,19 +1,98 @@
-from sqlalchemy import create_engine, text
+from typing import Any, Dict
+from sqlalchemy import event, inspect, text
+from sqlalchemy.engine import Connection, Engine, make_url, URL
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 from sqlmodel import SQLModel, create_engine, Session
 import logging
 
-# Упрощенная версия - используем SQLite напрямую
-SQLALCHEMY_DATABASE_URL = "sqlite:///./ollamachat.db"
+from app.core.config import settings
+
+# Асинхронные драйверы для синхронных URL из настроек
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+def to_async_url(url: str) -> URL:
+    """Тот же адрес БД с асинхронным драйвером: sqlite -> aiosqlite, postgresql -> asyncpg"""
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"Нет асинхронного драйвера для {backend}")
+    return parsed.set(drivername=ASYNC_DRIVERS[backend])
+
+def is_memory_sqlite(url: URL) -> bool:
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+def engine_options(url: URL) -> Dict[str, Any]:
+    """Параметры движка из настроек: пул соединений для файловых баз и серверов"""
+    options: Dict[str, Any] = {"pool_pre_ping": settings.DB_POOL_PRE_PING}
+    if url.get_backend_name() == "sqlite":
+        options["connect_args"] = {"check_same_thread": False}
+    if not is_memory_sqlite(url):
+        options.update(
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_timeout=settings.DB_POOL_TIMEOUT,
+            pool_recycle=settings.DB_POOL_RECYCLE,
+        )
+    return options
+
+def sqlite_pragmas() -> Dict[str, Any]:
+    return {
+        "journal_mode": settings.SQLITE_JOURNAL_MODE,
+        "synchronous": settings.SQLITE_SYNCHRONOUS,
+        "mmap_size": settings.SQLITE_MMAP_SIZE,
+        "cache_size": settings.SQLITE_CACHE_SIZE,
+        "busy_timeout": settings.SQLITE_BUSY_TIMEOUT,
+    }
+
+def set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    """PRAGMA действуют на соединение, поэтому выполняются при каждом подключении"""
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in sqlite_pragmas().items():
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+def create_db_engine(url: str) -> Engine:
+    """Синхронный движок по адресу из настроек"""
+    parsed = make_url(url)
+    db_engine = create_engine(parsed, **engine_options(parsed))
+    if parsed.get_backend_name() == "sqlite":
+        event.listen(db_engine, "connect", set_sqlite_pragmas)
+    return db_engine
+
+def create_async_db_engine(url: str) -> AsyncEngine:
+    """Асинхронный движок для того же адреса"""
+    parsed = to_async_url(url)
+    db_engine = create_async_engine(parsed, **engine_options(parsed))
+    if parsed.get_backend_name() == "sqlite":
+        # События подключения регистрируются на синхронном движке внутри асинхронного
+        event.listen(db_engine.sync_engine, "connect", set_sqlite_pragmas)
+    return db_engine
+
+# Адрес БД из настроек (переменная окружения DATABASE_URL), по умолчанию SQLite-файл
+SQLALCHEMY_DATABASE_URL = settings.DATABASE_URL
 
 # Создание движка SQLAlchemy
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+engine = create_db_engine(SQLALCHEMY_DATABASE_URL)
 
 # Создание фабрики сессий
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-# Функция для получения сессии БД
+# Асинхронный движок: запросы к БД из обработчиков не блокируют цикл событий,
+# который одновременно отдает потоки токенов
+async_engine = create_async_db_engine(SQLALCHEMY_DATABASE_URL)
+
+# expire_on_commit=False: после commit атрибуты объектов остаются доступными
+# без повторного запроса (неявный запрос в асинхронной сессии невозможен)
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False, autoflush=False)
+
+# Функция для получения сессии БД (синхронные скрипты и фоновые потоки)
 def get_db():
     db = SessionLocal()
     try:
@@ -21,11 +100,70 @@ def get_db():
     finally:
         db.close()
 
+# Функция для получения асинхронной сессии БД в обработчиках запросов
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# Колонки, добавленные после создания первых баз: create_all не меняет существующие таблицы
+ADDED_COLUMNS = [
+    ("chatsession", "version", "INTEGER NOT NULL DEFAULT 0"),
+    ("chatmessage", "position", "INTEGER NOT NULL DEFAULT 0"),
+]
+
+# Номера сообщений 0, 1, 2... внутри сессии: для новой колонки (все номера 0) - по времени,
+# для старых повторяющихся номеров - с сохранением их порядка
+RENUMBER_MESSAGE_POSITIONS = text(
+    "UPDATE chatmessage SET position = ("
+    "SELECT ordered.rn FROM ("
+    "SELECT id, ROW_NUMBER() OVER (PARTITION BY session_id ORDER BY position, timestamp, id) - 1 AS rn FROM chatmessage"
+    ") AS ordered WHERE ordered.id = chatmessage.id)"
+)
+
+# Уникальный индекс номеров сообщений: перед его созданием номера перенумеровываются
+MESSAGE_POSITION_INDEX = "ix_chatmessage_session_id_position"
+
+def upgrade_schema(connection: Connection):
+    """
+    Добавляет недостающие колонки и индексы в таблицы, созданные старой версией приложения.
+    Меняет только то, чего в базе еще нет; для миграций есть ревизии Alembic.
+    """
+    inspector = inspect(connection)
+    tables = set(inspector.get_table_names())
+    for table, column, ddl in ADDED_COLUMNS:
+        if table not in tables or column in {item["name"] for item in inspector.get_columns(table)}:
+            continue
+        connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+        logging.info(f"Added column {table}.{column}")
+        if (table, column) == ("chatmessage", "position"):
+            connection.execute(RENUMBER_MESSAGE_POSITIONS)
+    # create_all создает индексы только вместе с новой таблицей
+    for table in SQLModel.metadata.sorted_tables:
+        if table.name not in tables or not table.indexes:
+            continue
+        existing = {item["name"]: bool(item["unique"]) for item in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if existing.get(index.name) == bool(index.unique):
+                continue
+            if index.name in existing:
+                # Индекс стал уникальным (или перестал): пересоздаем
+                index.drop(connection)
+            if index.name == MESSAGE_POSITION_INDEX:
+                connection.execute(RENUMBER_MESSAGE_POSITIONS)
+            index.create(connection)
+            logging.info(f"Created index {index.name}")
+
 # Функция для инициализации моделей БД
 def init_db():
     try:
         # Создаем таблицы
         SQLModel.metadata.create_all(bind=engine)
+        with engine.begin() as connection:
+            upgrade_schema(connection)
         logging.info("Database tables created successfully")
+        # Полнотекстовый индекс сообщений (только SQLite)
+        from app.database.fts import setup_message_fts
+        if setup_message_fts(engine):
+            logging.info("Message full-text index is ready")
     except Exception as e:
         logging.error(f"Error initializing database: {e}")
@@ -0,0 +1,143 @@
+"""
+Полнотекстовый индекс сообщений чата (SQLite FTS5).
+
+Таблица chatmessage_fts хранит только индекс: текст читается из chatmessage
+по rowid (external content), а триггеры обновляют индекс при любой записи
+в chatmessage, в том числе массовых удалениях.
+
+Пересборка индекса для существующей базы (например, созданной до появления
+индекса или после VACUUM, который может перенумеровать rowid):
+    python -m app.database.fts --rebuild
+"""
+from typing import Any, Dict, List
+import argparse
+import logging
+import re
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = "chatmessage_fts"
+
+# Границы найденных слов во фрагменте текста
+SNIPPET_MARK_OPEN = "**"
+SNIPPET_MARK_CLOSE = "**"
+# Длина фрагмента в словах
+SNIPPET_TOKENS = 16
+
+FTS_SCHEMA = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+    "content, content='chatmessage', content_rowid='rowid', "
+    "tokenize='unicode61 remove_diacritics 2')",
+    f"CREATE TRIGGER IF NOT EXISTS chatmessage_fts_insert AFTER INSERT ON chatmessage BEGIN "
+    f"INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.rowid, new.content); END",
+    f"CREATE TRIGGER IF NOT EXISTS chatmessage_fts_delete AFTER DELETE ON chatmessage BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.rowid, old.content); END",
+    f"CREATE TRIGGER IF NOT EXISTS chatmessage_fts_update AFTER UPDATE OF content ON chatmessage BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.rowid, old.content); "
+    f"INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.rowid, new.content); END",
+]
+
+SEARCH_QUERY = text(
+    f"SELECT m.id, m.session_id, m.role, m.timestamp, "
+    f"snippet({FTS_TABLE}, 0, :mark_open, :mark_close, '…', :snippet_tokens) AS snippet, "
+    f"bm25({FTS_TABLE}) AS rank "
+    f"FROM {FTS_TABLE} "
+    f"JOIN chatmessage AS m ON m.rowid = {FTS_TABLE}.rowid "
+    f"JOIN chatsession AS s ON s.id = m.session_id "
+    f"WHERE {FTS_TABLE} MATCH :query AND s.user_id = :user_id "
+    f"ORDER BY rank LIMIT :limit"
+)
+
+
+def is_fts_available(bind: Any) -> bool:
+    """FTS5 есть только у SQLite; для других СУБД поиск идет через LIKE"""
+    return bind.dialect.name == "sqlite"
+
+
+def setup_message_fts(engine: Engine) -> bool:
+    """
+    Создает индекс и триггеры, если их нет. Если таблица индекса только что
+    появилась в базе с сообщениями, индекс заполняется.
+    """
+    if not is_fts_available(engine):
+        return False
+    with engine.begin() as connection:
+        existed = connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": FTS_TABLE}
+        ).first() is not None
+        for statement in FTS_SCHEMA:
+            connection.execute(text(statement))
+        if not existed:
+            rebuild_message_fts(connection)
+    return True
+
+
+def rebuild_message_fts(connection: Connection) -> None:
+    """Пересобирает индекс по текущему содержимому chatmessage"""
+    connection.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+
+
+def build_match_query(query: str) -> str:
+    """
+    Запрос пользователя в безопасное выражение FTS5: каждое слово в кавычках
+    (спецсимволы синтаксиса FTS не вызывают ошибок), все слова обязательны,
+    последнее ищется как префикс, чтобы поиск работал во время набора.
+    """
+    words = re.findall(r"\w+", query)
+    if not words:
+        return ""
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def search_messages(connection: Connection, user_id: str, query: str, limit: int = 20) -> List[Dict[str, Any]]:
+    """Сообщения пользователя, содержащие слова запроса, от наиболее релевантных (bm25)"""
+    match_query = build_match_query(query)
+    if not match_query:
+        return []
+    rows = connection.execute(
+        SEARCH_QUERY,
+        {
+            "query": match_query,
+            "user_id": user_id,
+            "limit": limit,
+            "mark_open": SNIPPET_MARK_OPEN,
+            "mark_close": SNIPPET_MARK_CLOSE,
+            "snippet_tokens": SNIPPET_TOKENS,
+        },
+    ).mappings().all()
+    return [
+        {
+            "message_id": row["id"],
+            "session_id": row["session_id"],
+            "role": row["role"],
+            "timestamp": row["timestamp"],
+            "snippet": row["snippet"],
+            # bm25 тем меньше, чем релевантнее; в ответе знак обратный, больше - лучше
+            "rank": -row["rank"],
+        }
+        for row in rows
+    ]
+
+
+if __name__ == "__main__":
+    from app.database.db import engine
+
+    parser = argparse.ArgumentParser(description="Полнотекстовый индекс сообщений чата")
+    parser.add_argument("--rebuild", action="store_true", help="Пересобрать индекс по всем сообщениям")
+    args = parser.parse_args()
+
+    if not is_fts_available(engine):
+        print("Полнотекстовый индекс поддерживается только для SQLite")
+    elif args.rebuild:
+        setup_message_fts(engine)
+        with engine.begin() as connection:
+            rebuild_message_fts(connection)
+            count = connection.execute(text("SELECT COUNT(*) FROM chatmessage")).scalar()
+        print(f"Индекс пересобран, сообщений: {count}")
+    else:
+        parser.print_help()
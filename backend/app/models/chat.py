@@ -1,6 +1,7 @@
 from datetime import datetime
 from typing import Optional, List, Dict, Any
 from sqlmodel import Field, SQLModel, Relationship, JSON
+from sqlalchemy import Index
 import uuid
 
 class ChatSessionBase(SQLModel):
@@ -13,9 +14,11 @@ class ChatSessionBase(SQLModel):
 class ChatMessage(SQLModel, table=True):
     """Модель сообщения чата"""
     id: str = Field(default_factory=lambda: str(uuid.uuid4()), primary_key=True)
-    session_id: str = Field(foreign_key="chatsession.id")
+    session_id: str = Field(foreign_key="chatsession.id", ondelete="CASCADE")
     role: str  # 'user' или 'assistant'
     content: str
+    # Порядковый номер сообщения в сессии, начиная с 0
+    position: int = Field(default=0)
     timestamp: datetime = Field(default_factory=datetime.utcnow)
     error: Optional[bool] = Field(default=False)
     attachments: Optional[List[Dict[str, Any]]] = Field(default=None, sa_type=JSON)
@@ -26,10 +29,15 @@ class ChatSession(ChatSessionBase, table=True):
     """Модель сессии чата в базе данных"""
     id: str = Field(default_factory=lambda: str(uuid.uuid4()), primary_key=True)
     user_id: str = Field(foreign_key="user.id")
+    # Версия списка сообщений: растет при каждом изменении, нужна для синхронизации без потери правок
+    version: int = Field(default=0)
     
     # Связи с другими моделями
     user: "User" = Relationship(back_populates="chat_sessions")
-    messages: List[ChatMessage] = Relationship(back_populates="session")
+    messages: List[ChatMessage] = Relationship(
+        back_populates="session",
+        sa_relationship_kwargs={"order_by": "ChatMessage.position"}
+    )
     
     def to_dict(self) -> Dict[str, Any]:
         """Преобразование сессии в словарь для отправки на фронтенд"""
@@ -39,6 +47,7 @@ class ChatSession(ChatSessionBase, table=True):
             "model": self.model,
             "created_at": self.created_at.isoformat(),
             "updated_at": self.updated_at.isoformat(),
+            "version": self.version,
             "messages": [
                 {
                     "id": msg.id,
@@ -51,3 +60,9 @@ class ChatSession(ChatSessionBase, table=True):
                 for msg in self.messages
             ]
         }
+
+# Составные индексы под основные запросы: сообщения сессии по порядку
+# и сессии пользователя от последних измененных. Они же покрывают поиск
+# по session_id и user_id (первая колонка индекса). Номер сообщения в сессии уникален
+Index("ix_chatmessage_session_id_position", ChatMessage.session_id, ChatMessage.position, unique=True)
+Index("ix_chatsession_user_id_updated_at", ChatSession.user_id, ChatSession.updated_at.desc())
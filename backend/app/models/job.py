@@ -0,0 +1,49 @@
+from datetime import datetime
+from typing import Optional, List, Dict, Any
+from sqlmodel import Field, SQLModel, JSON
+import uuid
+
+# Состояния задания генерации
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+JOB_FINISHED_STATUSES = (JOB_COMPLETED, JOB_FAILED, JOB_CANCELLED)
+
+class GenerationJob(SQLModel, table=True):
+    """Фоновое задание генерации с сохраняемым частичным ответом"""
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()), primary_key=True)
+    user_id: str = Field(foreign_key="user.id", index=True)
+    model: str
+    messages: List[Dict[str, Any]] = Field(default_factory=list, sa_type=JSON)
+    options: Optional[Dict[str, Any]] = Field(default=None, sa_type=JSON)
+    session_id: Optional[str] = None
+    status: str = Field(default=JOB_QUEUED, index=True)
+    # Сгенерированный текст; во время генерации обновляется периодически
+    content: str = ""
+    error: Optional[str] = None
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Преобразование задания в словарь для ответа API"""
+        return {
+            "id": self.id,
+            "model": self.model,
+            "session_id": self.session_id,
+            "status": self.status,
+            "content": self.content,
+            "error": self.error,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "updated_at": self.updated_at.isoformat(),
+        }
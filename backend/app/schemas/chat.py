@@ -18,6 +18,7 @@ class MessageResponse(MessageBase):
     """Схема ответа с сообщением"""
     id: str
     session_id: str
+    position: int = 0
 
     class Config:
         from_attributes = True
@@ -35,6 +36,29 @@ class MessagesUpdate(BaseModel):
     """Схема для массового обновления сообщений"""
     messages: List[MessageCreate]
 
+class MessageEdit(BaseModel):
+    """Изменение существующего сообщения по его номеру в сессии"""
+    index: int
+    content: Optional[str] = None
+    error: Optional[bool] = None
+    attachments: Optional[List[Dict[str, Any]]] = None
+
+class MessagesDelta(BaseModel):
+    """
+    Изменения списка сообщений относительно версии base_version:
+    сначала удаляются сообщения с номера truncate_from, затем применяются
+    правки edits и в конец добавляются сообщения append.
+    """
+    base_version: Optional[int] = None
+    truncate_from: Optional[int] = None
+    edits: List[MessageEdit] = []
+    append: List[MessageCreate] = []
+
+class MessagesDeltaResponse(BaseModel):
+    """Результат применения изменений сообщений"""
+    version: int
+    message_count: int
+
 class ChatSessionUpdate(BaseModel):
     """Схема для обновления сессии чата"""
     title: Optional[str] = None
@@ -46,6 +70,7 @@ class ChatSessionResponse(ChatSessionBase):
     user_id: str
     created_at: datetime
     updated_at: datetime
+    version: int = 0
     messages: List[MessageResponse] = []
 
     class Config:
@@ -1,13 +1,14 @@
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Any
-from sqlmodel import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from pydantic import BaseModel
+import asyncio
 
-from app.database.db import get_db
+from app.database.db import get_async_db
 from app.models.user import User
 from app.services.user_service import UserService
 from app.core.config import settings
@@ -43,15 +44,16 @@ def get_password_hash(password: str) -> str:
     """Хеширование пароля"""
     return pwd_context.hash(password)
 
-def authenticate_user(db: Session, username: str, password: str) -> Optional[User]:
+async def authenticate_user(db: AsyncSession, username: str, password: str) -> Optional[User]:
     """Аутентификация пользователя"""
     user_service = UserService(db)
-    user = user_service.get_user_by_username(username)
+    user = await user_service.get_user_by_username(username)
     
     if not user:
         return None
         
-    if not verify_password(password, user.hashed_password):
+    # Проверка bcrypt - сотни миллисекунд процессора, поэтому в отдельном потоке
+    if not await asyncio.to_thread(verify_password, password, user.hashed_password):
         return None
         
     return user
@@ -69,7 +71,7 @@ def create_access_token(data: Dict[str, Any], expires_delta: Optional[timedelta]
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> User:
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)) -> User:
     """Получение текущего пользователя из токена"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -90,7 +92,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
         raise credentials_exception
         
     user_service = UserService(db)
-    user = user_service.get_user_by_id(token_data.user_id)
+    user = await user_service.get_user_by_id(token_data.user_id)
     
     if user is None:
         raise credentials_exception
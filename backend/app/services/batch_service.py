@@ -0,0 +1,92 @@
+"""Пакетное выполнение запросов чата с ограничением параллельности по моделям"""
+from typing import Any, AsyncIterator, Dict, List, Optional
+import asyncio
+import logging
+import time
+
+from fastapi import HTTPException
+
+from app.services.ollama_service import stream_chat
+
+logger = logging.getLogger(__name__)
+
+
+async def run_batch_item(
+    index: int,
+    item: Dict[str, Any],
+    user_id: Optional[str],
+    use_cache: bool
+) -> Dict[str, Any]:
+    """Выполняет один запрос пакета и возвращает результат с замерами"""
+    model = item["model"]
+    start_time = time.monotonic()
+    first_token_at: Optional[float] = None
+    parts: List[str] = []
+    final_chunk: Dict[str, Any] = {}
+
+    try:
+        async for chunk in stream_chat(
+            model,
+            item["messages"],
+            user_id,
+            item.get("options"),
+            use_cache,
+            item.get("session_id")
+        ):
+            if chunk.get("queued"):
+                continue
+            if chunk["content"]:
+                if first_token_at is None:
+                    first_token_at = time.monotonic()
+                parts.append(chunk["content"])
+            if chunk["done"]:
+                final_chunk = chunk
+
+        result: Dict[str, Any] = {
+            "index": index,
+            "model": model,
+            "content": "".join(parts),
+            "prompt_tokens": final_chunk.get("prompt_eval_count"),
+            "completion_tokens": final_chunk.get("eval_count"),
+            "cached": bool(final_chunk.get("cached")),
+        }
+    except HTTPException as error:
+        result = {"index": index, "model": model, "error": error.detail, "status_code": error.status_code}
+    except Exception as error:
+        logger.error(f"Ошибка в элементе пакета {index}: {error}")
+        result = {"index": index, "model": model, "error": str(error), "status_code": 500}
+
+    result["duration_ms"] = round((time.monotonic() - start_time) * 1000, 1)
+    result["ttft_ms"] = round((first_token_at - start_time) * 1000, 1) if first_token_at is not None else None
+    return result
+
+
+async def run_batch(
+    items: List[Dict[str, Any]],
+    user_id: Optional[str],
+    concurrency: int,
+    use_cache: bool = True
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Запускает все запросы пакета, держа не больше concurrency одновременных
+    генераций на каждую модель. Результаты отдаются в порядке завершения,
+    в каждом есть index исходного запроса. Если клиент перестал читать,
+    незавершенные запросы отменяются.
+    """
+    semaphores: Dict[str, asyncio.Semaphore] = {}
+    results: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+
+    async def run(index: int, item: Dict[str, Any]) -> None:
+        semaphore = semaphores.setdefault(item["model"], asyncio.Semaphore(concurrency))
+        async with semaphore:
+            result = await run_batch_item(index, item, user_id, use_cache)
+        await results.put(result)
+
+    tasks = [asyncio.create_task(run(index, item)) for index, item in enumerate(items)]
+    try:
+        for _ in range(len(tasks)):
+            yield await results.get()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,51 +1,79 @@
-from sqlmodel import Session, select
-from typing import List, Optional, Dict, Any
+from sqlmodel import select
+from sqlalchemy import delete, func, insert, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from typing import List, Optional, Dict, Any, Sequence, Tuple
 from datetime import datetime
 from app.models.chat import ChatSession, ChatMessage
-from app.schemas.chat import ChatSessionCreate, ChatSessionUpdate, MessageCreate
+from app.schemas.chat import ChatSessionCreate, ChatSessionUpdate, MessageCreate, MessagesDelta
+from app.database import fts
 from uuid import uuid4
+import re
+
+# (id сообщения, id сессии, текст) - то, что нужно индексу поиска
+MessageRow = Tuple[str, str, str]
+
+class VersionConflict(Exception):
+    """Сессию уже изменил другой клиент; version - ее текущая версия"""
+
+    def __init__(self, version: Optional[int]):
+        super().__init__(f"Session version is {version}")
+        self.version = version
 
 class ChatService:
-    def __init__(self, db: Session):
+    def __init__(self, db: AsyncSession):
         self.db = db
         
-    def get_user_sessions(self, user_id: str, skip: int = 0, limit: int = 100) -> List[ChatSession]:
-        """Получить список всех сессий чата пользователя"""
-        statement = select(ChatSession).where(ChatSession.user_id == user_id).offset(skip).limit(limit)
-        return self.db.execute(statement).scalars().all()
+    async def get_user_sessions(self, user_id: str, skip: int = 0, limit: int = 100) -> List[ChatSession]:
+        """Получить список всех сессий чата пользователя вместе с сообщениями, последние измененные первыми"""
+        statement = (
+            select(ChatSession)
+            .where(ChatSession.user_id == user_id)
+            .order_by(ChatSession.updated_at.desc())
+            .options(selectinload(ChatSession.messages))
+            .offset(skip)
+            .limit(limit)
+        )
+        return (await self.db.execute(statement)).scalars().all()
     
-    def get_session_by_id(self, session_id: str) -> Optional[ChatSession]:
-        """Получить сессию чата по ID"""
-        statement = select(ChatSession).where(ChatSession.id == session_id)
-        return self.db.execute(statement).scalar_one_or_none()
+    async def get_session_by_id(self, session_id: str, with_messages: bool = False) -> Optional[ChatSession]:
+        """
+        Получить сессию чата по ID. Сообщения загружаются только с with_messages:
+        в асинхронной сессии связь нельзя подгрузить при обращении к атрибуту.
+        """
+        statement = (
+            select(ChatSession)
+            .where(ChatSession.id == session_id)
+            # Объект мог остаться в сессии с версией до UPDATE, выполненного запросом
+            .execution_options(populate_existing=True)
+        )
+        if with_messages:
+            statement = statement.options(selectinload(ChatSession.messages))
+        return (await self.db.execute(statement)).scalar_one_or_none()
     
-    def create_session(self, user_id: str, session_data: ChatSessionCreate) -> ChatSession:
-        """Создать новую сессию чата"""
+    async def create_session(self, user_id: str, session_data: ChatSessionCreate) -> ChatSession:
+        """Создать новую сессию чата вместе с начальными сообщениями одной транзакцией"""
+        now = datetime.utcnow()
         session = ChatSession(
             id=str(uuid4()),
             title=session_data.title,
             model=session_data.model,
             user_id=user_id,
-            created_at=datetime.utcnow(),
-            updated_at=datetime.utcnow()
+            created_at=now,
+            updated_at=now,
+            version=1 if session_data.messages else 0
         )
         self.db.add(session)
-        self.db.commit()
-        self.db.refresh(session)
-        
-        # Если есть сообщения, добавляем их
         if session_data.messages:
-            for message_data in session_data.messages:
-                self.add_message(
-                    session_id=session.id,
-                    message_data=message_data
-                )
-        
-        return session
+            # Сессия должна попасть в БД раньше сообщений, ссылающихся на нее
+            await self.db.flush()
+            await self.insert_messages(session.id, session_data.messages, 0, now)
+        await self.db.commit()
+        return await self.get_session_by_id(session.id, with_messages=True)
     
-    def update_session(self, session_id: str, session_data: ChatSessionUpdate) -> Optional[ChatSession]:
+    async def update_session(self, session_id: str, session_data: ChatSessionUpdate) -> Optional[ChatSession]:
         """Обновить сессию чата"""
-        session = self.get_session_by_id(session_id)
+        session = await self.get_session_by_id(session_id)
         if not session:
             return None
             
@@ -57,59 +85,210 @@ class ChatService:
             
         session.updated_at = datetime.utcnow()
         self.db.add(session)
-        self.db.commit()
-        self.db.refresh(session)
-        return session
+        await self.db.commit()
+        return await self.get_session_by_id(session_id, with_messages=True)
     
-    def delete_session(self, session_id: str) -> bool:
-        """Удалить сессию чата"""
-        session = self.get_session_by_id(session_id)
-        if not session:
-            return False
-            
-        # Сначала удаляем все связанные сообщения
-        statement = select(ChatMessage).where(ChatMessage.session_id == session_id)
-        messages = self.db.execute(statement).scalars().all()
-        for message in messages:
-            self.db.delete(message)
-            
-        self.db.delete(session)
-        self.db.commit()
-        return True
+    async def delete_session(self, session_id: str) -> bool:
+        """Удалить сессию чата вместе с сообщениями"""
+        # Сообщения удаляются явно: в базах, созданных до ON DELETE CASCADE,
+        # внешний ключ без каскада
+        await self.db.execute(delete(ChatMessage).where(ChatMessage.session_id == session_id))
+        deleted = await self.db.execute(delete(ChatSession).where(ChatSession.id == session_id))
+        await self.db.commit()
+        return deleted.rowcount > 0
     
-    def get_session_messages(self, session_id: str) -> List[ChatMessage]:
+    async def get_session_messages(self, session_id: str) -> List[ChatMessage]:
         """Получить все сообщения в сессии чата"""
-        statement = select(ChatMessage).where(ChatMessage.session_id == session_id)
-        return self.db.execute(statement).scalars().all()
+        statement = (
+            select(ChatMessage)
+            .where(ChatMessage.session_id == session_id)
+            .order_by(ChatMessage.position)
+        )
+        return (await self.db.execute(statement)).scalars().all()
+    
+    async def count_session_messages(self, session_id: str) -> int:
+        """Число сообщений в сессии (следующий свободный номер)"""
+        statement = select(func.count()).select_from(ChatMessage).where(ChatMessage.session_id == session_id)
+        return (await self.db.execute(statement)).scalar_one()
     
-    def delete_session_messages(self, session_id: str) -> bool:
+    async def delete_session_messages(self, session_id: str) -> bool:
         """Удалить все сообщения в сессии чата"""
-        statement = select(ChatMessage).where(ChatMessage.session_id == session_id)
-        messages = self.db.execute(statement).scalars().all()
-        for message in messages:
-            self.db.delete(message)
-        self.db.commit()
+        await self.db.execute(delete(ChatMessage).where(ChatMessage.session_id == session_id))
+        await self.touch_session(session_id)
+        await self.db.commit()
         return True
+    
+    async def insert_messages(
+        self,
+        session_id: str,
+        messages: Sequence[MessageCreate],
+        start_position: int,
+        now: Optional[datetime] = None
+    ) -> List[MessageRow]:
+        """
+        Вставляет сообщения одним многострочным INSERT с номерами start_position, start_position + 1, ...
+        Не фиксирует транзакцию: commit делает вызывающий метод вместе с остальными изменениями.
+        """
+        if not messages:
+            return []
+        now = now or datetime.utcnow()
+        rows = [
+            {
+                "id": str(uuid4()),
+                "session_id": session_id,
+                "role": message_data.role,
+                "content": message_data.content,
+                "position": start_position + offset,
+                "timestamp": message_data.timestamp or now,
+                "error": message_data.error or False,
+                "attachments": message_data.attachments,
+            }
+            for offset, message_data in enumerate(messages)
+        ]
+        await self.db.execute(insert(ChatMessage), rows)
+        return [(row["id"], session_id, row["content"]) for row in rows]
+    
+    async def touch_session(self, session_id: str, now: Optional[datetime] = None) -> None:
+        """Одно обновление даты и версии сессии на всю пачку изменений сообщений"""
+        await self.db.execute(
+            update(ChatSession)
+            .where(ChatSession.id == session_id)
+            .values(version=ChatSession.version + 1, updated_at=now or datetime.utcnow())
+        )
+    
+    async def replace_session_messages(self, session_id: str, messages: Sequence[MessageCreate]) -> List[MessageRow]:
+        """Заменяет все сообщения сессии одной транзакцией: DELETE по session_id и многострочный INSERT"""
+        now = datetime.utcnow()
+        await self.db.execute(delete(ChatMessage).where(ChatMessage.session_id == session_id))
+        rows = await self.insert_messages(session_id, messages, 0, now)
+        await self.touch_session(session_id, now)
+        await self.db.commit()
+        return rows
         
-    def add_message(self, session_id: str, message_data: MessageCreate) -> ChatMessage:
-        """Добавить сообщение в сессию чата"""
+    async def add_message(self, session_id: str, message_data: MessageCreate) -> ChatMessage:
+        """
+        Добавить сообщение в сессию чата.
+        Версия сессии увеличивается до выбора номера: UPDATE блокирует строку сессии
+        до commit, поэтому одновременные записи в сессию получают разные номера.
+        """
+        now = datetime.utcnow()
+        await self.touch_session(session_id, now)
+        position = (await self.db.execute(
+            select(func.coalesce(func.max(ChatMessage.position) + 1, 0)).where(ChatMessage.session_id == session_id)
+        )).scalar_one()
         message = ChatMessage(
             id=str(uuid4()),
             session_id=session_id,
             role=message_data.role,
             content=message_data.content,
-            timestamp=message_data.timestamp or datetime.utcnow(),
+            position=position,
+            timestamp=message_data.timestamp or now,
             error=message_data.error or False,
             attachments=message_data.attachments
         )
         self.db.add(message)
+        await self.db.commit()
+        return message
+    
+    async def apply_messages_delta(self, session_id: str, delta: MessagesDelta, base_version: int) -> Dict[str, Any]:
+        """
+        Применяет изменения сообщений одной транзакцией: стоимость записи
+        пропорциональна числу изменений, а не длине сессии.
+        Версия сессии сравнивается и увеличивается одним UPDATE: если сессию
+        уже изменил другой клиент, ничего не записывается и поднимается VersionConflict.
+        Неверные номера сообщений - ValueError.
+        """
+        now = datetime.utcnow()
+        bumped = await self.db.execute(
+            update(ChatSession)
+            .where(ChatSession.id == session_id, ChatSession.version == base_version)
+            .values(version=ChatSession.version + 1, updated_at=now)
+        )
+        if bumped.rowcount == 0:
+            await self.db.rollback()
+            session = await self.get_session_by_id(session_id)
+            raise VersionConflict(session.version if session else None)
         
-        # Обновляем дату обновления сессии
-        session = self.get_session_by_id(session_id)
-        if session:
-            session.updated_at = datetime.utcnow()
-            self.db.add(session)
+        try:
+            count = await self.count_session_messages(session_id)
+            removed_ids: List[str] = []
+            if delta.truncate_from is not None and delta.truncate_from < 0:
+                raise ValueError("truncate_from не может быть отрицательным")
+            if delta.truncate_from is not None and delta.truncate_from < count:
+                removed_ids = list((await self.db.execute(
+                    select(ChatMessage.id)
+                    .where(ChatMessage.session_id == session_id, ChatMessage.position >= delta.truncate_from)
+                )).scalars().all())
+                await self.db.execute(
+                    delete(ChatMessage)
+                    .where(ChatMessage.session_id == session_id, ChatMessage.position >= delta.truncate_from)
+                )
+                count = delta.truncate_from
             
-        self.db.commit()
-        self.db.refresh(message)
-        return message
+            changed: List[ChatMessage] = []
+            for edit in delta.edits:
+                if not 0 <= edit.index < count:
+                    raise ValueError(f"Нет сообщения с номером {edit.index}")
+                # Только переданные поля: null в attachments очищает вложения
+                values = edit.model_dump(exclude={"index"}, exclude_unset=True)
+                if not values:
+                    continue
+                if values.get("content", "") is None:
+                    raise ValueError(f"Текст сообщения {edit.index} не может быть пустым")
+                message = (await self.db.execute(
+                    select(ChatMessage)
+                    .where(ChatMessage.session_id == session_id, ChatMessage.position == edit.index)
+                )).scalar_one()
+                for field, value in values.items():
+                    setattr(message, field, value)
+                changed.append(message)
+            
+            # (id, id сессии, текст) измененных и новых сообщений - для индекса поиска
+            changed_messages = [(message.id, message.session_id, message.content) for message in changed]
+            changed_messages += await self.insert_messages(session_id, delta.append, count, now)
+            count += len(delta.append)
+            
+            await self.db.commit()
+        except ValueError:
+            await self.db.rollback()
+            raise
+        
+        return {
+            "version": base_version + 1,
+            "message_count": count,
+            "removed_ids": removed_ids,
+            "changed": changed_messages,
+        }
+    
+    async def search_messages(self, user_id: str, query: str, limit: int = 20) -> List[Dict[str, Any]]:
+        """Полнотекстовый поиск по сообщениям всех сессий пользователя"""
+        if fts.is_fts_available(self.db.get_bind()):
+            # Запрос FTS написан для синхронного соединения; run_sync выполняет его без блокировки цикла
+            return await self.db.run_sync(
+                lambda sync_db: fts.search_messages(sync_db.connection(), user_id, query, limit)
+            )
+        
+        # Без FTS5 (не SQLite): все слова запроса через LIKE, новые сообщения выше
+        words = re.findall(r"\w+", query)
+        if not words:
+            return []
+        statement = (
+            select(ChatMessage)
+            .join(ChatSession, ChatSession.id == ChatMessage.session_id)
+            .where(ChatSession.user_id == user_id)
+            .order_by(ChatMessage.timestamp.desc())
+            .limit(limit)
+        )
+        for word in words:
+            statement = statement.where(ChatMessage.content.ilike(f"%{word}%"))
+        return [
+            {
+                "message_id": message.id,
+                "session_id": message.session_id,
+                "role": message.role,
+                "timestamp": message.timestamp.isoformat(),
+                "snippet": message.content[:200],
+                "rank": None,
+            }
+            for message in (await self.db.execute(statement)).scalars().all()
+        ]
@@ -0,0 +1,145 @@
+"""Хранилище эмбеддингов: векторы float32 в BLOB-колонке SQLite по (модель, sha256 текста)"""
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from array import array
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# SQLite ограничивает число параметров запроса; ключи читаются порциями
+LOOKUP_CHUNK_SIZE = 500
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def pack_vector(vector: Iterable[float]) -> bytes:
+    """Вектор в компактный float32 (4 байта на компоненту)"""
+    return array("f", vector).tobytes()
+
+
+def unpack_vector(blob: bytes) -> array:
+    vector = array("f")
+    vector.frombytes(blob)
+    return vector
+
+
+class EmbeddingStore:
+    """
+    Постоянный кэш эмбеддингов. Ключ - модель и sha256 текста, поэтому один и тот же
+    текст не отправляется в Ollama повторно. Записи с другим digest модели
+    (после ollama pull) считаются промахом и перезаписываются.
+    Пустой db_path - база в памяти, без сохранения между запусками.
+    """
+
+    def __init__(self, db_path: str = ""):
+        self.db_path = db_path
+        self._db: Optional[sqlite3.Connection] = None
+        # Одно соединение используется из потоков asyncio.to_thread
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path or ":memory:", check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, text_hash TEXT NOT NULL, digest TEXT, "
+                "dimensions INTEGER NOT NULL, vector BLOB NOT NULL, created_at REAL NOT NULL, "
+                "PRIMARY KEY (model, text_hash)) WITHOUT ROWID"
+            )
+            self._db.commit()
+        return self._db
+
+    def _get_many(self, model: str, digest: Optional[str], hashes: List[str]) -> Dict[str, array]:
+        found: Dict[str, array] = {}
+        with self._lock:
+            db = self._connect()
+            for start in range(0, len(hashes), LOOKUP_CHUNK_SIZE):
+                chunk = hashes[start:start + LOOKUP_CHUNK_SIZE]
+                placeholders = ",".join("?" * len(chunk))
+                rows = db.execute(
+                    f"SELECT text_hash, digest, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    (model, *chunk),
+                ).fetchall()
+                for hash_value, stored_digest, blob in rows:
+                    if digest is None or stored_digest == digest:
+                        found[hash_value] = unpack_vector(blob)
+        return found
+
+    def _put_many(self, model: str, digest: Optional[str], items: List[Tuple[str, array]]) -> None:
+        now = time.time()
+        rows = [(model, hash_value, digest, len(vector), pack_vector(vector), now) for hash_value, vector in items]
+        with self._lock:
+            db = self._connect()
+            db.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, digest, dimensions, vector, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            db.commit()
+
+    # Публичный интерфейс
+
+    async def get_many(self, model: str, digest: Optional[str], hashes: List[str]) -> Dict[str, array]:
+        """Сохраненные векторы для набора хешей; отсутствующих в результате нет"""
+        try:
+            found = await asyncio.to_thread(self._get_many, model, digest, hashes)
+        except sqlite3.Error as error:
+            logger.error(f"Ошибка чтения кэша эмбеддингов: {error}")
+            found = {}
+        self.hits += len(found)
+        self.misses += len(hashes) - len(found)
+        return found
+
+    async def put_many(self, model: str, digest: Optional[str], items: List[Tuple[str, array]]) -> None:
+        """Сохраняет векторы одной транзакцией"""
+        try:
+            await asyncio.to_thread(self._put_many, model, digest, items)
+        except sqlite3.Error as error:
+            logger.error(f"Ошибка записи кэша эмбеддингов: {error}")
+            return
+        self.stores += len(items)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _table_stats(self) -> Tuple[int, int]:
+        with self._lock:
+            return self._connect().execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+            ).fetchone()
+
+    async def stats(self) -> Dict[str, Any]:
+        """Счетчики и размер кэша; подсчет по таблице идет в потоке, не в цикле событий"""
+        lookups = self.hits + self.misses
+        result: Dict[str, Any] = {
+            "persistent": bool(self.db_path),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+            "stores": self.stores,
+        }
+        try:
+            entries, vector_bytes = await asyncio.to_thread(self._table_stats)
+            result["entries"] = entries
+            result["vector_bytes"] = vector_bytes
+        except sqlite3.Error as error:
+            logger.error(f"Ошибка чтения статистики эмбеддингов: {error}")
+        return result
+
+
+embedding_store = EmbeddingStore(db_path=settings.OLLAMA_EMBEDDING_CACHE_DB_PATH)
@@ -0,0 +1,123 @@
+"""Хранилище контекста генерации Ollama (/api/generate) по сессиям чата"""
+from typing import Any, Dict, List, Optional, Tuple
+from array import array
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+ContextKey = Tuple[str, str, str]
+
+
+def conversation_fingerprint(messages: List[Dict[str, str]]) -> str:
+    """Хеш переписки: учитываются только роль и текст сообщений"""
+    payload = json.dumps(
+        [[msg.get("role", "").lower(), msg.get("content", "")] for msg in messages],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class GenerationContextStore:
+    """
+    Хранит массив context, который Ollama возвращает из /api/generate,
+    для пары (сессия, модель). Вместе с контекстом запоминается хеш переписки,
+    которую он покрывает, и digest модели: если клиент прислал другую историю
+    или модель обновилась, контекст считается устаревшим.
+    Объем ограничен суммарным числом токенов, вытесняются давно не использованные.
+    """
+
+    def __init__(self, max_tokens: int = 4_000_000):
+        self.max_tokens = max_tokens
+        self._entries: "OrderedDict[ContextKey, Dict[str, Any]]" = OrderedDict()
+        self._tokens = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(user_id: Optional[str], session_id: str, model: str) -> ContextKey:
+        return (user_id or "anonymous", session_id, model)
+
+    def get(
+        self,
+        user_id: Optional[str],
+        session_id: str,
+        model: str,
+        digest: Optional[str],
+        history: List[Dict[str, str]]
+    ) -> Optional[List[int]]:
+        """Контекст, покрывающий ровно history, или None"""
+        key = self._key(user_id, session_id, model)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        if entry["digest"] != digest or entry["fingerprint"] != conversation_fingerprint(history):
+            self.stale += 1
+            self._drop(key)
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry["context"].tolist()
+
+    def put(
+        self,
+        user_id: Optional[str],
+        session_id: str,
+        model: str,
+        digest: Optional[str],
+        conversation: List[Dict[str, str]],
+        context: List[int]
+    ) -> None:
+        """Запоминает контекст после ответа модели на conversation"""
+        key = self._key(user_id, session_id, model)
+        if key in self._entries:
+            self._drop(key)
+        if not context or len(context) > self.max_tokens:
+            return
+
+        self._entries[key] = {
+            "context": array("I", context),
+            "digest": digest,
+            "fingerprint": conversation_fingerprint(conversation),
+        }
+        self._tokens += len(context)
+
+        while self._tokens > self.max_tokens:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def forget(self, user_id: Optional[str], session_id: str, model: Optional[str] = None) -> None:
+        """Удаляет контекст сессии (для одной модели или для всех)"""
+        owner = user_id or "anonymous"
+        for key in [key for key in self._entries if key[0] == owner and key[1] == session_id]:
+            if model is None or key[2] == model:
+                self._drop(key)
+
+    def _drop(self, key: ContextKey) -> None:
+        entry = self._entries.pop(key)
+        self._tokens -= len(entry["context"])
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "tokens": self._tokens,
+            "max_tokens": self.max_tokens,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "evictions": self.evictions,
+        }
+
+
+generation_contexts = GenerationContextStore(max_tokens=settings.OLLAMA_CONTEXT_CACHE_MAX_TOKENS)
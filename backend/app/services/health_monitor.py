@@ -0,0 +1,181 @@
+"""Фоновый мониторинг доступности Ollama"""
+from typing import Any, Deque, Dict, List, Optional, Set
+from collections import deque
+from datetime import datetime
+import asyncio
+import logging
+import time
+
+import httpx
+
+from app.core.config import settings
+from app.services.ollama_client import OllamaClient, get_backend_pool
+from app.services.model_registry import model_registry
+
+logger = logging.getLogger(__name__)
+
+
+class OllamaHealthMonitor:
+    """
+    Периодически проверяет все экземпляры Ollama (/api/version, /api/ps)
+    одной фоновой задачей и хранит историю проверок. Статус отдается из памяти, поэтому
+    число клиентов не влияет на число запросов к Ollama.
+    """
+
+    def __init__(self, interval: float = 10.0, history_size: int = 360):
+        self.interval = interval
+        self.history: Deque[Dict[str, Any]] = deque(maxlen=history_size)
+        self._last: Optional[Dict[str, Any]] = None
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._subscribers: Set[asyncio.Queue] = set()
+
+    async def _probe_backend(self, backend: OllamaClient) -> Dict[str, Any]:
+        """Проверяет один экземпляр и обновляет список загруженных в него моделей"""
+        started = time.perf_counter()
+        result: Dict[str, Any] = {"base_url": backend.base_url}
+        connect_error = False
+        try:
+            response = await backend.get("/api/version")
+            result["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            result["up"] = response.status_code == 200
+            if result["up"]:
+                result["version"] = response.json().get("version", "unknown")
+                # Модели в памяти нужны балансировщику для выбора экземпляра
+                ps_response = await backend.get("/api/ps")
+                if ps_response.status_code == 200:
+                    backend.loaded_models = {model["name"] for model in ps_response.json().get("models") or []}
+            else:
+                result["error"] = f"Status {response.status_code}"
+        except (httpx.HTTPError, ValueError) as error:
+            result.setdefault("latency_ms", None)
+            result["up"] = False
+            result["error"] = str(error) or error.__class__.__name__
+            connect_error = isinstance(error, httpx.ConnectError)
+
+        # Исключенный экземпляр возвращается в пул по успешной проверке;
+        # ошибки соединения клиент уже учел сам
+        if result["up"]:
+            backend.mark_success()
+        elif not connect_error:
+            backend.mark_failure()
+        return result
+
+    async def probe(self) -> Dict[str, Any]:
+        """Проверяет все экземпляры Ollama и сохраняет результат"""
+        backends = get_backend_pool().backends
+        checked_at = datetime.utcnow().isoformat()
+        results = await asyncio.gather(*(self._probe_backend(backend) for backend in backends))
+
+        up_results = [item for item in results if item["up"]]
+        result: Dict[str, Any] = {
+            "checked_at": checked_at,
+            "up": bool(up_results),
+            "latency_ms": min((item["latency_ms"] for item in up_results), default=None),
+        }
+        if up_results:
+            result["version"] = up_results[0]["version"]
+        else:
+            result["error"] = results[0].get("error")
+        if len(results) > 1:
+            result["backends"] = results
+
+        self._record(result)
+        return result
+
+    def _record(self, result: Dict[str, Any]) -> None:
+        previous = self._last
+        self._last = result
+        self.history.append(result)
+
+        if previous is not None and previous["up"] != result["up"]:
+            if result["up"]:
+                logger.info("Соединение с Ollama восстановлено")
+                # Пока Ollama была недоступна, набор моделей мог измениться
+                model_registry.invalidate()
+            else:
+                logger.error(f"Ollama недоступна: {result.get('error')}")
+
+        self._publish(self.status())
+
+    def _publish(self, status: Dict[str, Any]) -> None:
+        for queue in self._subscribers:
+            # Медленному подписчику важен только последний статус
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(status)
+
+    def status(self) -> Dict[str, Any]:
+        """Текущий статус из памяти в формате ответа /ollama/status"""
+        last = self._last
+        if last is None:
+            return {"status": "checking"}
+
+        checks = len(self.history)
+        up_checks = sum(1 for item in self.history if item["up"])
+        latencies = [item["latency_ms"] for item in self.history if item["latency_ms"] is not None]
+
+        status = {
+            "status": "connected" if last["up"] else "disconnected",
+            "checked_at": last["checked_at"],
+            "latency_ms": last["latency_ms"],
+            "uptime_ratio": round(up_checks / checks, 3),
+            "avg_latency_ms": round(sum(latencies) / len(latencies), 1) if latencies else None,
+        }
+        if "version" in last:
+            status["version"] = last["version"]
+        if "error" in last:
+            status["error"] = last["error"]
+        if "backends" in last:
+            status["backends"] = last["backends"]
+        return status
+
+    async def get_status(self) -> Dict[str, Any]:
+        """Статус из памяти; если проверок еще не было, выполняет первую"""
+        if self._last is None:
+            async with self._lock:
+                if self._last is None:
+                    await self.probe()
+        return self.status()
+
+    def get_history(self) -> List[Dict[str, Any]]:
+        return list(self.history)
+
+    def subscribe(self) -> asyncio.Queue:
+        """Подписка на изменения статуса (для SSE)"""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self._subscribers.discard(queue)
+
+    async def _heartbeat_loop(self) -> None:
+        while True:
+            try:
+                async with self._lock:
+                    await self.probe()
+            except Exception as error:
+                logger.error(f"Ошибка фоновой проверки Ollama: {error}")
+            await asyncio.sleep(self.interval)
+
+    async def start(self) -> None:
+        """Запускает фоновые проверки"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._heartbeat_loop())
+
+    async def stop(self) -> None:
+        """Останавливает фоновые проверки"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+health_monitor = OllamaHealthMonitor(
+    interval=settings.OLLAMA_HEALTH_CHECK_INTERVAL,
+    history_size=settings.OLLAMA_HEALTH_HISTORY_SIZE,
+)
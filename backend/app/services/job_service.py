@@ -0,0 +1,472 @@
+"""Фоновые задания генерации: время генерации не зависит от времени жизни HTTP-запроса"""
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple
+from datetime import datetime, timedelta
+import asyncio
+import logging
+import time
+
+from fastapi import HTTPException
+from sqlalchemy import delete, select, update
+
+from app.core.config import settings
+from app.database.db import SessionLocal
+from app.models.job import (
+    GenerationJob,
+    JOB_QUEUED,
+    JOB_RUNNING,
+    JOB_COMPLETED,
+    JOB_FAILED,
+    JOB_CANCELLED,
+    JOB_FINISHED_STATUSES,
+)
+from app.services.ollama_service import stream_chat
+
+logger = logging.getLogger(__name__)
+
+# Пауза перед повтором, если очередь модели переполнена, а Retry-After не указан (секунды)
+DEFAULT_RETRY_AFTER = 5.0
+
+
+def retry_after_seconds(error: HTTPException) -> float:
+    """Пауза из заголовка Retry-After ответа 429"""
+    try:
+        return max(1.0, float((error.headers or {}).get("Retry-After", DEFAULT_RETRY_AFTER)))
+    except ValueError:
+        return DEFAULT_RETRY_AFTER
+
+
+class LiveJob:
+    """Задание в памяти, пока оно ждет или выполняется: текст ответа и подписчики потока"""
+
+    def __init__(self, job_id: str, user_id: str):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.status = JOB_QUEUED
+        self.parts: List[str] = []
+        self.length = 0
+        self.subscribers: Set[asyncio.Queue] = set()
+        self.task: Optional[asyncio.Task] = None
+        self.cancel_requested = False
+        # Итог уже записывается в БД, отменять выполнение поздно
+        self.finishing = False
+
+    def append(self, text: str) -> None:
+        self.parts.append(text)
+        self.length += len(text)
+
+    def content(self) -> str:
+        if len(self.parts) > 1:
+            self.parts = ["".join(self.parts)]
+        return self.parts[0] if self.parts else ""
+
+    def publish(self, event: Dict[str, Any]) -> None:
+        for queue in self.subscribers:
+            queue.put_nowait(event)
+
+    def subscribe(self) -> asyncio.Queue:
+        # Очередь без ограничения: подписчик не должен терять фрагменты текста
+        queue: asyncio.Queue = asyncio.Queue()
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self.subscribers.discard(queue)
+
+
+# Синхронные операции с БД, выполняются в потоке через asyncio.to_thread
+
+def _insert_job(job: GenerationJob) -> Dict[str, Any]:
+    with SessionLocal() as db:
+        db.add(job)
+        db.commit()
+        db.refresh(job)
+        return job.to_dict()
+
+
+def _load_job(job_id: str) -> Optional[GenerationJob]:
+    with SessionLocal() as db:
+        return db.get(GenerationJob, job_id)
+
+
+def _update_job(job_id: str, **fields: Any) -> None:
+    fields["updated_at"] = datetime.utcnow()
+    with SessionLocal() as db:
+        db.execute(update(GenerationJob).where(GenerationJob.id == job_id).values(**fields))
+        db.commit()
+
+
+def _list_jobs(user_id: str, limit: int) -> List[Dict[str, Any]]:
+    with SessionLocal() as db:
+        statement = (
+            select(GenerationJob)
+            .where(GenerationJob.user_id == user_id)
+            .order_by(GenerationJob.created_at.desc())
+            .limit(limit)
+        )
+        return [job.to_dict() for job in db.execute(statement).scalars().all()]
+
+
+def _recover_jobs() -> Tuple[List[Tuple[str, str]], int]:
+    """
+    Задания, оставшиеся от прошлого запуска. Ожидавшие ставятся в очередь снова;
+    выполнявшиеся в момент падения помечаются ошибкой, их частичный ответ остается в БД.
+    """
+    now = datetime.utcnow()
+    with SessionLocal() as db:
+        interrupted = db.execute(
+            update(GenerationJob)
+            .where(GenerationJob.status == JOB_RUNNING)
+            .values(status=JOB_FAILED, error="Generation was interrupted by a server restart", finished_at=now, updated_at=now)
+        ).rowcount
+        queued = db.execute(
+            select(GenerationJob.id, GenerationJob.user_id)
+            .where(GenerationJob.status == JOB_QUEUED)
+            .order_by(GenerationJob.created_at)
+        ).all()
+        db.commit()
+    return [(job_id, user_id) for job_id, user_id in queued], interrupted
+
+
+def _purge_jobs(retention: float) -> int:
+    """Удаляет завершенные задания старше срока хранения"""
+    expired_before = datetime.utcnow() - timedelta(seconds=retention)
+    with SessionLocal() as db:
+        deleted = db.execute(
+            delete(GenerationJob)
+            .where(GenerationJob.status.in_(JOB_FINISHED_STATUSES))
+            .where(GenerationJob.finished_at < expired_before)
+        ).rowcount
+        db.commit()
+    return deleted
+
+
+class GenerationJobManager:
+    """
+    Выполняет задания генерации пулом фоновых обработчиков.
+    POST сразу возвращает id задания, а ответ пишется в БД контрольными точками
+    не реже чем раз в checkpoint_interval секунд. Клиент может опрашивать задание
+    или подключиться к его потоку, в том числе повторно после обрыва соединения.
+    Завершенные задания хранятся retention секунд.
+    """
+
+    def __init__(
+        self,
+        workers: int = 2,
+        max_queued: int = 100,
+        checkpoint_interval: float = 2.0,
+        retention: float = 86400.0,
+        cleanup_interval: float = 600.0,
+    ):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.checkpoint_interval = checkpoint_interval
+        self.retention = retention
+        self.cleanup_interval = cleanup_interval
+        self._queue: "asyncio.Queue[str]" = asyncio.Queue()
+        self._live: Dict[str, LiveJob] = {}
+        self._workers: List[asyncio.Task] = []
+        self._cleanup_task: Optional[asyncio.Task] = None
+        # Отложенные повторы заданий, которым не хватило места в очереди модели
+        self._retry_tasks: Set[asyncio.Task] = set()
+        self._stats = {
+            "submitted_total": 0,
+            "completed_total": 0,
+            "failed_total": 0,
+            "cancelled_total": 0,
+            "recovered_total": 0,
+            "interrupted_total": 0,
+            "checkpoints_total": 0,
+            "purged_total": 0,
+            "deferred_total": 0,
+        }
+
+    async def submit(
+        self,
+        user_id: str,
+        model: str,
+        messages: List[Dict[str, Any]],
+        options: Optional[Dict[str, Any]] = None,
+        session_id: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Сохраняет задание и ставит его в очередь; генерация начнется в фоне"""
+        if self._queue.qsize() >= self.max_queued:
+            raise HTTPException(
+                status_code=429,
+                detail=f"Too many generation jobs are waiting ({self._queue.qsize()}). Please retry later.",
+                headers={"Retry-After": "30"}
+            )
+
+        job = GenerationJob(
+            user_id=user_id,
+            model=model,
+            messages=messages,
+            options=options,
+            session_id=session_id
+        )
+        data = await asyncio.to_thread(_insert_job, job)
+        self._live[job.id] = LiveJob(job.id, user_id)
+        self._queue.put_nowait(job.id)
+        self._stats["submitted_total"] += 1
+        logger.info(f"Задание {job.id} для модели {model} поставлено в очередь")
+        return data
+
+    async def get(self, job_id: str, user_id: str, offset: int = 0) -> Dict[str, Any]:
+        """
+        Состояние задания. Пока задание выполняется, текст берется из памяти,
+        он свежее последней контрольной точки. offset - сколько символов ответа
+        клиент уже получил: вернется только продолжение.
+        """
+        job = await asyncio.to_thread(_load_job, job_id)
+        if job is None or job.user_id != user_id:
+            raise HTTPException(status_code=404, detail="Job not found")
+
+        data = job.to_dict()
+        live = self._live.get(job_id)
+        if live is not None:
+            data["status"] = live.status
+            data["content"] = live.content()
+
+        data["content_length"] = len(data["content"])
+        data["offset"] = offset
+        data["content"] = data["content"][offset:]
+        return data
+
+    async def list_jobs(self, user_id: str, limit: int = 50) -> List[Dict[str, Any]]:
+        jobs = await asyncio.to_thread(_list_jobs, user_id, limit)
+        for data in jobs:
+            live = self._live.get(data["id"])
+            if live is not None:
+                data["status"] = live.status
+                data["content"] = live.content()
+        return jobs
+
+    async def attach(self, job_id: str, user_id: str, offset: int = 0) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Поток задания: сначала уже сгенерированный текст (начиная с offset),
+        затем новые фрагменты по мере генерации и последним - итог с "done": true.
+        Отключение клиента не влияет на генерацию.
+        """
+        data = await self.get(job_id, user_id, offset)
+        live = self._live.get(job_id)
+
+        if live is None:
+            yield {"job_id": job_id, "status": data["status"], "content": data["content"], "done": False}
+            yield self._final_event(data)
+            return
+
+        # Подписка и снимок текста без await между ними: фрагменты не теряются и не повторяются
+        queue = live.subscribe()
+        try:
+            yield {"job_id": job_id, "status": live.status, "content": live.content()[offset:], "done": False}
+            while True:
+                event = await queue.get()
+                yield event
+                if event["done"]:
+                    return
+        finally:
+            live.unsubscribe(queue)
+
+    async def cancel(self, job_id: str, user_id: str) -> Dict[str, Any]:
+        """Останавливает задание; частичный ответ сохраняется"""
+        data = await self.get(job_id, user_id)
+        live = self._live.get(job_id)
+        if live is None or data["status"] in JOB_FINISHED_STATUSES:
+            return data
+
+        live.cancel_requested = True
+        if live.finishing:
+            pass
+        elif live.task is not None:
+            live.task.cancel()
+            await asyncio.gather(live.task, return_exceptions=True)
+        else:
+            # Задание еще в очереди: обработчик его пропустит
+            await self._finish(live, {"status": JOB_CANCELLED})
+        return await self.get(job_id, user_id)
+
+    @staticmethod
+    def _final_event(data: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "job_id": data["id"],
+            "status": data["status"],
+            "content": "",
+            "error": data.get("error"),
+            "prompt_tokens": data.get("prompt_tokens"),
+            "completion_tokens": data.get("completion_tokens"),
+            "done": True,
+        }
+
+    async def _finish(self, live: LiveJob, fields: Dict[str, Any]) -> None:
+        """Записывает итог в БД, затем оповещает подписчиков и убирает задание из памяти"""
+        live.finishing = True
+        fields["content"] = live.content()
+        fields["finished_at"] = datetime.utcnow()
+        await asyncio.to_thread(_update_job, live.job_id, **fields)
+
+        live.status = fields["status"]
+        self._stats[f"{live.status}_total"] += 1
+        live.publish(self._final_event({"id": live.job_id, **fields}))
+        self._live.pop(live.job_id, None)
+        logger.info(f"Задание {live.job_id} завершено: {live.status}, {live.length} символов")
+
+    async def _checkpoint(self, live: LiveJob) -> None:
+        await asyncio.to_thread(_update_job, live.job_id, content=live.content())
+        self._stats["checkpoints_total"] += 1
+
+    async def _requeue_later(self, live: LiveJob, delay: float) -> None:
+        await asyncio.sleep(delay)
+        if not live.cancel_requested:
+            self._queue.put_nowait(live.job_id)
+
+    async def _defer(self, live: LiveJob, error: HTTPException) -> None:
+        """Очередь модели переполнена: задание ждет Retry-After и снова встает в очередь"""
+        delay = retry_after_seconds(error)
+        live.status = JOB_QUEUED
+        await asyncio.to_thread(_update_job, live.job_id, status=JOB_QUEUED)
+        live.publish({"job_id": live.job_id, "status": JOB_QUEUED, "content": "", "done": False})
+        self._stats["deferred_total"] += 1
+        logger.info(f"Очередь модели заполнена, задание {live.job_id} повторится через {delay:.0f}s")
+
+        task = asyncio.create_task(self._requeue_later(live, delay))
+        self._retry_tasks.add(task)
+        task.add_done_callback(self._retry_tasks.discard)
+
+    async def _run(self, live: LiveJob) -> None:
+        """Выполняет одно задание"""
+        job = await asyncio.to_thread(_load_job, live.job_id)
+        if job is None:
+            self._live.pop(live.job_id, None)
+            return
+
+        live.status = JOB_RUNNING
+        await asyncio.to_thread(
+            _update_job, live.job_id, status=JOB_RUNNING, started_at=datetime.utcnow(), content="", error=None
+        )
+        live.publish({"job_id": live.job_id, "status": JOB_RUNNING, "content": "", "done": False})
+
+        final_chunk: Dict[str, Any] = {}
+        last_checkpoint = time.monotonic()
+        checkpointed_length = 0
+        try:
+            async for chunk in stream_chat(
+                job.model,
+                job.messages,
+                job.user_id,
+                job.options,
+                True,
+                job.session_id
+            ):
+                if chunk.get("queued"):
+                    continue
+                if chunk["content"]:
+                    live.append(chunk["content"])
+                    live.publish({"content": chunk["content"], "done": False})
+                if chunk["done"]:
+                    final_chunk = chunk
+                if live.length != checkpointed_length and time.monotonic() - last_checkpoint >= self.checkpoint_interval:
+                    await self._checkpoint(live)
+                    checkpointed_length = live.length
+                    last_checkpoint = time.monotonic()
+            fields = {
+                "status": JOB_COMPLETED,
+                "prompt_tokens": final_chunk.get("prompt_eval_count"),
+                "completion_tokens": final_chunk.get("eval_count"),
+            }
+        except asyncio.CancelledError:
+            if not live.cancel_requested:
+                # Остановка сервера: задание вернется в очередь при следующем запуске
+                await asyncio.to_thread(_update_job, live.job_id, status=JOB_QUEUED, content=live.content())
+                raise
+            fields = {"status": JOB_CANCELLED}
+        except HTTPException as error:
+            if error.status_code == 429 and not live.length:
+                # Отказ планировщика приходит до первого фрагмента: это не ошибка задания
+                await self._defer(live, error)
+                return
+            fields = {"status": JOB_FAILED, "error": str(error.detail)}
+        except Exception as error:
+            logger.error(f"Ошибка выполнения задания {live.job_id}: {error}")
+            fields = {"status": JOB_FAILED, "error": str(error)}
+
+        await self._finish(live, fields)
+
+    async def _worker(self) -> None:
+        while True:
+            job_id = await self._queue.get()
+            live = self._live.get(job_id)
+            if live is None or live.cancel_requested:
+                continue
+
+            live.task = asyncio.create_task(self._run(live))
+            try:
+                await live.task
+                # Отложенное задание снова ждет в очереди: отмена завершит его без обработчика
+                live.task = None
+            except asyncio.CancelledError:
+                if not live.task.done():
+                    # Отменен сам обработчик (остановка сервера)
+                    live.task.cancel()
+                    await asyncio.gather(live.task, return_exceptions=True)
+                    raise
+            except Exception as error:
+                logger.error(f"Ошибка обработчика заданий: {error}")
+
+    async def _cleanup_loop(self) -> None:
+        while True:
+            try:
+                purged = await asyncio.to_thread(_purge_jobs, self.retention)
+                if purged:
+                    self._stats["purged_total"] += purged
+                    logger.info(f"Удалено устаревших заданий генерации: {purged}")
+            except Exception as error:
+                logger.error(f"Ошибка очистки заданий генерации: {error}")
+            await asyncio.sleep(self.cleanup_interval)
+
+    async def start(self) -> None:
+        """Восстанавливает задания прошлого запуска и запускает обработчики"""
+        if self._workers:
+            return
+        try:
+            queued, interrupted = await asyncio.to_thread(_recover_jobs)
+        except Exception as error:
+            logger.error(f"Не удалось восстановить задания генерации: {error}")
+            queued, interrupted = [], 0
+        for job_id, user_id in queued:
+            self._live[job_id] = LiveJob(job_id, user_id)
+            self._queue.put_nowait(job_id)
+        self._stats["recovered_total"] += len(queued)
+        self._stats["interrupted_total"] += interrupted
+        if queued or interrupted:
+            logger.info(f"Задания генерации: {len(queued)} снова в очереди, {interrupted} прервано перезапуском")
+
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+
+    async def stop(self) -> None:
+        """Останавливает обработчики; выполняемые задания вернутся в очередь при следующем запуске"""
+        # Отложенные задания остаются в БД в очереди и восстановятся при запуске
+        tasks = self._workers + list(self._retry_tasks) + ([self._cleanup_task] if self._cleanup_task else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        self._cleanup_task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "queued": self._queue.qsize(),
+            "running": sum(1 for live in self._live.values() if live.status == JOB_RUNNING),
+            "subscribers": sum(len(live.subscribers) for live in self._live.values()),
+            "retention_seconds": self.retention,
+            **self._stats,
+        }
+
+
+generation_jobs = GenerationJobManager(
+    workers=settings.OLLAMA_JOB_WORKERS,
+    max_queued=settings.OLLAMA_JOB_QUEUE_SIZE,
+    checkpoint_interval=settings.OLLAMA_JOB_CHECKPOINT_INTERVAL,
+    retention=settings.OLLAMA_JOB_RETENTION,
+    cleanup_interval=settings.OLLAMA_JOB_CLEANUP_INTERVAL,
+)
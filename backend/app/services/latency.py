@@ -0,0 +1,164 @@
+"""Скользящая статистика задержек генерации и адаптивные таймауты по моделям"""
+from typing import Any, Deque, Dict, Optional, Tuple
+from collections import deque
+import math
+
+from app.core.config import settings
+
+
+def percentile(samples: Deque[float], fraction: float) -> float:
+    """Перцентиль по выборке (ближайший ранг)"""
+    ordered = sorted(samples)
+    index = max(0, math.ceil(fraction * len(ordered)) - 1)
+    return ordered[index]
+
+
+class ModelLatency:
+    """Последние замеры одной модели"""
+
+    def __init__(self, window: int):
+        # Время до первого токена у уже загруженной модели (секунды)
+        self.ttft: Deque[float] = deque(maxlen=window)
+        # Скорость генерации (токенов в секунду)
+        self.tokens_per_second: Deque[float] = deque(maxlen=window)
+        # Самая долгая пауза между фрагментами в каждом ответе (секунды)
+        self.max_gap: Deque[float] = deque(maxlen=window)
+        # Длина ответов в токенах
+        self.response_tokens: Deque[int] = deque(maxlen=window)
+        # Размер обработанных промптов (токенов) и скорость их обработки (токенов в секунду)
+        self.prompt_tokens: Deque[int] = deque(maxlen=window)
+        self.prompt_tokens_per_second: Deque[float] = deque(maxlen=window)
+        self.stalls_total = 0
+
+
+class LatencyTracker:
+    """
+    Вместо одного общего таймаута на весь ответ задает два:
+    ожидание первого фрагмента и простой между фрагментами.
+    Оба считаются как p99 наблюдаемых значений, умноженный на factor,
+    и ограничены снизу минимумами, а сверху - статическим таймаутом модели.
+    Ожидание первого фрагмента растет с размером промпта: его обработка
+    занимает время, пропорциональное числу токенов.
+    Пока замеров мало, используется статический таймаут.
+    """
+
+    def __init__(
+        self,
+        window: int = 200,
+        min_samples: int = 20,
+        factor: float = 3.0,
+        min_first_byte: float = 15.0,
+        min_idle: float = 5.0,
+    ):
+        self.window = window
+        self.min_samples = min_samples
+        self.factor = factor
+        self.min_first_byte = min_first_byte
+        self.min_idle = min_idle
+        self._models: Dict[str, ModelLatency] = {}
+
+    def _model(self, model: str) -> ModelLatency:
+        latency = self._models.get(model)
+        if latency is None:
+            latency = self._models[model] = ModelLatency(self.window)
+        return latency
+
+    def record(
+        self,
+        model: str,
+        ttft: Optional[float],
+        max_gap: Optional[float],
+        tokens_per_second: Optional[float],
+        response_tokens: Optional[int] = None,
+        prompt_tokens: Optional[int] = None,
+        prompt_tokens_per_second: Optional[float] = None
+    ) -> None:
+        """Замеры одного успешно завершенного ответа"""
+        latency = self._model(model)
+        if ttft is not None:
+            latency.ttft.append(ttft)
+        if max_gap is not None:
+            latency.max_gap.append(max_gap)
+        if tokens_per_second:
+            latency.tokens_per_second.append(tokens_per_second)
+        if response_tokens:
+            latency.response_tokens.append(response_tokens)
+        if prompt_tokens:
+            latency.prompt_tokens.append(prompt_tokens)
+        if prompt_tokens_per_second:
+            latency.prompt_tokens_per_second.append(prompt_tokens_per_second)
+
+    def record_stall(self, model: str) -> None:
+        self._model(model).stalls_total += 1
+
+    def typical_response_tokens(self, model: str) -> Optional[int]:
+        """Медианная длина ответа модели в токенах"""
+        latency = self._models.get(model)
+        if latency is None or not latency.response_tokens:
+            return None
+        return int(percentile(latency.response_tokens, 0.5))
+
+    def first_byte_timeout(self, latency: ModelLatency, ceiling: float, prompt_tokens: Optional[int]) -> float:
+        first_byte = max(self.min_first_byte, percentile(latency.ttft, 0.99) * self.factor)
+        if not prompt_tokens:
+            return min(ceiling, first_byte)
+        if len(latency.prompt_tokens_per_second) >= self.min_samples:
+            # Обработка промпта при самой низкой наблюдаемой скорости тоже должна укладываться в таймаут
+            prompt_time = prompt_tokens / percentile(latency.prompt_tokens_per_second, 0.01)
+            return min(ceiling, max(first_byte, prompt_time * self.factor))
+        if not latency.prompt_tokens or prompt_tokens > max(latency.prompt_tokens):
+            # Скорость неизвестна, а промпт больше всех, по которым набраны замеры
+            return ceiling
+        return min(ceiling, first_byte)
+
+    def timeouts(
+        self,
+        model: str,
+        ceiling: float,
+        loaded: bool = True,
+        prompt_tokens: Optional[int] = None
+    ) -> Tuple[float, float]:
+        """
+        Таймауты (первый фрагмент, простой между фрагментами) в секундах.
+        Для незагруженной модели ожидание первого фрагмента включает загрузку,
+        поэтому берется статический таймаут. prompt_tokens - оценка размера промпта.
+        """
+        latency = self._models.get(model)
+        first_byte = idle = ceiling
+
+        if latency is not None and loaded and len(latency.ttft) >= self.min_samples:
+            first_byte = self.first_byte_timeout(latency, ceiling, prompt_tokens)
+
+        if latency is not None and len(latency.max_gap) >= self.min_samples:
+            gap = percentile(latency.max_gap, 0.99)
+            if len(latency.tokens_per_second) >= self.min_samples:
+                # Медленнейший наблюдаемый темп генерации тоже должен укладываться в таймаут
+                gap = max(gap, 1.0 / percentile(latency.tokens_per_second, 0.01))
+            idle = min(ceiling, max(self.min_idle, gap * self.factor))
+
+        return first_byte, idle
+
+    def stats(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = {}
+        for model, latency in self._models.items():
+            result[model] = {
+                "samples": len(latency.ttft),
+                "ttft_p50": round(percentile(latency.ttft, 0.5), 3) if latency.ttft else None,
+                "ttft_p99": round(percentile(latency.ttft, 0.99), 3) if latency.ttft else None,
+                "tokens_per_second_p50": round(percentile(latency.tokens_per_second, 0.5), 2) if latency.tokens_per_second else None,
+                "prompt_tokens_per_second_p50": (
+                    round(percentile(latency.prompt_tokens_per_second, 0.5), 2) if latency.prompt_tokens_per_second else None
+                ),
+                "max_gap_p99": round(percentile(latency.max_gap, 0.99), 3) if latency.max_gap else None,
+                "stalls_total": latency.stalls_total,
+            }
+        return result
+
+
+latency_tracker = LatencyTracker(
+    window=settings.OLLAMA_LATENCY_WINDOW,
+    min_samples=settings.OLLAMA_LATENCY_MIN_SAMPLES,
+    factor=settings.OLLAMA_TIMEOUT_P99_FACTOR,
+    min_first_byte=settings.OLLAMA_MIN_FIRST_BYTE_TIMEOUT,
+    min_idle=settings.OLLAMA_MIN_IDLE_TIMEOUT,
+)
@@ -0,0 +1,285 @@
+"""Кэш каталога моделей Ollama (/api/tags) и их метаданных (/api/show) с фоновым обновлением"""
+from typing import Any, Dict, List, Optional
+import asyncio
+import logging
+import time
+
+import httpx
+
+from app.core.config import settings
+from app.services.ollama_client import OllamaClient, get_backend_pool, PROBE
+
+logger = logging.getLogger(__name__)
+
+# Множители суффиксов в поле parameter_size ("7.2B", "500M")
+PARAMETER_SUFFIXES = {"K": 10**3, "M": 10**6, "B": 10**9, "T": 10**12}
+
+
+def parse_parameter_size(value: Optional[str]) -> Optional[int]:
+    """Число параметров из строки вида '7.2B'"""
+    if not value:
+        return None
+    value = value.strip().upper()
+    multiplier = PARAMETER_SUFFIXES.get(value[-1:])
+    try:
+        if multiplier is None:
+            return int(float(value))
+        return int(float(value[:-1]) * multiplier)
+    except ValueError:
+        return None
+
+
+def build_model_metadata(tag: Dict[str, Any], show: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Метаданные модели из записи /api/tags и (если есть) ответа /api/show"""
+    details = {**(tag.get("details") or {}), **((show or {}).get("details") or {})}
+    model_info = (show or {}).get("model_info") or {}
+
+    parameter_count = model_info.get("general.parameter_count") or parse_parameter_size(details.get("parameter_size"))
+    context_length = next(
+        (value for key, value in model_info.items() if key.endswith(".context_length")),
+        None
+    )
+    return {
+        "digest": tag.get("digest"),
+        "family": details.get("family"),
+        "parameter_count": parameter_count,
+        "quantization": details.get("quantization_level"),
+        "size": tag.get("size"),
+        "context_length": context_length,
+        "complete": show is not None,
+    }
+
+
+class ModelRegistry:
+    """
+    Держит в памяти список моделей всех экземпляров Ollama.
+    Каталог обновляется по TTL и фоновой задачей, поэтому проверки
+    доступности модели на пути запроса не делают лишних обращений к Ollama.
+    """
+
+    def __init__(
+        self,
+        ttl: float = 60.0,
+        refresh_interval: float = 30.0,
+        miss_refresh_interval: float = 5.0,
+        large_model_parameters: int = 20 * 10**9,
+    ):
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        # Минимальный интервал принудительного обновления при промахе
+        self.miss_refresh_interval = miss_refresh_interval
+        # С какого числа параметров модель считается большой (долгая загрузка)
+        self.large_model_parameters = large_model_parameters
+
+        self._models: Dict[str, Dict[str, Any]] = {}
+        # Метаданные по digest: не меняются, пока модель не перекачали
+        self._metadata: Dict[str, Dict[str, Any]] = {}
+        self._loaded_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+        self.last_error: Optional[str] = None
+        self.last_status_code: Optional[int] = None
+        self.refreshes_total = 0
+        self.invalidations_total = 0
+        self.show_requests_total = 0
+
+    @property
+    def is_loaded(self) -> bool:
+        """Был ли каталог хотя бы раз успешно загружен"""
+        return self._loaded_at is not None
+
+    def age(self) -> Optional[float]:
+        """Возраст каталога в секундах (None, если каталог не загружен)"""
+        if self._loaded_at is None:
+            return None
+        return time.monotonic() - self._loaded_at
+
+    def is_stale(self) -> bool:
+        age = self.age()
+        return age is None or age > self.ttl
+
+    def invalidate(self) -> None:
+        """Помечает каталог устаревшим, следующее обращение его обновит"""
+        self._loaded_at = None
+        self.invalidations_total += 1
+
+    async def _fetch_tags(self, backend: OllamaClient) -> Optional[List[Dict[str, Any]]]:
+        """Загружает /api/tags одного экземпляра; None при ошибке"""
+        try:
+            response = await backend.get("/api/tags")
+            self.last_status_code = response.status_code
+            if response.status_code != 200:
+                self.last_error = f"Status {response.status_code}"
+                logger.error(f"Ошибка при обновлении каталога моделей {backend.base_url}: статус {response.status_code}")
+                return None
+            return response.json().get("models") or []
+        except (httpx.HTTPError, ValueError) as error:
+            self.last_error = str(error) or error.__class__.__name__
+            logger.error(f"Не удалось обновить каталог моделей {backend.base_url}: {self.last_error}")
+            return None
+
+    async def _fetch_show(self, backend: OllamaClient, model_name: str) -> Optional[Dict[str, Any]]:
+        """Загружает /api/show для модели; None при ошибке"""
+        self.show_requests_total += 1
+        try:
+            response = await backend.post("/api/show", call_class=PROBE, json={"model": model_name})
+            if response.status_code != 200:
+                logger.warning(f"Не удалось получить описание модели {model_name}: статус {response.status_code}")
+                return None
+            return response.json()
+        except (httpx.HTTPError, ValueError) as error:
+            logger.warning(f"Не удалось получить описание модели {model_name}: {error}")
+            return None
+
+    async def _refresh_metadata(self, backends: List[OllamaClient]) -> None:
+        """Запрашивает /api/show только для моделей с новым digest"""
+        pending = [
+            model for model in self._models.values()
+            if not self._metadata.get(model.get("digest"), {}).get("complete")
+        ]
+
+        async def describe(model: Dict[str, Any]) -> None:
+            backend = next((b for b in backends if b.has_model(model["name"])), backends[0])
+            show = await self._fetch_show(backend, model["name"])
+            self._metadata[model.get("digest")] = build_model_metadata(model, show)
+
+        await asyncio.gather(*(describe(model) for model in pending))
+
+        # Метаданные удаленных моделей больше не нужны
+        digests = {model.get("digest") for model in self._models.values()}
+        for digest in [digest for digest in self._metadata if digest not in digests]:
+            del self._metadata[digest]
+
+    async def refresh(self) -> bool:
+        """
+        Загружает /api/tags со всех экземпляров и заменяет каталог.
+        Возвращает True, если ответил хотя бы один экземпляр.
+        """
+        backends = get_backend_pool().backends
+        results = await asyncio.gather(*(self._fetch_tags(backend) for backend in backends))
+
+        models: Dict[str, Dict[str, Any]] = {}
+        loaded_any = False
+        for backend, backend_models in zip(backends, results):
+            if backend_models is None:
+                continue
+            loaded_any = True
+            backend.available_models = {model["name"] for model in backend_models}
+            for model in backend_models:
+                models.setdefault(model["name"], model)
+
+        if not loaded_any:
+            return False
+
+        self._models = models
+        await self._refresh_metadata(backends)
+        self._loaded_at = time.monotonic()
+        self.last_error = None
+        self.refreshes_total += 1
+        logger.debug(f"Каталог моделей обновлен: {len(self._models)} моделей")
+        return True
+
+    async def ensure_fresh(self, max_age: Optional[float] = None) -> bool:
+        """Обновляет каталог, если он старше max_age (по умолчанию TTL)"""
+        max_age = self.ttl if max_age is None else max_age
+        age = self.age()
+        if age is not None and age <= max_age:
+            return True
+        async with self._lock:
+            # Пока ждали блокировку, каталог мог обновить другой запрос
+            age = self.age()
+            if age is not None and age <= max_age:
+                return True
+            return await self.refresh()
+
+    def models(self) -> List[Dict[str, Any]]:
+        """Модели из каталога в формате ответа /api/tags"""
+        return list(self._models.values())
+
+    def get(self, model_name: str) -> Optional[Dict[str, Any]]:
+        """Запись каталога для модели; имя без тега соответствует ':latest'"""
+        model = self._models.get(model_name)
+        if model is None and ":" not in model_name:
+            model = self._models.get(f"{model_name}:latest")
+        return model
+
+    def metadata(self, model_name: str) -> Optional[Dict[str, Any]]:
+        """
+        Метаданные модели: parameter_count, quantization, size, context_length.
+        None, если модели нет в каталоге.
+        """
+        model = self.get(model_name)
+        if model is None:
+            return None
+        return self._metadata.get(model.get("digest")) or build_model_metadata(model)
+
+    def is_large(self, model_name: str) -> bool:
+        """Большая модель: много параметров, долго загружается и медленно отвечает"""
+        metadata = self.metadata(model_name)
+        if metadata is None or metadata["parameter_count"] is None:
+            return False
+        return metadata["parameter_count"] >= self.large_model_parameters
+
+    def context_length(self, model_name: str) -> Optional[int]:
+        """Собственная длина контекста модели из ее описания"""
+        metadata = self.metadata(model_name)
+        return metadata["context_length"] if metadata else None
+
+    async def is_available(self, model_name: str) -> Optional[bool]:
+        """
+        Проверяет наличие модели по каталогу в памяти.
+        Возвращает None, если каталог недоступен и ответить нельзя.
+        """
+        await self.ensure_fresh()
+        if not self.is_loaded:
+            return None
+        if self.get(model_name) is not None:
+            return True
+        # Модель могли только что скачать: перечитываем каталог, но не чаще miss_refresh_interval
+        await self.ensure_fresh(max_age=self.miss_refresh_interval)
+        return self.get(model_name) is not None
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            try:
+                await self.ensure_fresh(max_age=self.refresh_interval)
+            except Exception as error:
+                logger.error(f"Ошибка фонового обновления каталога моделей: {error}")
+            await asyncio.sleep(self.refresh_interval)
+
+    async def start(self) -> None:
+        """Запускает фоновое обновление каталога"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self) -> None:
+        """Останавливает фоновое обновление каталога"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        age = self.age()
+        return {
+            "loaded": self.is_loaded,
+            "models": len(self._models),
+            "age_seconds": round(age, 3) if age is not None else None,
+            "ttl_seconds": self.ttl,
+            "refreshes_total": self.refreshes_total,
+            "invalidations_total": self.invalidations_total,
+            "described_models": sum(1 for metadata in self._metadata.values() if metadata["complete"]),
+            "show_requests_total": self.show_requests_total,
+            "last_error": self.last_error,
+        }
+
+
+model_registry = ModelRegistry(
+    ttl=settings.OLLAMA_MODELS_CACHE_TTL,
+    refresh_interval=settings.OLLAMA_MODELS_REFRESH_INTERVAL,
+    large_model_parameters=settings.OLLAMA_LARGE_MODEL_PARAMETERS,
+)
@@ -0,0 +1,70 @@
+"""Инкрементальный разбор NDJSON-потока Ollama"""
+from typing import Any, Callable, Dict, List
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    # Необязательная быстрая библиотека JSON; без нее используется стандартный json
+    import orjson
+
+    def json_loads(data: bytes) -> Any:
+        return orjson.loads(data)
+
+    JSON_BACKEND = "orjson"
+except ImportError:  # pragma: no cover - зависит от окружения
+    def json_loads(data: bytes) -> Any:
+        # Явное декодирование быстрее, чем определение кодировки внутри json.loads(bytes)
+        return json.loads(data.decode("utf-8"))
+
+    JSON_BACKEND = "json"
+
+
+class NDJSONDecoder:
+    """
+    Принимает произвольные куски байтов из сети и возвращает готовые JSON-объекты.
+    Строки режутся в байтах, без промежуточного декодирования всего потока в str;
+    неполная последняя строка ждет следующего куска.
+    """
+
+    def __init__(self, loads: Callable[[bytes], Any] = json_loads):
+        self._loads = loads
+        self._buffer = b""
+        self.objects = 0
+        self.errors = 0
+
+    def _parse(self, line: bytes) -> Any:
+        try:
+            obj = self._loads(line)
+        except ValueError:
+            self.errors += 1
+            logger.warning(f"Failed to parse chunk as JSON: {line[:200]!r}")
+            return None
+        self.objects += 1
+        return obj
+
+    def feed(self, data: bytes) -> List[Dict[str, Any]]:
+        """Добавляет кусок данных и возвращает объекты всех завершенных строк"""
+        if self._buffer:
+            data = self._buffer + data
+        lines = data.split(b"\n")
+        # Последний элемент - начало еще не завершенной строки (или пустая строка)
+        self._buffer = lines.pop()
+
+        objects = []
+        for line in lines:
+            if line and not line.isspace():
+                obj = self._parse(line)
+                if obj is not None:
+                    objects.append(obj)
+        return objects
+
+    def flush(self) -> List[Dict[str, Any]]:
+        """Разбирает остаток буфера, если поток закончился без перевода строки"""
+        line = self._buffer.strip()
+        self._buffer = b""
+        if not line:
+            return []
+        obj = self._parse(line)
+        return [obj] if obj is not None else []
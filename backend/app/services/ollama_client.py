@@ -0,0 +1,305 @@
+"""Общий пул HTTP-соединений с Ollama и балансировка между экземплярами"""
+from typing import Any, Dict, List, Optional, Set, AsyncIterator
+from contextlib import asynccontextmanager
+import httpx
+import logging
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Классы запросов: короткие служебные проверки и долгая генерация
+PROBE = "probe"
+GENERATION = "generation"
+
+
+class OllamaClient:
+    """
+    Долгоживущий httpx.AsyncClient для одного экземпляра Ollama.
+    Держит пул keep-alive соединений, выдает таймауты по классу запроса
+    и ведет статистику использования пула.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        keepalive_expiry: float = 60.0,
+        pool_timeout: float = 10.0,
+        probe_connect_timeout: float = 2.0,
+        probe_read_timeout: float = 5.0,
+        generation_connect_timeout: float = 5.0,
+        generation_read_timeout: float = 180.0,
+        eject_after_failures: int = 3,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.pool_timeout = pool_timeout
+        self.probe_connect_timeout = probe_connect_timeout
+        self.probe_read_timeout = probe_read_timeout
+        self.generation_connect_timeout = generation_connect_timeout
+        self.generation_read_timeout = generation_read_timeout
+
+        self._client: Optional[httpx.AsyncClient] = None
+        self._in_flight = 0
+        self._peak_in_flight = 0
+        self._requests_total = 0
+        self._errors_total = 0
+        self._clients_created = 0
+
+        # Состояние экземпляра для балансировщика
+        self.eject_after_failures = eject_after_failures
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.ejections_total = 0
+        # Модели, скачанные на экземпляр (/api/tags); None - пока неизвестно
+        self.available_models: Optional[Set[str]] = None
+        # Модели, загруженные в память экземпляра (/api/ps)
+        self.loaded_models: Set[str] = set()
+
+    @classmethod
+    def from_settings(cls, base_url: Optional[str] = None) -> "OllamaClient":
+        """Создает клиента с параметрами из настроек приложения"""
+        return cls(
+            base_url=base_url or settings.OLLAMA_API_URL,
+            max_connections=settings.OLLAMA_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.OLLAMA_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.OLLAMA_KEEPALIVE_EXPIRY,
+            pool_timeout=settings.OLLAMA_POOL_TIMEOUT,
+            probe_connect_timeout=settings.OLLAMA_PROBE_CONNECT_TIMEOUT,
+            probe_read_timeout=settings.OLLAMA_PROBE_READ_TIMEOUT,
+            generation_connect_timeout=settings.OLLAMA_GENERATION_CONNECT_TIMEOUT,
+            generation_read_timeout=settings.OLLAMA_GENERATION_READ_TIMEOUT,
+            eject_after_failures=settings.OLLAMA_EJECT_AFTER_FAILURES,
+        )
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Возвращает httpx-клиент, создавая его при первом обращении"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                limits=self.limits,
+                timeout=self.timeout(PROBE),
+            )
+            self._clients_created += 1
+            logger.info(f"Создан пул соединений с Ollama: {self.base_url}")
+        return self._client
+
+    async def start(self) -> None:
+        """Открывает пул соединений (вызывается при старте приложения)"""
+        _ = self.client
+
+    async def close(self) -> None:
+        """Закрывает пул соединений (вызывается при остановке приложения)"""
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+            logger.info(f"Пул соединений с Ollama закрыт: {self.base_url}")
+        self._client = None
+
+    def timeout(self, call_class: str = PROBE, read: Optional[float] = None) -> httpx.Timeout:
+        """Таймауты connect/read/write/pool для класса запроса"""
+        if call_class == GENERATION:
+            connect = self.generation_connect_timeout
+            read = read if read is not None else self.generation_read_timeout
+        else:
+            connect = self.probe_connect_timeout
+            read = read if read is not None else self.probe_read_timeout
+        return httpx.Timeout(connect=connect, read=read, write=connect, pool=self.pool_timeout)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def mark_success(self) -> None:
+        """Успешный ответ: экземпляр снова принимает запросы"""
+        self.consecutive_failures = 0
+        if not self.healthy:
+            self.healthy = True
+            logger.info(f"Экземпляр Ollama возвращен в пул: {self.base_url}")
+
+    def mark_failure(self) -> None:
+        """Ошибка соединения: после нескольких подряд экземпляр исключается из пула"""
+        self.consecutive_failures += 1
+        if self.healthy and self.consecutive_failures >= self.eject_after_failures:
+            self.healthy = False
+            self.ejections_total += 1
+            logger.error(f"Экземпляр Ollama исключен из пула: {self.base_url}")
+
+    def has_model(self, model: str) -> bool:
+        """Скачана ли модель на экземпляр (неизвестный каталог считается подходящим)"""
+        if self.available_models is None:
+            return True
+        return model in self.available_models or f"{model}:latest" in self.available_models
+
+    def has_loaded(self, model: str) -> bool:
+        """Загружена ли модель в память экземпляра"""
+        return model in self.loaded_models or f"{model}:latest" in self.loaded_models
+
+    def _request_started(self) -> None:
+        self._in_flight += 1
+        self._requests_total += 1
+        self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+
+    def _request_finished(self, failed: bool) -> None:
+        self._in_flight -= 1
+        if failed:
+            self._errors_total += 1
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        call_class: str = PROBE,
+        read_timeout: Optional[float] = None,
+        **kwargs: Any,
+    ) -> httpx.Response:
+        """Выполняет запрос к Ollama через общий пул"""
+        kwargs.setdefault("timeout", self.timeout(call_class, read_timeout))
+        self._request_started()
+        failed = True
+        try:
+            response = await self.client.request(method, path, **kwargs)
+            failed = False
+            self.mark_success()
+            return response
+        except httpx.ConnectError:
+            self.mark_failure()
+            raise
+        finally:
+            self._request_finished(failed)
+
+    async def get(self, path: str, call_class: str = PROBE, **kwargs: Any) -> httpx.Response:
+        return await self.request("GET", path, call_class=call_class, **kwargs)
+
+    async def post(self, path: str, call_class: str = GENERATION, **kwargs: Any) -> httpx.Response:
+        return await self.request("POST", path, call_class=call_class, **kwargs)
+
+    @asynccontextmanager
+    async def stream(
+        self,
+        method: str,
+        path: str,
+        call_class: str = GENERATION,
+        read_timeout: Optional[float] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[httpx.Response]:
+        """Потоковый запрос: соединение занято, пока открыт контекст"""
+        kwargs.setdefault("timeout", self.timeout(call_class, read_timeout))
+        self._request_started()
+        failed = True
+        try:
+            try:
+                async with self.client.stream(method, path, **kwargs) as response:
+                    self.mark_success()
+                    yield response
+            except httpx.ConnectError:
+                self.mark_failure()
+                raise
+            failed = False
+        finally:
+            self._request_finished(failed)
+
+    def _pool_connections(self) -> Dict[str, int]:
+        """Число открытых и простаивающих соединений в пуле httpcore"""
+        # httpx не публикует состояние пула, поэтому читаем его осторожно
+        pool = getattr(getattr(self._client, "_transport", None), "_pool", None)
+        connections = getattr(pool, "connections", None)
+        if connections is None:
+            return {"open": 0, "idle": 0}
+        idle = sum(1 for connection in connections if connection.is_idle())
+        return {"open": len(connections), "idle": idle}
+
+    def stats(self) -> Dict[str, Any]:
+        """Статистика использования пула"""
+        connections = self._pool_connections()
+        return {
+            "base_url": self.base_url,
+            "active": self._client is not None and not self._client.is_closed,
+            "healthy": self.healthy,
+            "consecutive_failures": self.consecutive_failures,
+            "ejections_total": self.ejections_total,
+            "loaded_models": sorted(self.loaded_models),
+            "in_flight": self._in_flight,
+            "peak_in_flight": self._peak_in_flight,
+            "requests_total": self._requests_total,
+            "errors_total": self._errors_total,
+            "clients_created": self._clients_created,
+            "open_connections": connections["open"],
+            "idle_connections": connections["idle"],
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+        }
+
+
+class OllamaBackendPool:
+    """
+    Набор экземпляров Ollama. Каждый запрос направляется на исправный
+    экземпляр с наименьшим числом выполняющихся запросов; при генерации
+    предпочитаются экземпляры, где модель уже загружена в память.
+    """
+
+    def __init__(self, backends: List[OllamaClient]):
+        if not backends:
+            raise ValueError("Нужен хотя бы один экземпляр Ollama")
+        self.backends = backends
+        self._next = 0
+
+    @classmethod
+    def from_settings(cls) -> "OllamaBackendPool":
+        return cls([OllamaClient.from_settings(url) for url in settings.get_ollama_urls()])
+
+    def healthy_backends(self) -> List[OllamaClient]:
+        return [backend for backend in self.backends if backend.healthy]
+
+    def choose(self, model: Optional[str] = None) -> OllamaClient:
+        """Выбирает экземпляр для запроса"""
+        # Если исключены все экземпляры, пробуем все: ошибку вернет сам запрос
+        candidates = self.healthy_backends() or self.backends
+
+        if model:
+            with_model = [backend for backend in candidates if backend.has_model(model)]
+            candidates = with_model or candidates
+            loaded = [backend for backend in candidates if backend.has_loaded(model)]
+            candidates = loaded or candidates
+
+        # Наименьшее число выполняющихся запросов; при равенстве - по кругу
+        self._next = (self._next + 1) % len(self.backends)
+        return min(
+            candidates,
+            key=lambda backend: (backend.in_flight, (self.backends.index(backend) - self._next) % len(self.backends))
+        )
+
+    async def start(self) -> None:
+        for backend in self.backends:
+            await backend.start()
+
+    async def close(self) -> None:
+        for backend in self.backends:
+            await backend.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backends": [backend.stats() for backend in self.backends],
+            "healthy_backends": len(self.healthy_backends()),
+            "in_flight": sum(backend.in_flight for backend in self.backends),
+        }
+
+
+# Пул уровня приложения: открывается при старте и закрывается при остановке
+backend_pool = OllamaBackendPool.from_settings()
+
+
+def get_backend_pool() -> OllamaBackendPool:
+    """Возвращает пул экземпляров Ollama"""
+    return backend_pool
+
+
+def get_ollama_client(model: Optional[str] = None) -> OllamaClient:
+    """Возвращает клиент экземпляра Ollama, выбранного для запроса к модели"""
+    return backend_pool.choose(model)
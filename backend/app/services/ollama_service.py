@@ -1,22 +1,143 @@
 """Сервис для работы с Ollama API"""
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, AsyncIterator, Tuple
+from array import array
 import httpx
 import asyncio
 import logging
 import time
 import json
-import json
 from fastapi import HTTPException
 from app.core.config import settings
+from app.services.ollama_client import get_ollama_client, GENERATION
+from app.services.model_registry import model_registry
+from app.services.scheduler import model_scheduler, parse_model_limits
+from app.services.single_flight import single_flight, request_key
+from app.services.response_cache import response_cache
+from app.services.generation_context import generation_contexts
+from app.services.residency import residency_manager
+from app.services.latency import latency_tracker
+from app.services.ndjson import NDJSONDecoder
+from app.services.embedding_store import embedding_store, text_hash
 
 logger = logging.getLogger(__name__)
 
-# Большие модели, требующие особого подхода
-LARGE_MODELS = ['deepseek', 'llama3-70b', 'mixtral-8x7b', 'qwen', 'solar-10b']
+# Параметры генерации по умолчанию; клиент может переопределить их в запросе
+DEFAULT_OPTIONS = {
+    "num_ctx": 8192,  # Верхняя граница контекста для моделей без значения в OLLAMA_MODEL_CONTEXT_LENGTHS
+    "temperature": 0.7,
+    "top_k": 50,
+}
+
+# Длина контекста отдельных моделей из настроек, например "llama3:70b=8192,phi3=4096"
+MODEL_CONTEXT_LENGTHS = parse_model_limits(settings.OLLAMA_MODEL_CONTEXT_LENGTHS)
+
+# Служебные токены шаблона на каждое сообщение (роль, разделители)
+MESSAGE_TOKEN_OVERHEAD = 4
+# Среднее число символов на токен для грубой оценки без токенизатора
+CHARS_PER_TOKEN = 4
+# В DEBUG логируется каждый N-й фрагмент потока
+CHUNK_LOG_SAMPLE_RATE = 50
 
 def is_large_model(model_name: str) -> bool:
-    """Проверка, является ли модель "большой" и требующей особого подхода"""
-    return any(name.lower() in model_name.lower() for name in LARGE_MODELS)
+    """Проверка, является ли модель "большой" и требующей особого подхода (по числу параметров)"""
+    return model_registry.is_large(model_name)
+
+def get_generation_timeout(model_name: str) -> float:
+    """Таймаут чтения ответа генерации для модели (секунды)"""
+    if is_large_model(model_name):
+        return settings.OLLAMA_LARGE_MODEL_READ_TIMEOUT
+    return settings.OLLAMA_GENERATION_READ_TIMEOUT
+
+def get_model_context_length(model_name: Optional[str]) -> int:
+    """
+    Длина контекста модели (num_ctx), если она не задана в запросе:
+    значение из настроек, иначе собственный контекст модели, но не больше значения по умолчанию
+    """
+    if model_name:
+        length = MODEL_CONTEXT_LENGTHS.get(model_name)
+        if length is None and model_name.endswith(":latest"):
+            length = MODEL_CONTEXT_LENGTHS.get(model_name[:-len(":latest")])
+        if length is not None:
+            return length
+        native_length = model_registry.context_length(model_name)
+        if native_length:
+            return min(native_length, DEFAULT_OPTIONS["num_ctx"])
+    return DEFAULT_OPTIONS["num_ctx"]
+
+def build_options(options: Optional[Dict[str, Any]] = None, model: Optional[str] = None) -> Dict[str, Any]:
+    """Параметры генерации по умолчанию с учетом модели и переопределений из запроса"""
+    return {**DEFAULT_OPTIONS, "num_ctx": get_model_context_length(model), **(options or {})}
+
+def estimate_message_tokens(message: Dict[str, str]) -> int:
+    """Грубая оценка числа токенов в сообщении: дешевле любого кэша по его тексту"""
+    return len(message.get("content", "")) // CHARS_PER_TOKEN + 1 + MESSAGE_TOKEN_OVERHEAD
+
+# Статистика обрезки истории
+history_stats = {"requests_trimmed": 0, "messages_dropped": 0}
+
+# Генерации, остановленные из-за отключения клиента
+cancellation_stats = {"cancelled_total": 0, "tokens_generated": 0, "tokens_saved_estimate": 0}
+
+# Эмбеддинги: сколько текстов пришло, сколько взято из кэша и сколько посчитано в Ollama
+embedding_stats = {"requests": 0, "texts": 0, "duplicates": 0, "cached": 0, "embedded": 0, "upstream_batches": 0}
+
+def record_cancellation(model: str, tokens_generated: int, num_predict: Optional[int]) -> None:
+    """Учитывает остановленную генерацию и оценку несгенерированных токенов"""
+    expected = latency_tracker.typical_response_tokens(model)
+    if isinstance(num_predict, int) and num_predict > 0:
+        expected = min(expected, num_predict) if expected is not None else num_predict
+    saved = max((expected or 0) - tokens_generated, 0)
+    
+    cancellation_stats["cancelled_total"] += 1
+    cancellation_stats["tokens_generated"] += tokens_generated
+    cancellation_stats["tokens_saved_estimate"] += saved
+    logger.info(f"Генерация {model} остановлена: клиент отключился после {tokens_generated} токенов, сэкономлено ~{saved}")
+
+def get_history_budget(options: Dict[str, Any]) -> int:
+    """Сколько токенов истории помещается в контекст с учетом резерва под ответ"""
+    reserve = options.get("num_predict")
+    if not isinstance(reserve, int) or reserve <= 0:
+        reserve = settings.OLLAMA_RESPONSE_TOKEN_RESERVE
+    budget = options["num_ctx"] - reserve
+    if settings.OLLAMA_HISTORY_TOKEN_BUDGET > 0:
+        budget = min(budget, settings.OLLAMA_HISTORY_TOKEN_BUDGET)
+    return max(budget, 0)
+
+def pack_messages(
+    model: str,
+    messages: List[Dict[str, str]],
+    options: Dict[str, Any]
+) -> Tuple[List[Dict[str, str]], int]:
+    """
+    Оставляет системные сообщения и последние реплики, помещающиеся в бюджет токенов.
+    Последнее сообщение сохраняется всегда. Возвращает сообщения и число отброшенных.
+    """
+    budget = get_history_budget(options)
+    system_indexes = [i for i, msg in enumerate(messages) if msg.get("role", "").lower() == "system"]
+    used = sum(estimate_message_tokens(messages[i]) for i in system_indexes)
+    
+    kept = set(system_indexes)
+    for index in range(len(messages) - 1, -1, -1):
+        if index in kept:
+            continue
+        tokens = estimate_message_tokens(messages[index])
+        if used + tokens > budget and index != len(messages) - 1:
+            break
+        kept.add(index)
+        used += tokens
+    
+    dropped = len(messages) - len(kept)
+    if dropped:
+        history_stats["requests_trimmed"] += 1
+        history_stats["messages_dropped"] += dropped
+        logger.info(f"История для {model} обрезана: отброшено {dropped} сообщений, бюджет {budget} токенов")
+        messages = [msg for i, msg in enumerate(messages) if i in kept]
+    return messages, dropped
+
+def response_cache_key(kind: str, model: str, messages: List[Dict[str, str]], options: Dict[str, Any]) -> str:
+    """Ключ кэша ответов; digest модели меняется после ollama pull, и старые ответы перестают совпадать"""
+    model_info = model_registry.get(model) or {}
+    return response_cache.make_key(kind, model, model_info.get("digest"), messages, options)
 
 def convert_messages_to_prompt(messages: List[Dict[str, str]]) -> str:
     """Конвертирует сообщения чата в текстовый промпт для формата /api/generate"""
@@ -41,83 +162,109 @@ def convert_messages_to_prompt(messages: List[Dict[str, str]]) -> str:
     
     return prompt.strip()
 
-async def send_generate_request(model: str, prompt: str) -> str:
+def build_timeout_message(model: str, timeout_duration: float) -> str:
+    """Текст ошибки таймаута с подсказками для пользователя"""
+    error_message = f"Request to model '{model}' timed out after {timeout_duration} seconds.\n\n"
+    
+    if is_large_model(model):
+        error_message += (
+            "This is a very large model that takes significant time to load. The model might still be loading in the background. You can try:\n"
+            "1. Wait a few minutes and try again\n"
+            "2. Check Ollama logs in the terminal\n"
+            "3. Restart the Ollama service\n"
+            "4. Consider using a smaller model if immediate responses are needed"
+        )
+    else:
+        error_message += "The model might be still loading or the response is taking too long. You may need to restart Ollama."
+    
+    return error_message
+
+def raise_for_ollama_error(model: str, status_code: int, error_text: str, invalidate_catalog: bool = True) -> None:
+    """
+    Преобразует ошибочный ответ Ollama в HTTPException с понятным описанием.
+    invalidate_catalog=False - ответ об отсутствии модели не сбрасывает каталог моделей.
+    """
+    logger.error(f"Error response from Ollama API: {status_code} - {error_text}")
+    
+    # Обрабатываем специфичные ошибки с более детальными объяснениями
+    if status_code == 404 and "model" in error_text and "not found" in error_text:
+        # Каталог в памяти устарел, только если в нем эта модель есть: ее удалили или переименовали
+        if invalidate_catalog and model_registry.get(model) is not None:
+            model_registry.invalidate()
+        raise HTTPException(
+            status_code=404,
+            detail=f"Model '{model}' not found. You need to download it first using the command: ollama pull {model}"
+        )
+    
+    # Обрабатываем ошибки таймаута/загрузки с лучшим объяснением
+    if status_code in [500, 502, 504]:
+        raise HTTPException(
+            status_code=status_code,
+            detail=f"Model '{model}' is having trouble loading or responding (Error {status_code}). Large models may take several minutes to load. Try restarting Ollama or checking the Ollama logs."
+        )
+    
+    raise HTTPException(status_code=status_code, detail=f"API error: {error_text}")
+
+async def send_generate_request(model: str, prompt: str, options: Optional[Dict[str, Any]] = None) -> str:
     """Отправляет запрос через эндпоинт /api/generate"""    # Таймаут для больших моделей
-    is_model_large = is_large_model(model)
-    timeout_duration = 1000 if is_model_large else 180  # секунды
+    timeout_duration = get_generation_timeout(model)
     
     logger.info(f"Запрос к модели: {model}, таймаут: {timeout_duration}s")
     
     start_time = time.time()
+    client = get_ollama_client(model)
     
     try:
-        async with httpx.AsyncClient(timeout=timeout_duration) as client:
-            response = await client.post(
-                f"{settings.OLLAMA_API_URL}/api/generate",
-                json={
-                    "model": model,
-                    "prompt": prompt,
-                    "stream": False,
-                    "options": {
-                        "num_ctx": 8192,
-                        "temperature": 0.7,
-                        "top_k": 50,
-                    }
-                }
-            )
-            
-            if response.status_code != 200:
-                error_text = response.text
-                logger.error(f"Error response from Ollama API: {response.status_code} - {error_text}")
-                
-                # Обрабатываем специфичные ошибки
-                if response.status_code == 404 and "model" in error_text and "not found" in error_text:
-                    raise HTTPException(
-                        status_code=404,
-                        detail=f"Model '{model}' not found. You need to download it first using the command: ollama pull {model}"
-                    )
-                
-                if response.status_code in [500, 502, 504]:
-                    raise HTTPException(
-                        status_code=response.status_code,
-                        detail=f"Model '{model}' is having trouble loading or responding (Error {response.status_code}). Large models may take several minutes to load. Try restarting Ollama or checking the Ollama logs."
-                    )
-                
-                raise HTTPException(status_code=response.status_code, detail=f"API error: {error_text}")
-            
-            data = response.json()
-            logger.info(f"Response received after {time.time() - start_time:.2f}s")
-            
-            # Получаем ответ из поля "response" в соответствии с API /api/generate
-            if "response" in data:
-                return data["response"]
-            else:
-                logger.error(f"Unexpected response format from Ollama API: {data}")
-                raise HTTPException(status_code=500, detail="Unexpected response format from Ollama API")
-    
-    except httpx.TimeoutException:
-        error_message = f"Request to model '{model}' timed out after {timeout_duration} seconds.\n\n"
+        response = await client.post(
+            "/api/generate",
+            call_class=GENERATION,
+            read_timeout=timeout_duration,
+            json={
+                "model": model,
+                "prompt": prompt,
+                "stream": False,
+                "options": build_options(options, model),
+                "keep_alive": residency_manager.keep_alive_for(model)
+            }
+        )
+        
+        if response.status_code != 200:
+            raise_for_ollama_error(model, response.status_code, response.text)
         
-        if is_large_model(model):
-            error_message += (
-                "This is a very large model that takes significant time to load. The model might still be loading in the background. You can try:\n"
-                "1. Wait a few minutes and try again\n"
-                "2. Check Ollama logs in the terminal\n"
-                "3. Restart the Ollama service\n"
-                "4. Consider using a smaller model if immediate responses are needed"
-            )
+        data = response.json()
+        logger.info(f"Response received after {time.time() - start_time:.2f}s")
+        
+        # Получаем ответ из поля "response" в соответствии с API /api/generate
+        if "response" in data:
+            return data["response"]
         else:
-            error_message += "The model might be still loading or the response is taking too long. You may need to restart Ollama."
+            logger.error(f"Unexpected response format from Ollama API: {data}")
+            raise HTTPException(status_code=500, detail="Unexpected response format from Ollama API")
+    
+    except httpx.TimeoutException:
+        error_message = build_timeout_message(model, timeout_duration)
         
         logger.error(f"Timeout error: {error_message}")
         raise HTTPException(status_code=504, detail=error_message)
     
+    except HTTPException:
+        raise
     except Exception as error:
         logger.error(f"Error in send_generate_request: {error}")
         raise HTTPException(status_code=500, detail=str(error))
 
-async def send_message(model: str, messages: List[Dict[str, str]]) -> str:
-    """Отправляет сообщение через API Ollama, используя формат /api/generate"""
+async def send_message(
+    model: str,
+    messages: List[Dict[str, str]],
+    user_id: Optional[str] = None,
+    options: Optional[Dict[str, Any]] = None,
+    use_cache: bool = True
+) -> str:
+    """
+    Отправляет сообщение через API Ollama, используя формат /api/generate.
+    Детерминированные запросы (temperature 0 или seed) отдаются из кэша ответов,
+    если use_cache не отключен.
+    """
     try:
         logger.info(f"Preparing to send message to model: {model}")
         
@@ -134,11 +281,31 @@ async def send_message(model: str, messages: List[Dict[str, str]]) -> str:
         else:
             logger.info(f"Skipping strict availability check for large model: {model}")
         
+        full_options = build_options(options, model)
+        messages, _ = pack_messages(model, messages, full_options)
+        
         # Конвертируем сообщения в единый промпт
         prompt = convert_messages_to_prompt(messages)
         
-        # Отправляем запрос через /api/generate
-        return await send_generate_request(model, prompt)
+        cache_key = None
+        if response_cache.is_cacheable(full_options):
+            cache_key = response_cache_key("generate", model, messages, full_options)
+            if use_cache:
+                entry = await response_cache.get(cache_key)
+                if entry is not None:
+                    logger.info(f"Ответ модели {model} взят из кэша")
+                    return entry["content"]
+            else:
+                response_cache.record_bypass()
+        
+        # Отправляем запрос через /api/generate, дождавшись слота модели
+        residency_manager.record_use(model)
+        async with model_scheduler.slot(model, user_id):
+            response = await send_generate_request(model, prompt, options)
+        
+        if cache_key is not None:
+            await response_cache.put(cache_key, response)
+        return response
     
     except httpx.HTTPError as error:
         logger.error(f"Error communicating with local Ollama instance: {error}")
@@ -154,210 +321,471 @@ async def send_message(model: str, messages: List[Dict[str, str]]) -> str:
         
         raise HTTPException(status_code=500, detail=error_message)
 
-async def send_streaming_message(model: str, messages: List[Dict[str, str]]) -> str:
-    """Отправляет сообщение с использованием потокового режима"""    # Таймаут для больших моделей
-    is_model_large = is_large_model(model)
-    timeout_duration = 1000 if is_model_large else 180  # секунды
+async def stream_chat(
+    model: str,
+    messages: List[Dict[str, str]],
+    user_id: Optional[str] = None,
+    options: Optional[Dict[str, Any]] = None,
+    use_cache: bool = True,
+    session_id: Optional[str] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Потоковая генерация через /api/chat с учетом очереди модели.
+    Если передан session_id, используется /api/generate с контекстом Ollama,
+    сохраненным после предыдущего хода этой сессии.
+    Пока запрос ждет слот, отдает фрагменты {"queued": True, "position": N};
+    затем - фрагменты ответа сразу по мере их получения от Ollama.
+    Одинаковые одновременные запросы объединяются и получают одни и те же фрагменты.
+    Детерминированные ответы из кэша воспроизводятся фрагментами с флагом "cached".
+    Переполненная очередь (429) и ошибки Ollama поднимаются как HTTPException до первого фрагмента.
+    """
+    full_options = build_options(options, model)
+    messages, dropped = pack_messages(model, messages, full_options)
+    key = request_key(model, messages, full_options)
+    if session_id:
+        # Контекст сохраняется для конкретной сессии, поэтому объединяем только ее запросы
+        key = f"{key}:{user_id}:{session_id}"
     
-    logger.info(f"Стриминг запрос к модели: {model}, таймаут: {timeout_duration}s")
+    cache_key = None
+    if response_cache.is_cacheable(full_options):
+        cache_key = response_cache_key("generate" if session_id else "chat", model, messages, full_options)
+        if use_cache:
+            entry = await response_cache.get(cache_key)
+            if entry is not None:
+                logger.info(f"Ответ модели {model} воспроизводится из кэша")
+                async for chunk in response_cache.replay(entry, model):
+                    yield with_dropped_count(chunk, dropped)
+                return
+        else:
+            response_cache.record_bypass()
     
-    start_time = time.time()
-    full_response = ""
-    has_started_receiving_content = False
-    last_progress_update = time.time()
+    async def generate() -> AsyncIterator[Dict[str, Any]]:
+        residency_manager.record_use(model)
+        ticket = model_scheduler.submit(model, user_id)
+        try:
+            async for position in model_scheduler.wait(ticket):
+                yield {"model": model, "content": "", "done": False, "queued": True, "position": position}
+            
+            if session_id:
+                upstream = _stream_session_upstream(model, messages, user_id, session_id, options)
+            else:
+                upstream = _stream_chat_upstream(model, messages, options)
+            
+            parts: List[str] = []
+            async for chunk in upstream:
+                if cache_key is not None:
+                    parts.append(chunk["content"])
+                    if chunk["done"]:
+                        # Сохраняем только полностью полученный ответ
+                        meta = {name: value for name, value in chunk.items() if name not in ("model", "content", "done")}
+                        await response_cache.put(cache_key, "".join(parts), meta)
+                yield chunk
+        finally:
+            model_scheduler.release(ticket)
+    
+    async for chunk in single_flight.subscribe(key, generate):
+        yield with_dropped_count(chunk, dropped)
+
+def with_dropped_count(chunk: Dict[str, Any], dropped: int) -> Dict[str, Any]:
+    """Добавляет в последний фрагмент число сообщений, не вошедших в контекст"""
+    if dropped and chunk["done"]:
+        # Фрагменты общие для объединенных запросов, поэтому копируем
+        return {**chunk, "dropped_messages": dropped}
+    return chunk
+
+async def _stream_chat_upstream(
+    model: str,
+    messages: List[Dict[str, str]],
+    options: Optional[Dict[str, Any]] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """Потоковый запрос к /api/chat со всей историей сообщений"""
+    async for chunk in _stream_upstream(model, "/api/chat", {
+        "model": model,
+        "messages": messages,
+        "stream": True,  # Включаем стриминг
+        "options": build_options(options, model),
+        "keep_alive": residency_manager.keep_alive_for(model)
+    }):
+        yield chunk
+
+async def _stream_session_upstream(
+    model: str,
+    messages: List[Dict[str, str]],
+    user_id: Optional[str],
+    session_id: str,
+    options: Optional[Dict[str, Any]] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Потоковый запрос к /api/generate с переиспользованием контекста сессии.
+    Если сохраненный context покрывает всю историю до нового сообщения пользователя,
+    отправляется только это сообщение; иначе - полный промпт из всей истории.
+    Полученный в конце context сохраняется для следующего хода.
+    """
+    digest = (model_registry.get(model) or {}).get("digest")
+    
+    context = None
+    if messages and messages[-1].get("role", "").lower() == "user":
+        context = generation_contexts.get(user_id, session_id, model, digest, messages[:-1])
+    
+    payload = {
+        "model": model,
+        "stream": True,
+        "options": build_options(options, model),
+        "keep_alive": residency_manager.keep_alive_for(model)
+    }
+    if context is not None:
+        logger.info(f"Сессия {session_id}: переиспользуем контекст из {len(context)} токенов")
+        payload.update(prompt=convert_messages_to_prompt(messages[-1:]), context=context)
+    else:
+        payload.update(prompt=convert_messages_to_prompt(messages))
+    
+    parts: List[str] = []
+    async for chunk in _stream_upstream(model, "/api/generate", payload):
+        new_context = chunk.pop("context", None)
+        parts.append(chunk["content"])
+        if chunk["done"] and new_context:
+            conversation = messages + [{"role": "assistant", "content": "".join(parts)}]
+            generation_contexts.put(user_id, session_id, model, digest, conversation, new_context)
+        yield chunk
+
+async def _stream_upstream(
+    model: str,
+    path: str,
+    payload: Dict[str, Any]
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Потоковый запрос к Ollama: отдает фрагменты ответа, не буферизуя весь ответ.
+    Вместо общего лимита на весь ответ действуют два адаптивных таймаута:
+    ожидание первого фрагмента и простой между фрагментами (см. latency_tracker).
+    """
+    timeout_duration = get_generation_timeout(model)
+    client = get_ollama_client(model)
+    model_loaded = client.has_loaded(model)
+    first_byte_timeout, idle_timeout = latency_tracker.timeouts(
+        model, timeout_duration, loaded=model_loaded, prompt_tokens=estimate_prompt_tokens(payload)
+    )
+    
+    logger.info(f"Стриминг запрос к модели: {model}, таймауты: первый фрагмент {first_byte_timeout:.1f}s, простой {idle_timeout:.1f}s")
+    
+    start_time = time.monotonic()
+    first_content_at: Optional[float] = None
+    last_chunk_at: Optional[float] = None
+    max_gap = 0.0
+    tokens_generated = 0
+    finished = False
     
     try:
-        async with httpx.AsyncClient(timeout=timeout_duration) as client:
-            response = await client.post(
-                f"{settings.OLLAMA_API_URL}/api/chat",
-                json={
-                    "model": model,
-                    "messages": messages,
-                    "stream": True,  # Включаем стриминг
-                    "options": {
-                        "num_ctx": 8192,  # Увеличенный размер контекста для лучшей обработки больших моделей
-                        "temperature": 0.7,
-                        "top_k": 50,
-                    }
-                }
-            )
-            
+        async with client.stream(
+            "POST",
+            path,
+            call_class=GENERATION,
+            # Сокет не должен срабатывать раньше прикладных таймаутов ниже
+            read_timeout=max(first_byte_timeout, idle_timeout),
+            json=payload
+        ) as response:
             if response.status_code != 200:
-                error_text = response.text
-                logger.error(f"Error response from Ollama API: {response.status_code} - {error_text}")
-                
-                # Обрабатываем специфичные ошибки с более детальными объяснениями
-                if response.status_code == 404 and "model" in error_text and "not found" in error_text:
-                    raise HTTPException(
-                        status_code=404,
-                        detail=f"Model '{model}' not found. You need to download it first using the command: ollama pull {model}"
-                    )
-                
-                # Обрабатываем ошибки таймаута/загрузки с лучшим объяснением
-                if response.status_code in [500, 502, 504]:
-                    raise HTTPException(
-                        status_code=response.status_code,
-                        detail=f"Model '{model}' is having trouble loading or responding (Error {response.status_code}). Large models may take several minutes to load. Try restarting Ollama or checking the Ollama logs."
-                    )
-                
-                raise HTTPException(status_code=response.status_code, detail=f"API error: {error_text}")
+                error_text = (await response.aread()).decode("utf-8", errors="replace")
+                raise_for_ollama_error(model, response.status_code, error_text)
             
-        # Читаем ответ построчно
-            async for line in response.aiter_lines():
-                if not line.strip():
-                    continue
-                
+            # Разбираем поток кусками байтов по мере поступления
+            raw_chunks = response.aiter_bytes()
+            decoder = NDJSONDecoder()
+            log_chunks = logger.isEnabledFor(logging.DEBUG)
+            stream_ended = False
+            while not stream_ended:
+                if first_content_at is None:
+                    wait = max(first_byte_timeout - (time.monotonic() - start_time), 0.001)
+                else:
+                    wait = idle_timeout
                 try:
-                    # Логируем полученную строку для отладки
-                    logger.info(f"Received chunk: {line[:100]}...")
+                    objects = decoder.feed(await asyncio.wait_for(raw_chunks.__anext__(), timeout=wait))
+                except StopAsyncIteration:
+                    objects = decoder.flush()
+                    stream_ended = True
+                except asyncio.TimeoutError:
+                    latency_tracker.record_stall(model)
+                    stage = "first token" if first_content_at is None else "next token"
+                    error_message = f"Model '{model}' stalled: no {stage} for {wait:.1f} seconds. The generation was stopped."
+                    logger.error(f"Streaming error (stall): {error_message}")
+                    raise HTTPException(status_code=504, detail=error_message)
+                
+                now = time.monotonic()
+                if first_content_at is None:
+                    first_content_at = now
+                elif last_chunk_at is not None:
+                    max_gap = max(max_gap, now - last_chunk_at)
+                last_chunk_at = now
+                
+                for json_data in objects:
+                    if not isinstance(json_data, dict):
+                        continue
+                    
+                    # Логирование каждого фрагмента дорого, поэтому только в DEBUG и выборочно
+                    if log_chunks and decoder.objects % CHUNK_LOG_SAMPLE_RATE == 0:
+                        logger.debug(f"Received chunk #{decoder.objects}: {str(json_data)[:100]}...")
                     
-                    # Парсим JSON из каждой строки
-                    try:
-                        json_data = json.loads(line)
-                    except json.JSONDecodeError:
-                        # Если не удалось распарсить как JSON, пробуем через httpx
-                        try:
-                            json_data = httpx.loads(line)
-                        except Exception:
-                            logger.warning(f"Failed to parse chunk as JSON: {line}")
-                            continue
+                    if "error" in json_data:
+                        raise HTTPException(status_code=500, detail=f"API error: {json_data['error']}")
                     
                     # Извлекаем контент сообщения, может быть в разных форматах
-                    content = None
-                    if 'message' in json_data and 'content' in json_data['message']:
-                        content = json_data['message']['content']
-                    elif 'response' in json_data:
-                        content = json_data['response']
+                    message = json_data.get("message")
+                    if message is not None:
+                        content = message.get("content") or ""
+                    else:
+                        content = json_data.get("response") or ""
                     
-                    if content:
-                        if not has_started_receiving_content:
-                            has_started_receiving_content = True
-                            logger.info(f"First content received after {time.time() - start_time:.2f}s")
-                            logger.info(f"Content: {content[:100]}...")
-                        
-                        full_response += content
-                        last_progress_update = time.time()
+                    done = bool(json_data.get("done"))
+                    chunk = {"model": model, "content": content, "done": done}
+                    if done:
+                        # Итоговая статистика генерации от Ollama
+                        for key in ("total_duration", "load_duration", "prompt_eval_count", "eval_count", "eval_duration", "context"):
+                            if key in json_data:
+                                chunk[key] = json_data[key]
+                        record_latency(model, json_data, start_time, first_content_at, max_gap, model_loaded)
+                        finished = True
+                    elif content:
+                        # Ollama присылает примерно по одному токену во фрагменте
+                        tokens_generated += 1
                     
-                    # Логируем прогресс для длинных ответов
-                    if time.time() - last_progress_update > 10:
-                        logger.info(f"Получено {len(full_response)} символов от {model}")
-                        last_progress_update = time.time()
-                        
-                except Exception as e:
-                    logger.warning(f'Failed to parse streaming response chunk: {line} - {str(e)}')
-            
-            logger.info(f"Ответ получен за {time.time() - start_time:.2f}s")
-        return full_response
+                    yield chunk
+    
+    except (asyncio.CancelledError, GeneratorExit):
+        # Ответ больше никому не нужен: выход из client.stream закрыл соединение,
+        # и Ollama прекращает генерацию
+        if not finished:
+            record_cancellation(model, tokens_generated, payload["options"].get("num_predict"))
+        raise
     
     except httpx.TimeoutException:
-        error_message = f"Request to model '{model}' timed out after {timeout_duration} seconds.\n\n"
-        
-        if is_large_model(model):
-            error_message += (
-                "This is a very large model that takes significant time to load. The model might still be loading in the background. You can try:\n"
-                "1. Wait a few minutes and try again\n"
-                "2. Check Ollama logs in the terminal\n"
-                "3. Restart the Ollama service\n"
-                "4. Consider using a smaller model if immediate responses are needed"
-            )
-        else:
-            error_message += "The model might be still loading or the response is taking too long. You may need to restart Ollama."
-        
+        latency_tracker.record_stall(model)
+        error_message = build_timeout_message(model, first_byte_timeout)
         logger.error(f"Streaming error (timeout): {error_message}")
         raise HTTPException(status_code=504, detail=error_message)
+
+def estimate_prompt_tokens(payload: Dict[str, Any]) -> int:
+    """Оценка размера промпта запроса /api/chat (messages) или /api/generate (prompt)"""
+    if "messages" in payload:
+        return sum(estimate_message_tokens(message) for message in payload["messages"])
+    return len(payload.get("prompt") or "") // CHARS_PER_TOKEN + 1
+
+def record_latency(
+    model: str,
+    final_chunk: Dict[str, Any],
+    start_time: float,
+    first_content_at: Optional[float],
+    max_gap: float,
+    model_loaded: bool
+) -> None:
+    """Передает замеры завершенного ответа в статистику задержек"""
+    tokens_per_second = None
+    if final_chunk.get("eval_count") and final_chunk.get("eval_duration"):
+        # eval_duration приходит в наносекундах
+        tokens_per_second = final_chunk["eval_count"] / (final_chunk["eval_duration"] / 1e9)
+    prompt_tokens_per_second = None
+    if final_chunk.get("prompt_eval_count") and final_chunk.get("prompt_eval_duration"):
+        prompt_tokens_per_second = final_chunk["prompt_eval_count"] / (final_chunk["prompt_eval_duration"] / 1e9)
+    
+    # Время до первого токена у холодной модели включает загрузку и не отражает обычную задержку
+    ttft = first_content_at - start_time if first_content_at is not None and model_loaded else None
+    latency_tracker.record(
+        model, ttft, max_gap, tokens_per_second, final_chunk.get("eval_count"),
+        final_chunk.get("prompt_eval_count"), prompt_tokens_per_second
+    )
+
+async def send_streaming_message(
+    model: str,
+    messages: List[Dict[str, str]],
+    user_id: Optional[str] = None,
+    options: Optional[Dict[str, Any]] = None,
+    use_cache: bool = True,
+    session_id: Optional[str] = None
+) -> str:
+    """Отправляет сообщение с использованием потокового режима и возвращает ответ целиком"""
+    start_time = time.time()
+    # Фрагменты собираем в список и склеиваем один раз в конце
+    parts: List[str] = []
+    received_chars = 0
+    has_started_receiving_content = False
+    last_progress_update = time.time()
     
+    try:
+        async for chunk in stream_chat(model, messages, user_id, options, use_cache, session_id):
+            content = chunk["content"]
+            if content:
+                if not has_started_receiving_content:
+                    has_started_receiving_content = True
+                    logger.info(f"First content received after {time.time() - start_time:.2f}s")
+                    logger.info(f"Content: {content[:100]}...")
+                
+                parts.append(content)
+                received_chars += len(content)
+            
+            # Логируем прогресс для длинных ответов
+            if time.time() - last_progress_update > 10:
+                logger.info(f"Получено {received_chars} символов от {model}")
+                last_progress_update = time.time()
+        
+        logger.info(f"Ответ получен за {time.time() - start_time:.2f}s")
+        return "".join(parts)
+    
+    except HTTPException:
+        raise
     except Exception as error:
         logger.error(f"Streaming error: {error}")
         raise HTTPException(status_code=500, detail=str(error))
 
+async def send_embed_request(model: str, texts: List[str]) -> List[List[float]]:
+    """Отправляет пакет текстов в /api/embed и возвращает векторы в том же порядке"""
+    timeout_duration = get_generation_timeout(model)
+    client = get_ollama_client(model)
+    
+    try:
+        response = await client.post(
+            "/api/embed",
+            call_class=GENERATION,
+            read_timeout=timeout_duration,
+            json={
+                "model": model,
+                "input": texts,
+                "keep_alive": residency_manager.keep_alive_for(model)
+            }
+        )
+        
+        if response.status_code != 200:
+            # Фоновая индексация шлет эмбеддинги постоянно: ее ошибки не должны сбрасывать каталог
+            raise_for_ollama_error(model, response.status_code, response.text, invalidate_catalog=False)
+        
+        embeddings = response.json().get("embeddings")
+        if not isinstance(embeddings, list) or len(embeddings) != len(texts):
+            logger.error(f"Unexpected embeddings response from Ollama API for {len(texts)} texts")
+            raise HTTPException(status_code=500, detail="Unexpected response format from Ollama API")
+        return embeddings
+    
+    except httpx.TimeoutException:
+        error_message = build_timeout_message(model, timeout_duration)
+        logger.error(f"Timeout error: {error_message}")
+        raise HTTPException(status_code=504, detail=error_message)
+    except HTTPException:
+        raise
+    except Exception as error:
+        logger.error(f"Error in send_embed_request: {error}")
+        raise HTTPException(status_code=500, detail=str(error))
+
+async def embed_texts(
+    model: str,
+    texts: List[str],
+    user_id: Optional[str] = None,
+    batch_size: Optional[int] = None
+) -> Tuple[List[array], int, int]:
+    """
+    Векторы float32 для текстов в исходном порядке и число уникальных текстов,
+    взятых из кэша и посчитанных заново.
+    Повторы внутри запроса считаются один раз, ранее встречавшиеся тексты берутся
+    из хранилища по (модель, sha256 текста). Остальные отправляются в /api/embed
+    пакетами по batch_size, каждый пакет занимает слот модели в планировщике
+    и сохраняется сразу, так что ошибка в следующем пакете не теряет готовые векторы.
+    """
+    batch_size = max(1, batch_size or settings.OLLAMA_EMBED_BATCH_SIZE)
+    hashes = [text_hash(text) for text in texts]
+    # Уникальные тексты в порядке первого появления
+    unique_texts = dict(zip(hashes, texts))
+    digest = (model_registry.get(model) or {}).get("digest")
+    
+    vectors = await embedding_store.get_many(model, digest, list(unique_texts))
+    missing = [hash_value for hash_value in unique_texts if hash_value not in vectors]
+    
+    if missing:
+        residency_manager.record_use(model)
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        async with model_scheduler.slot(model, user_id):
+            embeddings = await send_embed_request(model, [unique_texts[hash_value] for hash_value in batch])
+        # Сразу в float32, чтобы новые и закэшированные векторы совпадали до бита
+        items = [(hash_value, array("f", vector)) for hash_value, vector in zip(batch, embeddings)]
+        await embedding_store.put_many(model, digest, items)
+        vectors.update(items)
+        embedding_stats["upstream_batches"] += 1
+    
+    cached = len(unique_texts) - len(missing)
+    embedding_stats["requests"] += 1
+    embedding_stats["texts"] += len(texts)
+    embedding_stats["duplicates"] += len(texts) - len(unique_texts)
+    embedding_stats["cached"] += cached
+    embedding_stats["embedded"] += len(missing)
+    logger.info(f"Эмбеддинги {model}: {len(texts)} текстов, из кэша {cached}, посчитано {len(missing)}")
+    
+    return [vectors[hash_value] for hash_value in hashes], cached, len(missing)
+
+async def get_embeddings(
+    model: str,
+    texts: List[str],
+    user_id: Optional[str] = None,
+    batch_size: Optional[int] = None
+) -> Dict[str, Any]:
+    """Эмбеддинги текстов в формате ответа /ollama/embeddings"""
+    vectors, cached, embedded = await embed_texts(model, texts, user_id, batch_size)
+    return {
+        "model": model,
+        "embeddings": [vector.tolist() for vector in vectors],
+        "dimensions": len(vectors[0]) if vectors else 0,
+        "cached": cached,
+        "embedded": embedded,
+    }
+
+def format_model_name(model_id: str) -> str:
+    """Более описательное имя для распространенных моделей"""
+    model_name = model_id.lower()
+    display_name = model_id
+    
+    # Улучшенное именование моделей
+    if "phi3" in model_name:
+        display_name = f"Phi-3 {'Mini' if 'mini' in model_name else ''}"
+    elif "llama3" in model_name:
+        display_name = f"Llama 3 {'8B' if '8b' in model_name else '70B' if '70b' in model_name else ''}"
+    elif "llama2" in model_name:
+        display_name = f"Llama 2 {'7B' if '7b' in model_name else '13B' if '13b' in model_name else ''}"
+    elif "gemma" in model_name:
+        display_name = f"Gemma {'2B' if '2b' in model_name else '7B' if '7b' in model_name else ''}"
+    elif "mistral" in model_name:
+        display_name = f"Mistral {'7B' if '7b' in model_name else ''}"
+    elif "deepseek" in model_name:
+        display_name = f"DeepSeek {'Coder' if 'coder' in model_name else ''}"
+    
+    return display_name
+
 async def get_available_models() -> List[Dict[str, str]]:
-    """Получает список доступных моделей из локального Ollama"""
+    """Получает список доступных моделей из кэшированного каталога Ollama"""
     try:
-        # Получаем URL из настроек и выводим для отладки
-        ollama_url = f"{settings.OLLAMA_API_URL}/api/tags"
-        logger.info(f"Запрос к Ollama API для получения моделей: {ollama_url}")
+        await model_registry.ensure_fresh()
         
-        # First check if Ollama is running at all
-        is_connected = await test_connection()
-        if not is_connected:
-            logger.error("Ollama API недоступно, невозможно получить модели")
+        if not model_registry.is_loaded:
+            logger.error(f"Каталог моделей Ollama недоступен: {model_registry.last_error}")
+            if model_registry.last_status_code is not None and model_registry.last_status_code != 200:
+                return [{
+                    "id": "api_error",
+                    "name": f"Error accessing Ollama API: Status {model_registry.last_status_code}"
+                }]
             # Return a special model entry to indicate Ollama is not running
             return [{
                 "id": "ollama_not_running",
                 "name": "Ollama is not running. Start Ollama with 'ollama serve' command."
             }]
         
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            try:
-                # Use a slightly longer timeout for model fetching
-                response = await client.get(ollama_url, timeout=15.0)
-                logger.info(f"Статус ответа от Ollama API: {response.status_code}")
-                
-                # Log response for debugging
-                response_text = response.text
-                logger.info(f"Response content preview: {response_text[:200]}")
-                
-                if response.status_code != 200:
-                    logger.error(f"Ошибка при получении моделей: статус {response.status_code}")
-                    return [{
-                        "id": "api_error",
-                        "name": f"Error accessing Ollama API: Status {response.status_code}"
-                    }]
-                
-                # Parse the response as JSON
-                try:
-                    data = response.json()
-                except Exception as json_error:
-                    logger.error(f"Invalid JSON response: {json_error}")
-                    return [{
-                        "id": "json_error",
-                        "name": "Invalid response from Ollama API. Check logs."
-                    }]
-                
-            except httpx.RequestError as e:
-                logger.error(f"Ошибка соединения с Ollama API: {e}")
-                return [{
-                    "id": "connection_error",
-                    "name": f"Connection error: {str(e)}"
-                }]
-            
-            # Проверка на пустой список моделей
-            if not data.get("models") or len(data["models"]) == 0:
-                logger.warning("Нет доступных моделей в Ollama")
-                return [{
-                    "id": "no_models",
-                    "name": "No models found. Use 'ollama pull MODEL_NAME' to download models."
-                }]
-            
-            logger.info(f"Найдено моделей: {len(data['models'])}")
-            
-            # Преобразуем формат списка моделей Ollama в формат нашего приложения
-            # Добавляем более описательные имена для распространенных моделей
-            result = []
-            for model in data["models"]:
-                model_name = model["name"].lower()
-                display_name = model["name"]
-                
-                # Улучшенное именование моделей
-                if "phi3" in model_name:
-                    display_name = f"Phi-3 {'Mini' if 'mini' in model_name else ''}"
-                elif "llama3" in model_name:
-                    display_name = f"Llama 3 {'8B' if '8b' in model_name else '70B' if '70b' in model_name else ''}"
-                elif "llama2" in model_name:
-                    display_name = f"Llama 2 {'7B' if '7b' in model_name else '13B' if '13b' in model_name else ''}"
-                elif "gemma" in model_name:
-                    display_name = f"Gemma {'2B' if '2b' in model_name else '7B' if '7b' in model_name else ''}"
-                elif "mistral" in model_name:
-                    display_name = f"Mistral {'7B' if '7b' in model_name else ''}"
-                elif "deepseek" in model_name:
-                    display_name = f"DeepSeek {'Coder' if 'coder' in model_name else ''}"
-                
-                result.append({
-                    "id": model["name"],
-                    "name": display_name
-                })
-            
-            return result
+        models = model_registry.models()
+        
+        # Проверка на пустой список моделей
+        if not models:
+            logger.warning("Нет доступных моделей в Ollama")
+            return [{
+                "id": "no_models",
+                "name": "No models found. Use 'ollama pull MODEL_NAME' to download models."
+            }]
+        
+        # Преобразуем формат списка моделей Ollama в формат нашего приложения
+        return [
+            {"id": model["name"], "name": format_model_name(model["name"])}
+            for model in models
+        ]
             
     except Exception as error:
         logger.error(f"Error fetching models from local Ollama: {error}")
@@ -371,73 +799,45 @@ async def test_connection() -> bool:
         logger.info(f"Проверка соединения с Ollama API: {ollama_url}")
         
         # Use a shorter timeout for checking availability
-        async with httpx.AsyncClient(timeout=3.0) as client:
-            try:
-                logger.info("Sending request to Ollama API...")
-                response = await client.get(ollama_url)
-                logger.info(f"Статус проверки соединения: {response.status_code}")
-                
-                if response.status_code == 200:
-                    try:
-                        # Convert response to JSON to verify it's valid
-                        version_data = response.json()
-                        version = version_data.get("version", "unknown")
-                        logger.info(f"Ollama version: {version}")
-                        
-                        # Check if we can access the models list
-                        try:
-                            tags_response = await client.get(f"{settings.OLLAMA_API_URL}/api/tags", timeout=5.0)
-                            logger.info(f"Статус проверки моделей: {tags_response.status_code}")
-                            
-                            if tags_response.status_code == 200:
-                                data = tags_response.json()
-                                model_count = len(data.get("models", []))
-                                logger.info(f"Доступно моделей: {model_count}")
-                            else:
-                                logger.warning(f"Ollama API доступна, но не удалось получить список моделей: статус {tags_response.status_code}")
-                        except Exception as models_error:
-                            logger.warning(f"Ollama API доступна, но произошла ошибка при получении моделей: {models_error}")
-                    except Exception as json_error:
-                        logger.warning(f"Could not parse Ollama API response: {json_error}")
-                        # Even if we couldn't parse JSON, connection is still successful
-                
-                return response.status_code == 200
-            except httpx.ConnectError as connect_error:
-                logger.error(f"Не удалось подключиться к Ollama API по адресу {ollama_url}: {connect_error}")
-                return False
-            except httpx.ReadTimeout as timeout_error:
-                logger.error(f"Timeout при подключении к Ollama API: {timeout_error}")
-                return False
+        client = get_ollama_client()
+        try:
+            logger.info("Sending request to Ollama API...")
+            response = await client.get("/api/version", read_timeout=3.0)
+            logger.info(f"Статус проверки соединения: {response.status_code}")
+            
+            if response.status_code == 200:
+                try:
+                    # Convert response to JSON to verify it's valid
+                    version_data = response.json()
+                    version = version_data.get("version", "unknown")
+                    logger.info(f"Ollama version: {version}")
+                    
+                except Exception as json_error:
+                    logger.warning(f"Could not parse Ollama API response: {json_error}")
+                    # Even if we couldn't parse JSON, connection is still successful
+            
+            return response.status_code == 200
+        except httpx.ConnectError as connect_error:
+            logger.error(f"Не удалось подключиться к Ollama API по адресу {ollama_url}: {connect_error}")
+            return False
+        except httpx.ReadTimeout as timeout_error:
+            logger.error(f"Timeout при подключении к Ollama API: {timeout_error}")
+            return False
     except Exception as error:
         logger.error(f"Cannot connect to local Ollama instance: {error}")
         return False
 
 async def is_model_available(model_name: str) -> bool:
-    """Проверяет доступность указанной модели"""
+    """Проверяет доступность указанной модели по каталогу в памяти"""
     try:
-        models = await get_available_models()
-        model_exists = any(model["id"] == model_name for model in models)
+        is_available = await model_registry.is_available(model_name)
         
-        # Если модель не найдена в списке, делаем прямую проверку для верификации
-        # (Иногда список моделей не обновляется мгновенно)
-        if not model_exists:
-            try:
-                async with httpx.AsyncClient(timeout=8.0) as client:
-                    response = await client.post(
-                        f"{settings.OLLAMA_API_URL}/api/generate",
-                        json={
-                            "model": model_name,
-                            "prompt": "Hello",
-                            "stream": False,
-                            "options": {"num_predict": 1}  # Минимальное предсказание токенов для проверки существования модели
-                        }
-                    )
-                    return response.status_code == 200
-            except Exception as probe_error:
-                logger.info(f"Direct model probe failed: {probe_error}")
-                return False
+        # Каталог недоступен: не блокируем запрос, ошибку вернет сам Ollama
+        if is_available is None:
+            logger.warning(f"Каталог моделей недоступен, пропускаем проверку модели {model_name}")
+            return True
         
-        return model_exists
+        return is_available
     
     except Exception as error:
         logger.error(f"Error checking model availability: {error}")
@@ -448,20 +848,21 @@ async def query_ollama(prompt: str, model: str = "llama3") -> str:
     try:
         logger.info(f"Querying Ollama with model {model}")
         
-        async with httpx.AsyncClient(timeout=600) as client:
-            response = await client.post(
-                f"{settings.OLLAMA_API_URL}/api/generate",
-                json={
-                    "model": model,
-                    "prompt": prompt,
-                    "stream": False
-                }
-            )
-            
-            response.raise_for_status()
-            data = response.json()
-            
-            return data["response"]
+        client = get_ollama_client(model)
+        response = await client.post(
+            "/api/generate",
+            read_timeout=600,
+            json={
+                "model": model,
+                "prompt": prompt,
+                "stream": False
+            }
+        )
+        
+        response.raise_for_status()
+        data = response.json()
+        
+        return data["response"]
     except Exception as error:
         logger.error(f"Error in query_ollama: {error}")
         raise HTTPException(status_code=500, detail=str(error))
\ No newline at end of file
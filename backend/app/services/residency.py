@@ -0,0 +1,193 @@
+"""Прогрев моделей и управление временем их нахождения в памяти Ollama (keep_alive)"""
+from typing import Any, Deque, Dict, List, Optional, Set
+from collections import deque
+import asyncio
+import logging
+import time
+
+import httpx
+
+from app.core.config import settings
+from app.services.ollama_client import get_ollama_client, GENERATION
+from app.services.model_registry import model_registry
+
+logger = logging.getLogger(__name__)
+
+
+def parse_model_list(value: str) -> List[str]:
+    """Разбирает список моделей через запятую"""
+    return [model.strip() for model in value.split(",") if model.strip()]
+
+
+class ResidencyManager:
+    """
+    Решает, сколько модели оставаться в памяти Ollama после запроса:
+    модели из списка предзагрузки и часто используемые закрепляются
+    с длинным keep_alive, остальные получают короткий и выгружаются сами.
+    Прогрев выполняется в фоне, чтобы загрузка модели не попадала в запрос пользователя.
+    """
+
+    def __init__(
+        self,
+        preload: Optional[List[str]] = None,
+        keep_alive: str = "5m",
+        pinned_keep_alive: str = "30m",
+        pin_threshold: int = 5,
+        usage_window: float = 900.0,
+        interval: float = 60.0,
+    ):
+        self.preload = set(preload or [])
+        self.keep_alive = keep_alive
+        self.pinned_keep_alive = pinned_keep_alive
+        self.pin_threshold = pin_threshold
+        self.usage_window = usage_window
+        self.interval = interval
+
+        self._usage: Dict[str, Deque[float]] = {}
+        self._pinned: Set[str] = set()
+        self._warming: Dict[str, asyncio.Task] = {}
+        self._task: Optional[asyncio.Task] = None
+
+        self.warmups_total = 0
+        self.warmup_errors = 0
+        self.demotions_total = 0
+
+    def _recent_uses(self, model: str) -> int:
+        uses = self._usage.get(model)
+        if not uses:
+            return 0
+        cutoff = time.monotonic() - self.usage_window
+        while uses and uses[0] < cutoff:
+            uses.popleft()
+        return len(uses)
+
+    def record_use(self, model: str) -> None:
+        """Учитывает запрос к модели"""
+        self._usage.setdefault(model, deque()).append(time.monotonic())
+        if model not in self._pinned and self._recent_uses(model) >= self.pin_threshold:
+            self._pinned.add(model)
+            logger.info(f"Модель {model} часто используется и закреплена в памяти")
+
+    def is_pinned(self, model: str) -> bool:
+        return model in self.preload or model in self._pinned
+
+    def keep_alive_for(self, model: str) -> str:
+        """Значение keep_alive для запроса к модели"""
+        return self.pinned_keep_alive if self.is_pinned(model) else self.keep_alive
+
+    async def _load(self, model: str, keep_alive: str) -> None:
+        """Запрос без промпта: Ollama загружает модель и обновляет ее keep_alive"""
+        client = get_ollama_client(model)
+        if model_registry.is_large(model):
+            read_timeout = settings.OLLAMA_LARGE_MODEL_READ_TIMEOUT
+        else:
+            read_timeout = settings.OLLAMA_GENERATION_READ_TIMEOUT
+        response = await client.post(
+            "/api/generate",
+            call_class=GENERATION,
+            read_timeout=read_timeout,
+            json={"model": model, "keep_alive": keep_alive, "stream": False},
+        )
+        if response.status_code != 200:
+            raise httpx.HTTPStatusError(
+                f"Warm-up of {model} failed: {response.status_code} {response.text}",
+                request=response.request,
+                response=response,
+            )
+        client.loaded_models.add(model)
+
+    async def warm(self, model: str) -> None:
+        """Загружает модель, если ее еще нет в памяти"""
+        if get_ollama_client(model).has_loaded(model):
+            return
+        if model_registry.is_loaded and model_registry.get(model) is None:
+            # Модели нет в каталоге: прогрев закончился бы ошибкой 404
+            logger.info(f"Модель {model} не скачана, прогрев пропущен")
+            return
+        start_time = time.time()
+        try:
+            await self._load(model, self.keep_alive_for(model))
+            self.warmups_total += 1
+            logger.info(f"Модель {model} прогрета за {time.time() - start_time:.2f}s")
+        except Exception as error:
+            self.warmup_errors += 1
+            logger.warning(f"Не удалось прогреть модель {model}: {error}")
+
+    def schedule_warm(self, model: str) -> None:
+        """Запускает прогрев в фоне, не дублируя уже идущий"""
+        task = self._warming.get(model)
+        if task is not None and not task.done():
+            return
+        task = self._warming[model] = asyncio.create_task(self.warm(model))
+        task.add_done_callback(lambda done: self._warming_done(model, done))
+
+    def _warming_done(self, model: str, task: asyncio.Task) -> None:
+        if self._warming.get(model) is task:
+            del self._warming[model]
+
+    async def _demote_cold(self) -> None:
+        """Снимает закрепление с моделей, к которым давно не обращались"""
+        for model in list(self._pinned):
+            if self._recent_uses(model) >= self.pin_threshold:
+                continue
+            self._pinned.discard(model)
+            self.demotions_total += 1
+            # Короткий keep_alive ставим только загруженной модели, чтобы не загрузить ее снова
+            if get_ollama_client(model).has_loaded(model):
+                try:
+                    await self._load(model, self.keep_alive)
+                    logger.info(f"Модель {model} больше не закреплена и будет выгружена через {self.keep_alive}")
+                except Exception as error:
+                    logger.warning(f"Не удалось обновить keep_alive модели {model}: {error}")
+
+    async def _residency_loop(self) -> None:
+        while True:
+            try:
+                # Предзагруженные модели возвращаем в память, например после перезапуска Ollama
+                for model in self.preload:
+                    self.schedule_warm(model)
+                await self._demote_cold()
+            except Exception as error:
+                logger.error(f"Ошибка фонового управления моделями: {error}")
+            await asyncio.sleep(self.interval)
+
+    async def start(self) -> None:
+        """Запускает предзагрузку и фоновое управление моделями"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._residency_loop())
+
+    async def stop(self) -> None:
+        """Останавливает фоновые задачи"""
+        tasks = list(self._warming.values())
+        if self._task is not None:
+            tasks.append(self._task)
+            self._task = None
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._warming.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "preload": sorted(self.preload),
+            "pinned": sorted(self._pinned),
+            "warming": sorted(self._warming),
+            "recent_uses": {model: self._recent_uses(model) for model in list(self._usage)},
+            "warmups_total": self.warmups_total,
+            "warmup_errors": self.warmup_errors,
+            "demotions_total": self.demotions_total,
+        }
+
+
+residency_manager = ResidencyManager(
+    preload=parse_model_list(settings.OLLAMA_PRELOAD_MODELS),
+    keep_alive=settings.OLLAMA_KEEP_ALIVE,
+    pinned_keep_alive=settings.OLLAMA_PINNED_KEEP_ALIVE,
+    pin_threshold=settings.OLLAMA_PIN_THRESHOLD,
+    usage_window=settings.OLLAMA_USAGE_WINDOW,
+    interval=settings.OLLAMA_RESIDENCY_INTERVAL,
+)
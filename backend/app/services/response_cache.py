@@ -0,0 +1,206 @@
+"""Кэш ответов для детерминированных генераций (temperature 0 или фиксированный seed)"""
+from typing import Any, AsyncIterator, Dict, List, Optional
+from collections import OrderedDict
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Размер фрагмента при воспроизведении ответа из кэша в виде потока
+REPLAY_CHUNK_SIZE = 256
+
+
+class ResponseCache:
+    """
+    Двухуровневый кэш ответов: LRU в памяти, ограниченный по объему,
+    и необязательный SQLite-файл, который переживает перезапуск.
+    Кэшируются только воспроизводимые генерации.
+    """
+
+    def __init__(self, enabled: bool = False, max_bytes: int = 32 * 1024 * 1024, ttl: float = 86400.0, db_path: str = ""):
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.db_path = db_path
+
+        self._memory: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._memory_bytes = 0
+        self._db: Optional[sqlite3.Connection] = None
+        # Соединение общее для потоков asyncio.to_thread
+        self._lock = threading.Lock()
+
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.stores = 0
+        self.bypasses = 0
+
+    @staticmethod
+    def is_deterministic(options: Dict[str, Any]) -> bool:
+        """Ответ воспроизводим при нулевой температуре или заданном seed"""
+        return options.get("temperature") == 0 or options.get("seed") is not None
+
+    def is_cacheable(self, options: Dict[str, Any]) -> bool:
+        return self.enabled and self.is_deterministic(options)
+
+    @staticmethod
+    def make_key(kind: str, model: str, digest: Optional[str], messages: List[Dict[str, Any]], options: Dict[str, Any]) -> str:
+        """Ключ из нормализованных модели, ее digest, сообщений и параметров"""
+        payload = json.dumps(
+            {"kind": kind, "model": model, "digest": digest, "messages": messages, "options": options},
+            sort_keys=True,
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    # Уровень в памяти
+
+    def _memory_get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._memory.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry["created_at"] > self.ttl:
+            self._memory_drop(key)
+            return None
+        self._memory.move_to_end(key)
+        return entry
+
+    def _memory_put(self, key: str, entry: Dict[str, Any]) -> None:
+        if key in self._memory:
+            self._memory_drop(key)
+        if entry["size"] > self.max_bytes:
+            return
+        self._memory[key] = entry
+        self._memory_bytes += entry["size"]
+        while self._memory_bytes > self.max_bytes:
+            oldest_key = next(iter(self._memory))
+            self._memory_drop(oldest_key)
+
+    def _memory_drop(self, key: str) -> None:
+        entry = self._memory.pop(key)
+        self._memory_bytes -= entry["size"]
+
+    # Уровень на диске
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                "key TEXT PRIMARY KEY, content TEXT NOT NULL, meta TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._db.commit()
+        return self._db
+
+    def _disk_get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            db = self._connect()
+            row = db.execute(
+                "SELECT content, meta, created_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            content, meta, created_at = row
+            if time.time() - created_at > self.ttl:
+                db.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                db.commit()
+                return None
+        return {"content": content, "meta": json.loads(meta), "created_at": created_at, "size": len(content.encode("utf-8"))}
+
+    def _disk_put(self, key: str, entry: Dict[str, Any]) -> None:
+        with self._lock:
+            db = self._connect()
+            db.execute(
+                "INSERT OR REPLACE INTO response_cache (key, content, meta, created_at) VALUES (?, ?, ?, ?)",
+                (key, entry["content"], json.dumps(entry["meta"]), entry["created_at"]),
+            )
+            db.commit()
+
+    # Публичный интерфейс
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Ищет ответ в памяти, затем на диске"""
+        entry = self._memory_get(key)
+        if entry is not None:
+            self.hits_memory += 1
+            return entry
+
+        if self.db_path:
+            try:
+                entry = await asyncio.to_thread(self._disk_get, key)
+            except sqlite3.Error as error:
+                logger.error(f"Ошибка чтения кэша ответов с диска: {error}")
+                entry = None
+            if entry is not None:
+                self.hits_disk += 1
+                self._memory_put(key, entry)
+                return entry
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, content: str, meta: Optional[Dict[str, Any]] = None) -> None:
+        """Сохраняет ответ в памяти и, если настроено, на диске"""
+        entry = {
+            "content": content,
+            "meta": meta or {},
+            "created_at": time.time(),
+            "size": len(content.encode("utf-8")),
+        }
+        self._memory_put(key, entry)
+        self.stores += 1
+
+        if self.db_path:
+            try:
+                await asyncio.to_thread(self._disk_put, key, entry)
+            except sqlite3.Error as error:
+                logger.error(f"Ошибка записи кэша ответов на диск: {error}")
+
+    def record_bypass(self) -> None:
+        self.bypasses += 1
+
+    @staticmethod
+    async def replay(entry: Dict[str, Any], model: str) -> AsyncIterator[Dict[str, Any]]:
+        """Воспроизводит сохраненный ответ в формате потоковых фрагментов"""
+        content = entry["content"]
+        for start in range(0, len(content), REPLAY_CHUNK_SIZE):
+            yield {"model": model, "content": content[start:start + REPLAY_CHUNK_SIZE], "done": False, "cached": True}
+        yield {"model": model, "content": "", "done": True, "cached": True, **entry["meta"]}
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits_memory + self.hits_disk + self.misses
+        return {
+            "enabled": self.enabled,
+            "disk_tier": bool(self.db_path),
+            "entries_in_memory": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "max_memory_bytes": self.max_bytes,
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits_memory + self.hits_disk) / lookups, 3) if lookups else None,
+            "stores": self.stores,
+            "bypasses": self.bypasses,
+        }
+
+
+response_cache = ResponseCache(
+    enabled=settings.OLLAMA_RESPONSE_CACHE_ENABLED,
+    max_bytes=settings.OLLAMA_RESPONSE_CACHE_MAX_BYTES,
+    ttl=settings.OLLAMA_RESPONSE_CACHE_TTL,
+    db_path=settings.OLLAMA_RESPONSE_CACHE_DB_PATH,
+)
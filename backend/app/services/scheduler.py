@@ -0,0 +1,231 @@
+"""Ограничение параллельных запросов к моделям и справедливая очередь"""
+from typing import Any, AsyncIterator, Deque, Dict, Optional
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+import asyncio
+import logging
+import math
+import time
+
+from fastapi import HTTPException
+
+from app.core.config import settings
+from app.services.model_registry import model_registry
+
+logger = logging.getLogger(__name__)
+
+# Состояния заявки на слот
+QUEUED = "queued"
+ACTIVE = "active"
+RELEASED = "released"
+
+
+def parse_model_limits(value: str) -> Dict[str, int]:
+    """Разбирает строку вида 'llama3:70b=1,phi3=4'"""
+    limits: Dict[str, int] = {}
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        model, limit = item.rsplit("=", 1)
+        limits[model.strip()] = int(limit)
+    return limits
+
+
+class Ticket:
+    """Заявка пользователя на слот генерации для модели"""
+
+    def __init__(self, model: str, user_id: str):
+        self.model = model
+        self.user_id = user_id
+        self.state = QUEUED
+        self.granted: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.started_at: Optional[float] = None
+
+
+class ModelQueue:
+    """Очередь одной модели: активные слоты и ожидающие заявки по пользователям"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.queued = 0
+        # Порядок ключей - очередность пользователей при обслуживании по кругу
+        self.waiters: "OrderedDict[str, Deque[Ticket]]" = OrderedDict()
+        self.avg_service_time: Optional[float] = None
+        self.admitted_total = 0
+        self.rejected_total = 0
+
+
+class ModelScheduler:
+    """
+    Допускает к каждой модели не больше limit одновременных генераций.
+    Остальные запросы ждут в ограниченной очереди и обслуживаются по кругу
+    между пользователями, чтобы один пользователь не занимал модель целиком.
+    При переполнении очереди возвращается 429 с заголовком Retry-After.
+    """
+
+    def __init__(
+        self,
+        default_limit: int = 2,
+        max_queue: int = 32,
+        limits: Optional[Dict[str, int]] = None,
+        position_interval: float = 1.0,
+        large_model_limit: int = 1,
+    ):
+        self.default_limit = default_limit
+        self.large_model_limit = large_model_limit
+        self.max_queue = max_queue
+        self.limits = limits or {}
+        self.position_interval = position_interval
+        self._queues: Dict[str, ModelQueue] = {}
+
+    def limit_for(self, model: str) -> int:
+        """Число одновременных генераций, допустимое для модели"""
+        limit = self.limits.get(model)
+        if limit is None and model.endswith(":latest"):
+            limit = self.limits.get(model[:-len(":latest")])
+        if limit is None:
+            limit = self.large_model_limit if model_registry.is_large(model) else self.default_limit
+        return max(1, limit)
+
+    def _queue(self, model: str) -> ModelQueue:
+        queue = self._queues.get(model)
+        if queue is None:
+            queue = self._queues[model] = ModelQueue(self.limit_for(model))
+        else:
+            # Метаданные модели могли появиться или измениться после создания очереди
+            queue.limit = self.limit_for(model)
+        return queue
+
+    def _retry_after(self, queue: ModelQueue) -> int:
+        """Оценка времени до освобождения места в очереди (секунды)"""
+        service_time = queue.avg_service_time or 30.0
+        return max(1, math.ceil(service_time * (queue.queued + 1) / queue.limit))
+
+    def submit(self, model: str, user_id: Optional[str]) -> Ticket:
+        """Регистрирует заявку: сразу выдает слот или ставит в очередь"""
+        queue = self._queue(model)
+        ticket = Ticket(model, user_id or "anonymous")
+
+        if queue.active < queue.limit and queue.queued == 0:
+            self._grant(queue, ticket)
+            return ticket
+
+        if queue.queued >= self.max_queue:
+            queue.rejected_total += 1
+            retry_after = self._retry_after(queue)
+            logger.warning(f"Очередь модели {model} заполнена ({queue.queued}), запрос отклонен")
+            raise HTTPException(
+                status_code=429,
+                detail=f"Model '{model}' is busy: {queue.queued} requests are already waiting. Please retry later.",
+                headers={"Retry-After": str(retry_after)}
+            )
+
+        queue.waiters.setdefault(ticket.user_id, deque()).append(ticket)
+        queue.queued += 1
+        return ticket
+
+    def _grant(self, queue: ModelQueue, ticket: Ticket) -> None:
+        queue.active += 1
+        queue.admitted_total += 1
+        ticket.state = ACTIVE
+        ticket.started_at = time.monotonic()
+        ticket.granted.set_result(True)
+
+    def _dispatch(self, queue: ModelQueue) -> None:
+        """Отдает освободившиеся слоты следующим пользователям по кругу"""
+        while queue.active < queue.limit and queue.waiters:
+            user_id, tickets = next(iter(queue.waiters.items()))
+            ticket = tickets.popleft()
+            queue.queued -= 1
+            if tickets:
+                queue.waiters.move_to_end(user_id)
+            else:
+                del queue.waiters[user_id]
+            self._grant(queue, ticket)
+
+    def release(self, ticket: Ticket) -> None:
+        """Освобождает слот или снимает заявку с очереди"""
+        queue = self._queue(ticket.model)
+
+        if ticket.state == ACTIVE:
+            queue.active -= 1
+            duration = time.monotonic() - (ticket.started_at or ticket.enqueued_at)
+            queue.avg_service_time = duration if queue.avg_service_time is None else 0.8 * queue.avg_service_time + 0.2 * duration
+        elif ticket.state == QUEUED:
+            tickets = queue.waiters.get(ticket.user_id)
+            if tickets and ticket in tickets:
+                tickets.remove(ticket)
+                queue.queued -= 1
+                if not tickets:
+                    del queue.waiters[ticket.user_id]
+            ticket.granted.cancel()
+
+        ticket.state = RELEASED
+        self._dispatch(queue)
+
+    def position(self, ticket: Ticket) -> Optional[int]:
+        """Позиция заявки в очереди (1 - следующая), None если слот уже выдан"""
+        if ticket.state != QUEUED:
+            return None
+        queue = self._queue(ticket.model)
+        users = list(queue.waiters.keys())
+        own_index = users.index(ticket.user_id)
+        rank = queue.waiters[ticket.user_id].index(ticket)
+
+        # При обслуживании по кругу перед заявкой пройдут rank+1 раундов
+        # для пользователей впереди и rank раундов для остальных
+        ahead = 0
+        for index, user_id in enumerate(users):
+            if index == own_index:
+                continue
+            rounds = rank + 1 if index < own_index else rank
+            ahead += min(len(queue.waiters[user_id]), rounds)
+        return ahead + rank + 1
+
+    async def wait(self, ticket: Ticket) -> AsyncIterator[int]:
+        """Ожидает выдачи слота, отдавая позицию в очереди при каждом ее изменении"""
+        last_position = None
+        while not ticket.granted.done():
+            position = self.position(ticket)
+            if position is not None and position != last_position:
+                last_position = position
+                yield position
+            try:
+                await asyncio.wait_for(asyncio.shield(ticket.granted), timeout=self.position_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    @asynccontextmanager
+    async def slot(self, model: str, user_id: Optional[str]) -> AsyncIterator[Ticket]:
+        """Занимает слот модели на время выполнения блока"""
+        ticket = self.submit(model, user_id)
+        try:
+            async for _ in self.wait(ticket):
+                pass
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            model: {
+                "limit": queue.limit,
+                "active": queue.active,
+                "queued": queue.queued,
+                "waiting_users": len(queue.waiters),
+                "admitted_total": queue.admitted_total,
+                "rejected_total": queue.rejected_total,
+                "avg_service_seconds": round(queue.avg_service_time, 2) if queue.avg_service_time is not None else None,
+            }
+            for model, queue in self._queues.items()
+        }
+
+
+model_scheduler = ModelScheduler(
+    default_limit=settings.OLLAMA_MODEL_CONCURRENCY,
+    max_queue=settings.OLLAMA_MODEL_QUEUE_SIZE,
+    limits=parse_model_limits(settings.OLLAMA_MODEL_CONCURRENCY_OVERRIDES),
+    large_model_limit=settings.OLLAMA_LARGE_MODEL_CONCURRENCY,
+)
@@ -0,0 +1,320 @@
+"""Семантический поиск по истории чатов: векторный индекс сообщений каждого пользователя в памяти"""
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from array import array
+import asyncio
+import heapq
+import logging
+import math
+import time
+
+from fastapi import HTTPException
+from sqlalchemy import select
+
+from app.core.config import settings
+from app.database.db import SessionLocal
+from app.models.chat import ChatMessage, ChatSession
+from app.services.model_registry import model_registry
+from app.services.ollama_service import embed_texts
+
+logger = logging.getLogger(__name__)
+
+try:
+    # С numpy поиск - одно матричное умножение
+    import numpy as np
+
+    VECTOR_BACKEND = "numpy"
+except ImportError:  # pragma: no cover - зависит от окружения
+    np = None
+    VECTOR_BACKEND = "python"
+
+# Начальная емкость матрицы индекса (строк); при заполнении удваивается
+INITIAL_CAPACITY = 1024
+
+# Без numpy поиск перебирает векторы в Python: индексы больше этого не строятся
+PYTHON_BACKEND_MAX_VECTORS = 5000
+
+# (id сообщения, id сессии, текст)
+IndexedMessage = Tuple[str, str, str]
+
+
+def normalize(vector: Sequence[float]) -> array:
+    """Вектор единичной длины: косинусная близость сводится к скалярному произведению"""
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return array("f", (value / norm for value in vector))
+
+
+class UserVectorIndex:
+    """
+    Векторы сообщений одного пользователя: плотная матрица float32 нормированных строк
+    и позиция каждого сообщения в ней. Добавление - запись в конец, удаление -
+    перенос последней строки на место удаленной, поэтому матрица всегда без дыр.
+    """
+
+    def __init__(self, dimensions: int):
+        self.dimensions = dimensions
+        self.message_ids: List[str] = []
+        self.session_ids: List[str] = []
+        self.positions: Dict[str, int] = {}
+        if np is not None:
+            self._matrix = np.zeros((INITIAL_CAPACITY, dimensions), dtype=np.float32)
+        else:
+            self._rows: List[array] = []
+
+    def __len__(self) -> int:
+        return len(self.message_ids)
+
+    def _set_row(self, position: int, vector: Sequence[float]) -> None:
+        if np is not None:
+            if position >= self._matrix.shape[0]:
+                grown = np.zeros((self._matrix.shape[0] * 2, self.dimensions), dtype=np.float32)
+                grown[:position] = self._matrix[:position]
+                self._matrix = grown
+            row = np.asarray(vector, dtype=np.float32)
+            self._matrix[position] = row / (np.linalg.norm(row) or 1.0)
+            return
+        vector = normalize(vector)
+        if position == len(self._rows):
+            self._rows.append(vector)
+        else:
+            self._rows[position] = vector
+
+    def add(self, message_id: str, session_id: str, vector: Sequence[float]) -> None:
+        """Добавляет сообщение или заменяет его вектор"""
+        position = self.positions.get(message_id)
+        if position is None:
+            position = len(self.message_ids)
+            self.positions[message_id] = position
+            self.message_ids.append(message_id)
+            self.session_ids.append(session_id)
+        self._set_row(position, vector)
+
+    def remove(self, message_id: str) -> bool:
+        position = self.positions.pop(message_id, None)
+        if position is None:
+            return False
+        last = len(self.message_ids) - 1
+        if position != last:
+            moved_id = self.message_ids[last]
+            self.message_ids[position] = moved_id
+            self.session_ids[position] = self.session_ids[last]
+            self.positions[moved_id] = position
+            if np is not None:
+                self._matrix[position] = self._matrix[last]
+            else:
+                self._rows[position] = self._rows[last]
+        self.message_ids.pop()
+        self.session_ids.pop()
+        if np is None:
+            self._rows.pop()
+        return True
+
+    def remove_session(self, session_id: str) -> int:
+        message_ids = [
+            message_id for message_id, owner in zip(self.message_ids, self.session_ids) if owner == session_id
+        ]
+        for message_id in message_ids:
+            self.remove(message_id)
+        return len(message_ids)
+
+    def search(self, vector: Sequence[float], limit: int) -> List[Tuple[str, str, float]]:
+        """Ближайшие сообщения: (id сообщения, id сессии, косинусная близость)"""
+        count = len(self.message_ids)
+        if count == 0 or limit <= 0:
+            return []
+        query = normalize(vector)
+
+        if np is not None:
+            scores = self._matrix[:count] @ np.asarray(query, dtype=np.float32)
+            if limit < count:
+                # Частичная сортировка: O(n) вместо O(n log n)
+                top = np.argpartition(-scores, limit)[:limit]
+            else:
+                top = np.arange(count)
+            best = sorted(((float(scores[i]), int(i)) for i in top), reverse=True)
+        else:
+            best = heapq.nlargest(
+                limit,
+                ((sum(a * b for a, b in zip(row, query)), i) for i, row in enumerate(self._rows))
+            )
+        return [(self.message_ids[i], self.session_ids[i], score) for score, i in best]
+
+
+def _load_user_messages(user_id: str) -> List[IndexedMessage]:
+    """Все непустые сообщения пользователя для построения индекса"""
+    with SessionLocal() as db:
+        rows = db.execute(
+            select(ChatMessage.id, ChatMessage.session_id, ChatMessage.content)
+            .join(ChatSession, ChatSession.id == ChatMessage.session_id)
+            .where(ChatSession.user_id == user_id)
+        ).all()
+    return [(message_id, session_id, content) for message_id, session_id, content in rows if content and content.strip()]
+
+
+def _load_messages(message_ids: List[str]) -> Dict[str, ChatMessage]:
+    with SessionLocal() as db:
+        messages = db.execute(select(ChatMessage).where(ChatMessage.id.in_(message_ids))).scalars().all()
+        return {message.id: message for message in messages}
+
+
+class SemanticIndex:
+    """
+    Индексы пользователей в памяти. Индекс строится при первом поиске пользователя
+    (векторы берутся из кэша эмбеддингов, поэтому повторная сборка почти не обращается к Ollama),
+    дальше он обновляется фоновыми задачами при записи и удалении сообщений.
+    Поиск не читает таблицу сообщений: БД запрашивается только по id найденных.
+    """
+
+    def __init__(self, model: str, enabled: bool = True, max_users: int = 100):
+        self.model = model
+        self.enabled = enabled
+        self.max_users = max_users
+        self._users: Dict[str, UserVectorIndex] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._last_used: Dict[str, float] = {}
+        self._stats = {
+            "indexed_total": 0, "removed_total": 0, "index_errors": 0, "index_skipped": 0, "builds": 0, "searches": 0
+        }
+
+    def _lock(self, user_id: str) -> asyncio.Lock:
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        return lock
+
+    def _evict(self) -> None:
+        """Выгружает индексы пользователей, дольше всех не искавших"""
+        while len(self._users) > self.max_users:
+            user_id = min(self._users, key=lambda uid: self._last_used.get(uid, 0.0))
+            del self._users[user_id]
+            self._last_used.pop(user_id, None)
+
+    async def _embed(self, user_id: str, messages: List[IndexedMessage]) -> List[array]:
+        vectors: List[array] = []
+        # Не больше OLLAMA_EMBED_MAX_TEXTS текстов за раз, чтобы не держать все в одном запросе
+        step = max(1, settings.OLLAMA_EMBED_MAX_TEXTS)
+        for start in range(0, len(messages), step):
+            chunk = messages[start:start + step]
+            chunk_vectors, _, _ = await embed_texts(self.model, [content for _, _, content in chunk], user_id)
+            vectors.extend(chunk_vectors)
+        return vectors
+
+    async def _build(self, user_id: str) -> Optional[UserVectorIndex]:
+        started = time.monotonic()
+        messages = await asyncio.to_thread(_load_user_messages, user_id)
+        if np is None and len(messages) > PYTHON_BACKEND_MAX_VECTORS:
+            raise HTTPException(
+                status_code=503,
+                detail=f"Search index of {len(messages)} messages requires numpy (limit without it: {PYTHON_BACKEND_MAX_VECTORS})"
+            )
+        vectors = await self._embed(user_id, messages)
+        if not vectors:
+            return None
+        index = UserVectorIndex(len(vectors[0]))
+        for (message_id, session_id, _), vector in zip(messages, vectors):
+            index.add(message_id, session_id, vector)
+        self._stats["builds"] += 1
+        logger.info(f"Индекс поиска пользователя {user_id}: {len(index)} сообщений за {time.monotonic() - started:.2f}s")
+        return index
+
+    async def index_messages(self, user_id: str, messages: List[IndexedMessage]) -> None:
+        """Фоновая задача: считает векторы новых сообщений и добавляет их в индекс"""
+        messages = [message for message in messages if message[2] and message[2].strip()]
+        if not self.enabled or not messages:
+            return
+        if await model_registry.is_available(self.model) is False:
+            # Модели эмбеддингов нет: не отправляем заведомо неудачный запрос на каждую запись
+            self._stats["index_skipped"] += len(messages)
+            return
+        try:
+            # Вектор попадает в кэш эмбеддингов, даже если индекс пользователя еще не построен
+            vectors = await self._embed(user_id, messages)
+        except HTTPException as error:
+            self._stats["index_errors"] += 1
+            logger.warning(f"Не удалось проиндексировать сообщения для поиска: {error.detail}")
+            return
+
+        async with self._lock(user_id):
+            index = self._users.get(user_id)
+            if index is None:
+                return
+            if vectors and len(vectors[0]) != index.dimensions:
+                # Сменилась модель эмбеддингов: индекс будет построен заново при поиске
+                del self._users[user_id]
+                return
+            if np is None and len(index) + len(messages) > PYTHON_BACKEND_MAX_VECTORS:
+                # Индекс перерос перебор в Python: следующий поиск откажет при сборке
+                del self._users[user_id]
+                return
+            for (message_id, session_id, _), vector in zip(messages, vectors):
+                index.add(message_id, session_id, vector)
+            self._stats["indexed_total"] += len(messages)
+
+    async def remove_messages(self, user_id: str, message_ids: List[str]) -> None:
+        async with self._lock(user_id):
+            index = self._users.get(user_id)
+            if index is not None:
+                self._stats["removed_total"] += sum(1 for message_id in message_ids if index.remove(message_id))
+
+    async def remove_session(self, user_id: str, session_id: str) -> None:
+        async with self._lock(user_id):
+            index = self._users.get(user_id)
+            if index is not None:
+                self._stats["removed_total"] += index.remove_session(session_id)
+
+    async def replace_session(self, user_id: str, session_id: str, messages: List[IndexedMessage]) -> None:
+        """Фоновая задача после полной перезаписи сообщений сессии"""
+        await self.remove_session(user_id, session_id)
+        await self.index_messages(user_id, messages)
+
+    async def search(self, user_id: str, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """Сообщения пользователя, ближайшие по смыслу к запросу"""
+        if not self.enabled:
+            raise HTTPException(status_code=503, detail="Semantic search is disabled")
+
+        query_vectors, _, _ = await embed_texts(self.model, [query], user_id)
+        async with self._lock(user_id):
+            index = self._users.get(user_id)
+            if index is None:
+                index = await self._build(user_id)
+                if index is None:
+                    return []
+                self._users[user_id] = index
+            self._last_used[user_id] = time.monotonic()
+            self._evict()
+            if len(query_vectors[0]) != index.dimensions:
+                raise HTTPException(status_code=409, detail="Search index was built with a different embedding model")
+            hits = index.search(query_vectors[0], limit)
+        self._stats["searches"] += 1
+
+        messages = await asyncio.to_thread(_load_messages, [message_id for message_id, _, _ in hits])
+        results = []
+        for message_id, session_id, score in hits:
+            message = messages.get(message_id)
+            if message is None:
+                continue
+            results.append({
+                "message_id": message_id,
+                "session_id": session_id,
+                "role": message.role,
+                "content": message.content,
+                "timestamp": message.timestamp.isoformat(),
+                "score": round(score, 4),
+            })
+        return results
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "model": self.model,
+            "backend": VECTOR_BACKEND,
+            "users_loaded": len(self._users),
+            "messages_indexed": sum(len(index) for index in self._users.values()),
+            **self._stats,
+        }
+
+
+semantic_index = SemanticIndex(
+    model=settings.OLLAMA_SEARCH_EMBED_MODEL,
+    enabled=settings.OLLAMA_SEARCH_ENABLED,
+    max_users=settings.OLLAMA_SEARCH_MAX_USERS,
+)
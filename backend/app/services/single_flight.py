@@ -0,0 +1,206 @@
+"""Объединение одинаковых одновременных запросов генерации (single-flight)"""
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set
+import asyncio
+import hashlib
+import io
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Сколько живых фрагментов ждет медленного подписчика, прежде чем он перейдет на снимок текста
+SUBSCRIBER_QUEUE_SIZE = 256
+
+
+def request_key(model: str, messages: List[Dict[str, Any]], options: Optional[Dict[str, Any]] = None) -> str:
+    """Хеш запроса: одинаковые модель, сообщения и параметры дают одинаковый ключ"""
+    payload = json.dumps(
+        {"model": model, "messages": messages, "options": options or {}},
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class Subscription:
+    """
+    Ограниченная очередь живых фрагментов одного подписчика.
+    None в очереди будит подписчика: генерация закончилась или надо догнать по снимку.
+    """
+
+    def __init__(self):
+        self.queue: "asyncio.Queue[Optional[Dict[str, Any]]]" = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        # Сколько символов ответа подписчик уже получил
+        self.offset = 0
+        # Очередь переполнилась (или подписчик только подключился): догнать по снимку текста
+        self.lagged = True
+
+    def put(self, chunk: Optional[Dict[str, Any]]) -> None:
+        if self.lagged:
+            return
+        try:
+            self.queue.put_nowait(chunk)
+        except asyncio.QueueFull:
+            # Медленный подписчик: выбрасываем очередь, он догонит по снимку
+            self.lagged = True
+            self.clear()
+            self.queue.put_nowait(None)
+
+    def clear(self) -> None:
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+
+class Flight:
+    """
+    Одна выполняющаяся генерация и ее подписчики. Вместо списка фрагментов
+    хранится снимок текста ответа и поля последнего фрагмента: память не растет
+    с числом фрагментов, а подключившийся позже получает все одним фрагментом.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self._text = io.StringIO()
+        self.length = 0
+        self.last: Dict[str, Any] = {}
+        self.final: Optional[Dict[str, Any]] = None
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscriptions: Set[Subscription] = set()
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def subscribers(self) -> int:
+        return len(self.subscriptions)
+
+    def text(self) -> str:
+        return self._text.getvalue()
+
+    def publish(self, chunk: Dict[str, Any]) -> None:
+        # Позиция в очереди относится к ожиданию слота и в снимок не попадает
+        if not chunk.get("queued"):
+            if chunk["content"]:
+                self._text.write(chunk["content"])
+                self.length += len(chunk["content"])
+            self.last = {name: value for name, value in chunk.items() if name != "content"}
+            if chunk["done"]:
+                self.final = chunk
+        for subscription in self.subscriptions:
+            subscription.put(chunk)
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self.done = True
+        self.error = error
+        for subscription in self.subscriptions:
+            subscription.put(None)
+
+    def catch_up(self, subscription: Subscription) -> List[Dict[str, Any]]:
+        """Фрагменты, которых подписчику не хватает до текущего снимка"""
+        # В очереди может остаться только пробуждение, снимок его заменяет
+        subscription.clear()
+        subscription.lagged = False
+        chunks = []
+        if self.length > subscription.offset:
+            content = self.text()[subscription.offset:]
+            subscription.offset = self.length
+            chunks.append({**self.last, "content": content, "done": False})
+        if self.final is not None:
+            # Текст последнего фрагмента уже вошел в снимок
+            chunks.append({**self.final, "content": ""})
+        return chunks
+
+
+class SingleFlight:
+    """
+    Если такой же запрос уже выполняется, новый запрос подключается к нему:
+    одним фрагментом получает уже сгенерированный текст и дальше - те же
+    фрагменты, что и первый запрос. Генерация в Ollama выполняется один раз.
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+        self.flights_total = 0
+        self.coalesced_total = 0
+        self.resyncs_total = 0
+
+    async def _produce(self, flight: Flight, producer: Callable[[], AsyncIterator[Dict[str, Any]]]) -> None:
+        try:
+            async for chunk in producer():
+                flight.publish(chunk)
+            flight.finish()
+        except asyncio.CancelledError:
+            flight.finish(asyncio.CancelledError())
+            raise
+        except Exception as error:
+            flight.finish(error)
+        finally:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    async def subscribe(
+        self,
+        key: str,
+        producer: Callable[[], AsyncIterator[Dict[str, Any]]]
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Отдает фрагменты генерации по ключу, запуская ее только если она еще не идет"""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = Flight(key)
+            flight.task = asyncio.create_task(self._produce(flight, producer))
+            self.flights_total += 1
+        else:
+            self.coalesced_total += 1
+            logger.info(f"Запрос присоединен к уже выполняющейся генерации {key[:12]}")
+
+        subscription = Subscription()
+        flight.subscriptions.add(subscription)
+        try:
+            while True:
+                if subscription.lagged:
+                    if subscription.offset:
+                        self.resyncs_total += 1
+                    # Между снимком и подпиской на живые фрагменты нет await: ничего не теряется
+                    chunks = flight.catch_up(subscription)
+                    # Закончилась ли генерация к моменту снимка: пока отдаем его, она может закончиться
+                    finished = flight.done
+                    for chunk in chunks:
+                        yield chunk
+                        if chunk["done"]:
+                            return
+                    if finished:
+                        if flight.error is not None:
+                            raise flight.error
+                        return
+                    continue
+                chunk = await subscription.queue.get()
+                if chunk is None:
+                    if subscription.lagged:
+                        continue
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                if not chunk.get("queued"):
+                    subscription.offset += len(chunk["content"])
+                yield chunk
+                if chunk["done"]:
+                    return
+        finally:
+            flight.subscriptions.discard(subscription)
+            # Ответ больше никому не нужен - останавливаем генерацию
+            if not flight.subscriptions and not flight.done and flight.task is not None:
+                flight.task.cancel()
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._flights),
+            "subscribers": sum(flight.subscribers for flight in self._flights.values()),
+            "flights_total": self.flights_total,
+            "coalesced_total": self.coalesced_total,
+            "resyncs_total": self.resyncs_total,
+        }
+
+
+single_flight = SingleFlight()
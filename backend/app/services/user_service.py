@@ -1,35 +1,41 @@
-from sqlmodel import Session, select
+from sqlmodel import select
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
+from app.models.chat import ChatMessage, ChatSession
+from app.models.job import GenerationJob
 from app.models.user import User
 from app.schemas.user import UserCreate, UserUpdate
 from datetime import datetime
+import asyncio
 
 class UserService:
-    def __init__(self, db: Session):
+    def __init__(self, db: AsyncSession):
         self.db = db
-    def get_users(self, skip: int = 0, limit: int = 100) -> List[User]:
+    async def get_users(self, skip: int = 0, limit: int = 100) -> List[User]:
         """Получить список пользователей"""
         statement = select(User).offset(skip).limit(limit)
-        return self.db.execute(statement).scalars().all()
-    
-    def get_user_by_id(self, user_id: str) -> Optional[User]:
+        return (await self.db.execute(statement)).scalars().all()
+
+    async def get_user_by_id(self, user_id: str) -> Optional[User]:
         """Получить пользователя по ID"""
         statement = select(User).where(User.id == user_id)
-        return self.db.execute(statement).scalar_one_or_none()
-    
-    def get_user_by_email(self, email: str) -> Optional[User]:
+        return (await self.db.execute(statement)).scalar_one_or_none()
+
+    async def get_user_by_email(self, email: str) -> Optional[User]:
         """Получить пользователя по email"""
         statement = select(User).where(User.email == email)
-        return self.db.execute(statement).scalar_one_or_none()
-    
-    def get_user_by_username(self, username: str) -> Optional[User]:
+        return (await self.db.execute(statement)).scalar_one_or_none()
+
+    async def get_user_by_username(self, username: str) -> Optional[User]:
         """Получить пользователя по имени пользователя"""
         statement = select(User).where(User.username == username)
-        return self.db.execute(statement).scalar_one_or_none()
-    
-    def create_user(self, user_data: UserCreate) -> User:
+        return (await self.db.execute(statement)).scalar_one_or_none()
+
+    async def create_user(self, user_data: UserCreate) -> User:
         """Создать нового пользователя"""
-        hashed_password = User.hash_password(user_data.password)
+        # bcrypt занимает сотни миллисекунд процессора - не в цикле событий
+        hashed_password = await asyncio.to_thread(User.hash_password, user_data.password)
         user = User(
             email=user_data.email,
             username=user_data.username,
@@ -37,36 +43,41 @@ class UserService:
             full_name=user_data.full_name
         )
         self.db.add(user)
-        self.db.commit()
-        self.db.refresh(user)
+        await self.db.commit()
+        await self.db.refresh(user)
         return user
-    
-    def update_user(self, user_id: str, user_data: UserUpdate) -> Optional[User]:
+
+    async def update_user(self, user_id: str, user_data: UserUpdate) -> Optional[User]:
         """Обновить пользователя"""
-        user = self.get_user_by_id(user_id)
+        user = await self.get_user_by_id(user_id)
         if not user:
             return None
-            
+
         user_data_dict = user_data.model_dump(exclude_unset=True)
         if 'password' in user_data_dict:
-            user_data_dict['hashed_password'] = User.hash_password(user_data_dict.pop('password'))
-        
+            user_data_dict['hashed_password'] = await asyncio.to_thread(User.hash_password, user_data_dict.pop('password'))
+
         # Обновляем поля пользователя
         for field, value in user_data_dict.items():
             setattr(user, field, value)
-            
+
         user.updated_at = datetime.utcnow()
         self.db.add(user)
-        self.db.commit()
-        self.db.refresh(user)
+        await self.db.commit()
+        await self.db.refresh(user)
         return user
-    
-    def delete_user(self, user_id: str) -> bool:
-        """Удалить пользователя"""
-        user = self.get_user_by_id(user_id)
+
+    async def delete_user(self, user_id: str) -> bool:
+        """Удалить пользователя вместе с его сессиями, сообщениями и задачами генерации"""
+        user = await self.get_user_by_id(user_id)
         if not user:
             return False
-            
-        self.db.delete(user)
-        self.db.commit()
+
+        # Связанные записи удаляются запросами: ORM загружал бы их по одной
+        sessions = select(ChatSession.id).where(ChatSession.user_id == user_id)
+        await self.db.execute(delete(ChatMessage).where(ChatMessage.session_id.in_(sessions)))
+        await self.db.execute(delete(ChatSession).where(ChatSession.user_id == user_id))
+        await self.db.execute(delete(GenerationJob).where(GenerationJob.user_id == user_id))
+        await self.db.execute(delete(User).where(User.id == user_id))
+        await self.db.commit()
         return True
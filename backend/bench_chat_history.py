@@ -0,0 +1,101 @@
+"""
+Бенчмарк загрузки истории сессии: время get_session_messages при разном
+общем числе сообщений в таблице. С индексом (session_id, position) оно
+почти не должно расти вместе с таблицей.
+
+Прогон на временной базе SQLite:
+    python bench_chat_history.py
+    python bench_chat_history.py --sessions 100 1000 5000 --repeat 100
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from typing import List
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlmodel import SQLModel
+
+from app.database.db import create_async_db_engine, create_db_engine
+from app.models.chat import ChatMessage, ChatSession
+from app.models.job import GenerationJob  # noqa: F401 - таблица нужна create_all
+from app.models.user import User
+from app.services.chat_service import ChatService
+
+USER_ID = "bench-user"
+MESSAGES_PER_SESSION = 20
+
+
+def fill(engine, start: int, stop: int) -> None:
+    """Сессии с номерами [start, stop) по MESSAGES_PER_SESSION сообщений"""
+    now = datetime.now(timezone.utc)
+    with engine.begin() as connection:
+        connection.execute(insert(ChatSession.__table__), [
+            {"id": f"s{i}", "user_id": USER_ID, "title": f"Chat {i}", "model": "phi3",
+             "version": 0, "created_at": now, "updated_at": now - timedelta(seconds=i)}
+            for i in range(start, stop)
+        ])
+        connection.execute(insert(ChatMessage.__table__), [
+            {"id": f"s{i}-m{j}", "session_id": f"s{i}", "role": "user" if j % 2 == 0 else "assistant",
+             "content": f"message {j}", "position": j, "timestamp": now, "error": False, "attachments": None}
+            for i in range(start, stop)
+            for j in range(MESSAGES_PER_SESSION)
+        ])
+
+
+async def load_times(path: str, repeat: int) -> List[float]:
+    """Время загрузки истории одной сессии, repeat замеров"""
+    async_engine = create_async_db_engine(f"sqlite:///{path}")
+    Session = async_sessionmaker(async_engine, expire_on_commit=False, autoflush=False)
+    timings = []
+    async with Session() as db:
+        service = ChatService(db)
+        for _ in range(repeat):
+            start = time.perf_counter()
+            messages = await service.get_session_messages("s0")
+            timings.append(time.perf_counter() - start)
+            assert len(messages) == MESSAGES_PER_SESSION
+    await async_engine.dispose()
+    return timings
+
+
+def run(sizes: List[int], repeat: int) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        engine = create_db_engine(f"sqlite:///{path}")
+        SQLModel.metadata.create_all(engine)
+        with engine.begin() as connection:
+            now = datetime.now(timezone.utc)
+            connection.execute(insert(User.__table__), [
+                {"id": USER_ID, "email": "bench@example.com", "username": "bench", "hashed_password": "-",
+                 "is_active": True, "is_admin": False, "created_at": now, "updated_at": now},
+            ])
+
+        filled = 0
+        for sessions in sorted(sizes):
+            fill(engine, filled, sessions)
+            filled = sessions
+            timings = asyncio.run(load_times(path, repeat))
+            print(
+                f"  {sessions * MESSAGES_PER_SESSION:>10,} messages  "
+                f"median {statistics.median(timings) * 1000:>7.2f} ms  "
+                f"p95 {statistics.quantiles(timings, n=20)[-1] * 1000:>7.2f} ms"
+            )
+        engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк загрузки истории сессии")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+    run(args.sessions, args.repeat)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
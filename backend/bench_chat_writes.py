@@ -0,0 +1,137 @@
+"""
+Бенчмарк записи сообщений чата: сравнивает прежнюю запись по одному сообщению
+(SELECT счетчика, SELECT сессии и commit на каждое) с пакетными методами ChatService
+(многострочный INSERT, DELETE по session_id, одно обновление сессии, одна транзакция).
+
+Прогон на временной базе SQLite с полнотекстовым индексом, как у приложения:
+    python bench_chat_writes.py
+    python bench_chat_writes.py --sizes 10 1000 10000 --legacy-max 1000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, List
+from uuid import uuid4
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlmodel import SQLModel
+
+from app.database.db import create_async_db_engine, create_db_engine
+from app.database.fts import setup_message_fts
+from app.models.chat import ChatMessage, ChatSession
+from app.models.user import User
+from app.schemas.chat import ChatSessionCreate, MessageCreate
+from app.services.chat_service import ChatService
+
+USER_ID = "bench-user"
+
+
+def make_messages(count: int) -> List[MessageCreate]:
+    return [
+        MessageCreate(role="user" if i % 2 == 0 else "assistant", content=f"Сообщение номер {i}: " + "текст " * 20)
+        for i in range(count)
+    ]
+
+
+async def legacy_add_messages(db, session_id: str, messages: List[MessageCreate]) -> None:
+    """Прежний путь: каждое сообщение - отдельная транзакция с двумя SELECT"""
+    for message_data in messages:
+        position = (await db.execute(
+            select(func.count()).select_from(ChatMessage).where(ChatMessage.session_id == session_id)
+        )).scalar_one()
+        db.add(ChatMessage(
+            id=str(uuid4()),
+            session_id=session_id,
+            role=message_data.role,
+            content=message_data.content,
+            position=position,
+            timestamp=message_data.timestamp or datetime.utcnow(),
+            error=message_data.error or False,
+            attachments=message_data.attachments
+        ))
+        session = (await db.execute(select(ChatSession).where(ChatSession.id == session_id))).scalar_one()
+        session.updated_at = datetime.utcnow()
+        session.version += 1
+        await db.commit()
+
+
+async def legacy_delete_session(db, session_id: str) -> None:
+    """Прежний путь: загрузка и удаление каждого сообщения через ORM"""
+    for message in (await db.execute(select(ChatMessage).where(ChatMessage.session_id == session_id))).scalars().all():
+        await db.delete(message)
+    await db.delete((await db.execute(select(ChatSession).where(ChatSession.id == session_id))).scalar_one())
+    await db.commit()
+
+
+async def measure(name: str, count: int, run: Callable[[], Awaitable[object]]) -> None:
+    start = time.perf_counter()
+    await run()
+    elapsed = time.perf_counter() - start
+    print(f"  {name:<32} {count / elapsed:>12,.0f} rows/sec  ({elapsed * 1000:,.1f} ms)")
+
+
+async def run_size(Session, count: int, legacy: bool) -> None:
+    messages = make_messages(count)
+    print(f"{count} messages")
+
+    async with Session() as db:
+        service = ChatService(db)
+
+        if legacy:
+            session = await service.create_session(USER_ID, ChatSessionCreate(title="legacy", model="phi3"))
+            session_id = session.id
+            await measure("insert: per-row commit", count, lambda: legacy_add_messages(db, session_id, messages))
+            await measure("delete: per-row ORM", count, lambda: legacy_delete_session(db, session_id))
+
+        created = {}
+
+        async def create() -> None:
+            created["session"] = await service.create_session(
+                USER_ID, ChatSessionCreate(title="bulk", model="phi3", messages=messages)
+            )
+
+        await measure("insert: create_session (bulk)", count, create)
+        session_id = created["session"].id
+        await measure("replace: replace_session_messages", count, lambda: service.replace_session_messages(session_id, messages))
+        await measure("delete: delete_session (bulk)", count, lambda: service.delete_session(session_id))
+
+
+async def run(sizes: List[int], legacy_max: int) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        # Схема и полнотекстовый индекс создаются синхронно, как в init_db
+        # Движки с теми же пулом и PRAGMA, что у приложения
+        engine = create_db_engine(f"sqlite:///{path}")
+        SQLModel.metadata.create_all(engine)
+        setup_message_fts(engine)
+        engine.dispose()
+
+        async_engine = create_async_db_engine(f"sqlite:///{path}")
+        Session = async_sessionmaker(async_engine, expire_on_commit=False, autoflush=False)
+        async with Session() as db:
+            db.add(User(id=USER_ID, email="bench@example.com", username="bench", hashed_password="-"))
+            await db.commit()
+
+        for count in sizes:
+            await run_size(Session, count, legacy=count <= legacy_max)
+        await async_engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк записи сообщений чата")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 10000])
+    parser.add_argument(
+        "--legacy-max", type=int, default=10000,
+        help="Не запускать прежний путь для пачек больше этого размера (он медленный)"
+    )
+    args = parser.parse_args()
+    asyncio.run(run(args.sizes, args.legacy_max))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""
+Микро-бенчмарк разбора потока Ollama: воспроизводит записанные NDJSON-потоки
+и сравнивает скорость (фрагментов в секунду) старого построчного разбора
+и NDJSONDecoder с доступными JSON-бэкендами.
+
+Запись потока настоящей Ollama:
+    python bench_ndjson.py --record stream.ndjson --model phi3 --prompt "Tell me a story"
+
+Прогон на записанных потоках (без аргументов - на синтетическом потоке):
+    python bench_ndjson.py stream.ndjson other.ndjson
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+from typing import Callable, Iterable, List
+
+import httpx
+
+from app.services.ndjson import NDJSONDecoder, JSON_BACKEND
+
+OLLAMA_API_URL = "http://localhost:11434"
+
+# Размер кусков, которыми поток "приходит из сети"
+NETWORK_CHUNK_SIZE = 1024
+
+
+def record_stream(path: str, model: str, prompt: str) -> None:
+    """Сохраняет сырой поток /api/chat в файл"""
+    payload = {"model": model, "messages": [{"role": "user", "content": prompt}], "stream": True}
+    with httpx.stream("POST", f"{OLLAMA_API_URL}/api/chat", json=payload, timeout=None) as response:
+        response.raise_for_status()
+        with open(path, "wb") as file:
+            for data in response.iter_raw():
+                file.write(data)
+    print(f"Поток записан в {path}")
+
+
+def synthetic_stream(tokens: int = 2000) -> bytes:
+    """Поток, похожий на ответ /api/chat: один токен во фрагменте"""
+    lines = [
+        json.dumps({
+            "model": "phi3:latest",
+            "created_at": "2024-01-01T00:00:00.000000Z",
+            "message": {"role": "assistant", "content": f" token{i}"},
+            "done": False,
+        })
+        for i in range(tokens)
+    ]
+    lines.append(json.dumps({"model": "phi3:latest", "message": {"role": "assistant", "content": ""}, "done": True, "eval_count": tokens}))
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def split_network_chunks(data: bytes) -> List[bytes]:
+    return [data[i:i + NETWORK_CHUNK_SIZE] for i in range(0, len(data), NETWORK_CHUNK_SIZE)]
+
+
+# Логгер с обработчиком на уровне INFO, как у приложения, но без вывода
+chunk_logger = logging.getLogger("bench_ndjson.chunks")
+chunk_logger.addHandler(logging.NullHandler())
+chunk_logger.propagate = False
+
+
+def parse_line_by_line(chunks: Iterable[bytes], log_every_chunk: bool = False) -> int:
+    """Прежний способ: декодирование в str, построчное деление, json.loads и конкатенация строк"""
+    text = ""
+    full_response = ""
+    count = 0
+    for data in chunks:
+        text += data.decode("utf-8")
+        *lines, text = text.split("\n")
+        for line in lines:
+            if not line.strip():
+                continue
+            if log_every_chunk:
+                chunk_logger.info(f"Received chunk: {line[:100]}...")
+            obj = json.loads(line)
+            full_response += obj.get("message", {}).get("content", "")
+            count += 1
+    return count
+
+
+def parse_with_decoder(loads: Callable[[bytes], object]) -> Callable[[Iterable[bytes]], int]:
+    def run(chunks: Iterable[bytes]) -> int:
+        decoder = NDJSONDecoder(loads)
+        parts = []
+        count = 0
+        for data in chunks:
+            for obj in decoder.feed(data):
+                parts.append(obj.get("message", {}).get("content", ""))
+                count += 1
+        count += len(decoder.flush())
+        "".join(parts)
+        return count
+    return run
+
+
+def benchmark(name: str, parser: Callable[[Iterable[bytes]], int], chunks: List[bytes], repeat: int) -> None:
+    start = time.perf_counter()
+    total = 0
+    for _ in range(repeat):
+        total += parser(chunks)
+    elapsed = time.perf_counter() - start
+    print(f"  {name:<28} {total / elapsed:>12,.0f} chunks/sec")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк разбора NDJSON-потока Ollama")
+    parser.add_argument("files", nargs="*", help="Записанные потоки (.ndjson)")
+    parser.add_argument("--record", help="Записать поток Ollama в файл и выйти")
+    parser.add_argument("--model", default="phi3")
+    parser.add_argument("--prompt", default="Tell me a long story")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    if args.record:
+        record_stream(args.record, args.model, args.prompt)
+        return
+
+    streams = [(path, open(path, "rb").read()) for path in args.files] or [("synthetic", synthetic_stream())]
+
+    chunk_logger.setLevel(logging.INFO)
+    parsers = [
+        ("line-by-line + INFO log", lambda chunks: parse_line_by_line(chunks, log_every_chunk=True)),
+        ("line-by-line + json", parse_line_by_line),
+        ("NDJSONDecoder + json", parse_with_decoder(lambda line: json.loads(line.decode("utf-8")))),
+    ]
+    if JSON_BACKEND != "json":
+        from app.services.ndjson import json_loads
+        parsers.append((f"NDJSONDecoder + {JSON_BACKEND}", parse_with_decoder(json_loads)))
+
+    for name, data in streams:
+        chunks = split_network_chunks(data)
+        print(f"{name}: {len(data):,} bytes, {len(chunks)} network chunks")
+        for parser_name, parse in parsers:
+            benchmark(parser_name, parse, chunks, args.repeat)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
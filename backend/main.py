@@ -4,9 +4,15 @@ import logging
 import time
 
 from app.api.api import api_router
-from app.database.db import init_db
+from app.database.db import init_db, async_engine
 from app.core.config import settings
-from app.services.ollama_service import test_connection
+from app.services.ollama_client import get_backend_pool
+from app.services.model_registry import model_registry
+from app.services.health_monitor import health_monitor
+from app.services.response_cache import response_cache
+from app.services.residency import residency_manager
+from app.services.job_service import generation_jobs
+from app.services.embedding_store import embedding_store
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -49,26 +55,32 @@ async def log_requests(request: Request, call_next):
 # Подключение роутеров API
 app.include_router(api_router, prefix="/api/v1")
 
-# Add status endpoint directly to avoid authentication requirements
-@app.get("/api/v1/ollama/status", tags=["ollama"])
-async def check_status():
-    """
-    Проверяет статус подключения к Ollama.
-    Эта конечная точка доступна без аутентификации для проверки доступности.
-    """
-    try:
-        is_connected = await test_connection()
-        return {"status": "connected" if is_connected else "disconnected"}
-    except Exception as e:
-        # Логируем ошибку, но всегда возвращаем 200 статус код
-        logger.error(f"Ошибка проверки статуса Ollama: {e}")
-        return {"status": "disconnected", "error": str(e)}
-
 # Инициализация базы данных при запуске приложения
 @app.on_event("startup")
 def startup_db_client():
     init_db()
 
+# Открываем общий пул соединений с Ollama
+@app.on_event("startup")
+async def startup_ollama_client():
+    await get_backend_pool().start()
+    await model_registry.start()
+    await health_monitor.start()
+    await residency_manager.start()
+    await generation_jobs.start()
+
+# Закрываем пул соединений с Ollama при остановке
+@app.on_event("shutdown")
+async def shutdown_ollama_client():
+    await generation_jobs.stop()
+    await residency_manager.stop()
+    await health_monitor.stop()
+    await model_registry.stop()
+    await get_backend_pool().close()
+    await async_engine.dispose()
+    response_cache.close()
+    embedding_store.close()
+
 @app.get("/")
 async def root():
     return {"message": "Welcome to Ollama Chat API!"}
@@ -0,0 +1,172 @@
+"""
+Заглушка Ollama API для локальной проверки бэкенда без настоящих моделей.
+
+Запуск нескольких экземпляров для проверки балансировки:
+    python stub_ollama.py --port 11435 --models phi3:latest,llama3:latest --loaded phi3:latest
+    python stub_ollama.py --port 11436 --models phi3:latest --delay 0.05
+
+Затем в .env: OLLAMA_API_URLS=http://localhost:11435,http://localhost:11436
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+from typing import Any, Dict, List
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def create_stub_app(name: str, models: List[str], loaded: List[str], delay: float, tokens: int) -> FastAPI:
+    """Создает приложение, отвечающее как Ollama"""
+    app = FastAPI(title=f"Ollama stub {name}")
+    app.state.calls: Dict[str, int] = {}
+    app.state.last_generate = None
+
+    def count(endpoint: str) -> None:
+        app.state.calls[endpoint] = app.state.calls.get(endpoint, 0) + 1
+
+    def model_not_found(model: str) -> JSONResponse:
+        return JSONResponse({"error": f"model \"{model}\" not found, try pulling it first"}, status_code=404)
+
+    def has_model(model: str) -> bool:
+        return model in models or f"{model}:latest" in models
+
+    @app.get("/api/version")
+    async def version():
+        count("version")
+        return {"version": "0.0.0-stub"}
+
+    def parameter_size(model: str) -> str:
+        """Размер модели из тега, например 'llama3:70b' -> '70B'"""
+        tag = model.split(":")[-1].upper()
+        return tag if tag[:-1].replace(".", "").isdigit() and tag.endswith("B") else "3.8B"
+
+    @app.get("/api/tags")
+    async def tags():
+        count("tags")
+        return {"models": [
+            {
+                "name": model,
+                "model": model,
+                "digest": f"{name}-{model}",
+                "size": 0,
+                "details": {"parameter_size": parameter_size(model), "quantization_level": "Q4_0"},
+            }
+            for model in models
+        ]}
+
+    @app.post("/api/show")
+    async def show(request: Request):
+        count("show")
+        body: Dict[str, Any] = await request.json()
+        model = body.get("model") or body.get("name", "")
+        if not has_model(model):
+            return model_not_found(model)
+        size = parameter_size(model)
+        return {
+            "details": {"family": "llama", "parameter_size": size, "quantization_level": "Q4_0"},
+            "model_info": {
+                "general.parameter_count": int(float(size[:-1]) * 10**9),
+                "llama.context_length": 4096,
+            },
+        }
+
+    @app.get("/api/ps")
+    async def ps():
+        count("ps")
+        return {"models": [{"name": model, "model": model} for model in loaded]}
+
+    @app.get("/stub/calls")
+    async def calls():
+        """Счетчики запросов к заглушке"""
+        return {"name": name, "calls": app.state.calls, "last_generate": app.state.last_generate}
+
+    @app.post("/api/generate")
+    async def generate(request: Request):
+        count("generate")
+        body: Dict[str, Any] = await request.json()
+        if not has_model(body["model"]):
+            return model_not_found(body["model"])
+        prompt = body.get("prompt", "")
+        app.state.last_generate = {"prompt": prompt, "context": body.get("context")}
+        # Контекст растет как у настоящей Ollama: прошлый контекст + промпт + ответ
+        context = list(body.get("context") or []) + list(range(len(prompt.split()) + tokens))
+
+        async def chunks():
+            for i in range(tokens):
+                await asyncio.sleep(delay)
+                yield json.dumps({"model": body["model"], "response": f"token{i} ", "done": False}) + "\n"
+            yield json.dumps({"model": body["model"], "response": "", "done": True, "context": context, "prompt_eval_count": len(prompt.split()), "eval_count": tokens}) + "\n"
+
+        if body.get("stream", True):
+            return StreamingResponse(chunks(), media_type="application/x-ndjson")
+        await asyncio.sleep(delay * tokens)
+        return {
+            "model": body["model"],
+            "response": " ".join(f"token{i}" for i in range(tokens)),
+            "done": True,
+            "context": context,
+            "prompt_eval_count": len(prompt.split()),
+            "eval_count": tokens,
+        }
+
+    @app.post("/api/embed")
+    async def embed(request: Request):
+        count("embed")
+        body: Dict[str, Any] = await request.json()
+        if not has_model(body["model"]):
+            return model_not_found(body["model"])
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        app.state.calls["embed_texts"] = app.state.calls.get("embed_texts", 0) + len(texts)
+        # Один запрос на пакет, как у настоящей Ollama: задержка не зависит от размера пакета
+        await asyncio.sleep(delay)
+        # Детерминированные векторы из хеша текста
+        embeddings = [
+            [byte / 255.0 for byte in hashlib.sha256(text.encode("utf-8")).digest()[:8]]
+            for text in texts
+        ]
+        return {"model": body["model"], "embeddings": embeddings}
+
+    @app.post("/api/chat")
+    async def chat(request: Request):
+        count("chat")
+        body: Dict[str, Any] = await request.json()
+        if not has_model(body["model"]):
+            return model_not_found(body["model"])
+
+        async def chunks():
+            for i in range(tokens):
+                await asyncio.sleep(delay)
+                yield json.dumps({"model": body["model"], "message": {"role": "assistant", "content": f"token{i} "}, "done": False}) + "\n"
+            yield json.dumps({"model": body["model"], "message": {"role": "assistant", "content": ""}, "done": True, "eval_count": tokens}) + "\n"
+
+        if not body.get("stream", True):
+            await asyncio.sleep(delay * tokens)
+            content = "".join(f"token{i} " for i in range(tokens))
+            return {"model": body["model"], "message": {"role": "assistant", "content": content}, "done": True, "eval_count": tokens}
+        return StreamingResponse(chunks(), media_type="application/x-ndjson")
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Заглушка Ollama API")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--name", default=None)
+    parser.add_argument("--models", default="phi3:latest", help="Скачанные модели через запятую")
+    parser.add_argument("--loaded", default="", help="Модели, загруженные в память, через запятую")
+    parser.add_argument("--delay", type=float, default=0.02, help="Задержка между токенами (секунды)")
+    parser.add_argument("--tokens", type=int, default=20, help="Число токенов в ответе")
+    args = parser.parse_args()
+
+    stub_app = create_stub_app(
+        name=args.name or f"stub-{args.port}",
+        models=[model for model in args.models.split(",") if model],
+        loaded=[model for model in args.loaded.split(",") if model],
+        delay=args.delay,
+        tokens=args.tokens,
+    )
+    uvicorn.run(stub_app, host="127.0.0.1", port=args.port, log_level="warning")
@@ -0,0 +1,142 @@
+"""Test script to check Ollama backend pool routing against local stub servers"""
+import asyncio
+import logging
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+from app.services import ollama_client
+from app.services.ollama_client import OllamaBackendPool, OllamaClient
+from app.services.health_monitor import OllamaHealthMonitor
+from app.services.model_registry import ModelRegistry
+
+# Configure logging
+logging.basicConfig(level=logging.INFO,
+                  format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                  handlers=[logging.StreamHandler(sys.stdout)])
+logger = logging.getLogger(__name__)
+
+STUB_SCRIPT = Path(__file__).parent / "stub_ollama.py"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_stub(port: int, models: str, loaded: str = "") -> subprocess.Popen:
+    """Start stub_ollama.py and wait until it answers"""
+    process = subprocess.Popen([
+        sys.executable, str(STUB_SCRIPT), "--port", str(port),
+        "--models", models, "--loaded", loaded, "--delay", "0.05", "--tokens", "10",
+    ])
+    for _ in range(100):
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/api/version", timeout=0.5)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"Stub on port {port} did not start")
+
+
+async def call_counts(port: int) -> dict:
+    async with httpx.AsyncClient() as client:
+        response = await client.get(f"http://127.0.0.1:{port}/stub/calls")
+        return response.json()["calls"]
+
+
+async def check_pool(port_a: int, port_b: int) -> None:
+    backend_a = OllamaClient(f"http://127.0.0.1:{port_a}", eject_after_failures=2)
+    backend_b = OllamaClient(f"http://127.0.0.1:{port_b}", eject_after_failures=2)
+    pool = OllamaBackendPool([backend_a, backend_b])
+    original_pool = ollama_client.backend_pool
+    ollama_client.backend_pool = pool
+    try:
+        registry = ModelRegistry()
+        monitor = OllamaHealthMonitor()
+        await registry.refresh()
+        await monitor.probe()
+
+        # Affinity: phi3 is loaded only on A
+        assert pool.choose("phi3:latest") is backend_a, "phi3 should go to the backend that has it loaded"
+        logger.info("✅ Model affinity prefers the backend with the model loaded")
+
+        # Availability: mistral exists only on B
+        assert pool.choose("mistral:latest") is backend_b, "mistral should go to the only backend that has it"
+        logger.info("✅ Routing skips backends without the model")
+
+        # Least outstanding requests: llama3 is on both and loaded nowhere
+        async def generate() -> None:
+            client = pool.choose("llama3:latest")
+            async with client.stream("POST", "/api/chat", json={"model": "llama3:latest", "messages": []}) as response:
+                async for _ in response.aiter_lines():
+                    pass
+
+        await asyncio.gather(*(generate() for _ in range(6)))
+        chats_a = (await call_counts(port_a)).get("chat", 0)
+        chats_b = (await call_counts(port_b)).get("chat", 0)
+        assert chats_a == chats_b == 3, f"Expected an even split, got {chats_a}/{chats_b}"
+        logger.info("✅ Concurrent requests are spread by least outstanding requests")
+    finally:
+        ollama_client.backend_pool = original_pool
+        await pool.close()
+
+
+async def check_ejection(port_a: int, port_b: int) -> None:
+    backend_a = OllamaClient(f"http://127.0.0.1:{port_a}", eject_after_failures=2)
+    backend_b = OllamaClient(f"http://127.0.0.1:{port_b}", eject_after_failures=2)
+    pool = OllamaBackendPool([backend_a, backend_b])
+    original_pool = ollama_client.backend_pool
+    ollama_client.backend_pool = pool
+    try:
+        monitor = OllamaHealthMonitor()
+
+        # Nothing listens on B yet
+        await monitor.probe()
+        await monitor.probe()
+        assert not backend_b.healthy, "Unreachable backend should be ejected"
+        assert all(pool.choose() is backend_a for _ in range(5))
+        logger.info("✅ Unreachable backend is ejected from the pool")
+
+        stub_b = start_stub(port_b, "phi3:latest")
+        try:
+            await monitor.probe()
+            assert backend_b.healthy, "Backend should be re-admitted after a successful probe"
+            logger.info("✅ Recovered backend is re-admitted")
+        finally:
+            stub_b.kill()
+    finally:
+        ollama_client.backend_pool = original_pool
+        await pool.close()
+
+
+def test_backend_pool():
+    port_a, port_b = free_port(), free_port()
+    stub_a = start_stub(port_a, "phi3:latest,llama3:latest", loaded="phi3:latest")
+    stub_b = start_stub(port_b, "phi3:latest,llama3:latest,mistral:latest")
+    try:
+        asyncio.run(check_pool(port_a, port_b))
+    finally:
+        stub_a.kill()
+        stub_b.kill()
+
+
+def test_backend_ejection():
+    port_a, port_b = free_port(), free_port()
+    stub_a = start_stub(port_a, "phi3:latest")
+    try:
+        asyncio.run(check_ejection(port_a, port_b))
+    finally:
+        stub_a.kill()
+
+
+if __name__ == "__main__":
+    test_backend_pool()
+    test_backend_ejection()
+    logger.info("Backend pool checks passed")
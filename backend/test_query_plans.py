@@ -0,0 +1,213 @@
+"""Test script to check that chat history queries use indexes (SQLite EXPLAIN QUERY PLAN)"""
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Awaitable, Callable, List, Tuple
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import event, insert, inspect, text
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlmodel import SQLModel
+
+from app.core.config import settings
+from app.database.db import create_async_db_engine, create_db_engine
+from app.models.chat import ChatMessage, ChatSession
+from app.models.job import GenerationJob  # noqa: F401 - таблица нужна create_all
+from app.models.user import User
+from app.services.chat_service import ChatService
+
+# Configure logging
+logging.basicConfig(level=logging.INFO,
+                  format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                  handlers=[logging.StreamHandler(sys.stdout)])
+logger = logging.getLogger(__name__)
+
+ALEMBIC_DIR = Path(__file__).parent / "alembic"
+
+MESSAGES_INDEX = "ix_chatmessage_session_id_position"
+SESSIONS_INDEX = "ix_chatsession_user_id_updated_at"
+
+USER_ID = "plan-user"
+MESSAGES_PER_SESSION = 20
+
+
+def fill(engine, sessions: int) -> None:
+    """Сессии пользователей по MESSAGES_PER_SESSION сообщений; у USER_ID - каждая десятая"""
+    now = datetime.now(timezone.utc)
+    with engine.begin() as connection:
+        connection.execute(insert(User.__table__), [
+            {"id": USER_ID, "email": "plan@example.com", "username": "plan", "hashed_password": "-",
+             "is_active": True, "is_admin": False, "created_at": now, "updated_at": now},
+            {"id": "other", "email": "other@example.com", "username": "other", "hashed_password": "-",
+             "is_active": True, "is_admin": False, "created_at": now, "updated_at": now},
+        ])
+        connection.execute(insert(ChatSession.__table__), [
+            {"id": f"s{i}", "user_id": USER_ID if i % 10 == 0 else "other", "title": f"Chat {i}", "model": "phi3",
+             "version": 0, "created_at": now, "updated_at": now - timedelta(seconds=i)}
+            for i in range(sessions)
+        ])
+        connection.execute(insert(ChatMessage.__table__), [
+            {"id": f"s{i}-m{j}", "session_id": f"s{i}", "role": "user" if j % 2 == 0 else "assistant",
+             "content": f"message {j}", "position": j, "timestamp": now, "error": False, "attachments": None}
+            for i in range(sessions)
+            for j in range(MESSAGES_PER_SESSION)
+        ])
+
+
+async def capture_statements(path: str, run: Callable[[ChatService], Awaitable[object]]) -> List[Tuple[str, tuple]]:
+    """SQL, который ChatService на самом деле выполняет, с параметрами"""
+    statements: List[Tuple[str, tuple]] = []
+    async_engine = create_async_db_engine(f"sqlite:///{path}")
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith("PRAGMA"):
+            statements.append((statement, parameters))
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", record)
+    Session = async_sessionmaker(async_engine, expire_on_commit=False, autoflush=False)
+    try:
+        async with Session() as db:
+            await run(ChatService(db))
+    finally:
+        await async_engine.dispose()
+    return statements
+
+
+def query_plan(engine, statement: str, parameters: tuple) -> List[str]:
+    with engine.connect() as connection:
+        rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+    return [row[-1] for row in rows]
+
+
+def assert_no_scans(engine, statements: List[Tuple[str, tuple]]) -> None:
+    """Ни один запрос к таблицам чата не должен читать таблицу целиком"""
+    for statement, parameters in statements:
+        for step in query_plan(engine, statement, parameters):
+            assert not step.startswith(("SCAN chatmessage", "SCAN chatsession")), f"{step}\n{statement}"
+
+
+def check_history_plans(engine, path: str) -> None:
+    # Сообщения одной сессии: поиск по индексу, порядок берется из индекса без сортировки
+    statements = asyncio.run(capture_statements(path, lambda service: service.get_session_messages("s0")))
+    plan = query_plan(engine, *statements[0])
+    logger.info(f"get_session_messages: {plan}")
+    assert any(step.startswith("SEARCH chatmessage") and MESSAGES_INDEX in step for step in plan), plan
+    assert not any("TEMP B-TREE" in step for step in plan), plan
+
+    # Сессии пользователя от последних измененных: тоже без сортировки
+    statements = asyncio.run(capture_statements(path, lambda service: service.get_user_sessions(USER_ID)))
+    plan = query_plan(engine, *statements[0])
+    logger.info(f"get_user_sessions: {plan}")
+    assert any(step.startswith("SEARCH chatsession") and SESSIONS_INDEX in step for step in plan), plan
+    assert not any("TEMP B-TREE" in step for step in plan), plan
+    assert_no_scans(engine, statements)
+
+    # Подсчет, удаление и проверка версии сессии
+    async def writes(service: ChatService) -> None:
+        await service.count_session_messages("s10")
+        await service.delete_session("s10")
+
+    assert_no_scans(engine, asyncio.run(capture_statements(path, writes)))
+
+
+def test_query_plans():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "plans.db")
+        engine = create_db_engine(f"sqlite:///{path}")
+        SQLModel.metadata.create_all(engine)
+        fill(engine, 200)
+        check_history_plans(engine, path)
+        engine.dispose()
+
+
+INITIAL_REVISION = "5b0e7c1f9a42"
+
+
+def migrate(url: str, revision: str, downgrade: bool = False) -> None:
+    config = Config()
+    config.set_main_option("script_location", str(ALEMBIC_DIR))
+    # env.py берет адрес базы из настроек
+    database_url = settings.DATABASE_URL
+    settings.DATABASE_URL = url
+    try:
+        (command.downgrade if downgrade else command.upgrade)(config, revision)
+    finally:
+        settings.DATABASE_URL = database_url
+
+
+def fill_legacy(engine, sessions: int) -> None:
+    """Данные в схеме первой версии: без номеров сообщений и версии сессии"""
+    now = datetime.now(timezone.utc)
+    with engine.begin() as connection:
+        connection.execute(insert(User.__table__).values(
+            id=USER_ID, email="plan@example.com", username="plan", hashed_password="-",
+            is_active=True, is_admin=False, created_at=now, updated_at=now
+        ))
+        for i in range(sessions):
+            connection.execute(text(
+                "INSERT INTO chatsession (id, user_id, title, model, created_at, updated_at) "
+                "VALUES (:id, :user_id, 'Chat', 'phi3', :now, :updated_at)"
+            ), {"id": f"s{i}", "user_id": USER_ID, "now": now, "updated_at": now - timedelta(seconds=i)})
+        # Сообщения вставлены в обратном порядке: номера должны получиться по времени
+        connection.execute(text(
+            "INSERT INTO chatmessage (id, session_id, role, content, timestamp, error) "
+            "VALUES (:id, :session_id, 'user', 'message', :timestamp, 0)"
+        ), [
+            {"id": f"s{i}-m{j}", "session_id": f"s{i}", "timestamp": now + timedelta(seconds=j)}
+            for i in range(sessions)
+            for j in reversed(range(MESSAGES_PER_SESSION))
+        ])
+
+
+def test_migration_adds_indexes():
+    """База первой версии после alembic upgrade head получает номера сообщений и те же планы; downgrade откатывает"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "migrate.db")
+        url = f"sqlite:///{path}"
+        engine = create_db_engine(url)
+        migrate(url, INITIAL_REVISION)
+        fill_legacy(engine, 50)
+
+        migrate(url, "d142aafade3c")
+        with engine.begin() as connection:
+            # Повтор номера, который могли записать одновременные добавления сообщений
+            connection.execute(text("UPDATE chatmessage SET position = 0 WHERE id = 's1-m1'"))
+
+        migrate(url, "head")
+        # Таблицы, которых нет в миграциях, приложение создает при запуске
+        SQLModel.metadata.create_all(engine)
+        with engine.connect() as connection:
+            positions = connection.execute(text(
+                "SELECT id, position FROM chatmessage WHERE session_id = 's0' ORDER BY position"
+            )).all()
+        assert [position for _, position in positions] == list(range(MESSAGES_PER_SESSION))
+        assert [message_id for message_id, _ in positions] == [f"s0-m{j}" for j in range(MESSAGES_PER_SESSION)]
+        with engine.connect() as connection:
+            positions = connection.execute(text(
+                "SELECT position FROM chatmessage WHERE session_id = 's1' ORDER BY position"
+            )).scalars().all()
+        assert positions == list(range(MESSAGES_PER_SESSION)), "Duplicate positions should be renumbered"
+
+        inspector = inspect(engine)
+        indexes = {index["name"]: index["unique"] for index in inspector.get_indexes("chatmessage")}
+        assert indexes.get(MESSAGES_INDEX), "Message positions should be unique"
+        assert SESSIONS_INDEX in {index["name"] for index in inspector.get_indexes("chatsession")}
+        check_history_plans(engine, path)
+
+        migrate(url, INITIAL_REVISION, downgrade=True)
+        inspector = inspect(engine)
+        assert "position" not in {column["name"] for column in inspector.get_columns("chatmessage")}
+        assert "version" not in {column["name"] for column in inspector.get_columns("chatsession")}
+        assert not inspector.get_indexes("chatmessage") and not inspector.get_indexes("chatsession")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    test_query_plans()
+    test_migration_adds_indexes()
+    logger.info("Query plan checks passed")
@@ -0,0 +1,112 @@
+"""Test script to check request coalescing (single-flight) without Ollama"""
+import asyncio
+import logging
+import sys
+import tracemalloc
+from typing import Any, AsyncIterator, Dict, List
+
+from app.services.single_flight import SUBSCRIBER_QUEUE_SIZE, SingleFlight
+
+# Configure logging
+logging.basicConfig(level=logging.INFO,
+                  format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                  handlers=[logging.StreamHandler(sys.stdout)])
+logger = logging.getLogger(__name__)
+
+KEY = "same-request"
+
+
+def make_producer(chunks: int, text: str = "token ", queued: int = 3):
+    """Генерация: сначала позиции в очереди, затем фрагменты текста и итоговый фрагмент"""
+    async def producer() -> AsyncIterator[Dict[str, Any]]:
+        for position in range(queued, 0, -1):
+            yield {"model": "phi3", "content": "", "done": False, "queued": True, "position": position}
+            await asyncio.sleep(0)
+        for _ in range(chunks):
+            yield {"model": "phi3", "content": text, "done": False}
+            await asyncio.sleep(0)
+        yield {"model": "phi3", "content": "", "done": True, "eval_count": chunks}
+    return producer
+
+
+async def collect(flight: SingleFlight, producer, delay: int = 0, slow: bool = False) -> List[Dict[str, Any]]:
+    for _ in range(delay):
+        await asyncio.sleep(0)
+    received = []
+    async for chunk in flight.subscribe(KEY, producer):
+        received.append(chunk)
+        if slow:
+            await asyncio.sleep(0.001)
+    return received
+
+
+def text_of(chunks: List[Dict[str, Any]]) -> str:
+    return "".join(chunk["content"] for chunk in chunks)
+
+
+async def check_late_subscriber() -> None:
+    flight = SingleFlight()
+    producer = make_producer(100)
+    first, late = await asyncio.gather(collect(flight, producer), collect(flight, producer, delay=50))
+
+    assert text_of(first) == text_of(late) == "token " * 100, "Late subscriber should get the same text"
+    assert first[-1]["done"] and late[-1]["done"] and late[-1]["eval_count"] == 100
+    assert any(chunk.get("queued") for chunk in first), "First subscriber sees its queue positions"
+    assert not any(chunk.get("queued") for chunk in late), "Late subscriber should not get stale queue positions"
+    assert len(late) < len(first), "Late subscriber should catch up in one chunk"
+    assert flight.coalesced_total == 1 and flight.flights_total == 1
+    logger.info("✅ Late subscriber catches up with one chunk and receives the same final text")
+
+
+async def check_slow_subscriber() -> None:
+    flight = SingleFlight()
+    producer = make_producer(SUBSCRIBER_QUEUE_SIZE * 4)
+    fast, slow = await asyncio.gather(collect(flight, producer), collect(flight, producer, slow=True))
+
+    assert text_of(fast) == text_of(slow) == "token " * (SUBSCRIBER_QUEUE_SIZE * 4)
+    assert slow[-1]["done"]
+    assert flight.resyncs_total >= 1, "Overflowing subscriber should resync from the snapshot"
+    logger.info("✅ Slow subscriber resyncs from the snapshot instead of buffering every chunk")
+
+
+async def retained_per_chunk(chunks: int) -> float:
+    """Сколько байт генерация удерживает на один фрагмент к моменту последнего фрагмента"""
+    flight = SingleFlight()
+    measured = {}
+
+    async def producer() -> AsyncIterator[Dict[str, Any]]:
+        for _ in range(chunks):
+            # Каждый фрагмент - новый объект, как при разборе ответа Ollama
+            yield {"model": "phi3", "content": "".join(["tok", "en "]), "done": False}
+        measured["bytes"] = tracemalloc.get_traced_memory()[0] - measured["start"]
+        yield {"model": "phi3", "content": "", "done": True}
+
+    tracemalloc.start()
+    measured["start"] = tracemalloc.get_traced_memory()[0]
+    try:
+        received = await collect(flight, producer)
+    finally:
+        tracemalloc.stop()
+    assert text_of(received) == "token " * chunks
+    return measured["bytes"] / chunks
+
+
+async def check_memory_per_chunk() -> None:
+    small = await retained_per_chunk(2000)
+    large = await retained_per_chunk(20000)
+    logger.info(f"Retained per chunk: {small:.1f} bytes at 2000 chunks, {large:.1f} bytes at 20000 chunks")
+    # Только снимок текста (до 4 байт на символ с запасом буфера); словарь на каждый фрагмент - около 250 байт
+    assert large < 128, f"Flight retains {large:.1f} bytes per chunk"
+    assert large < small * 1.5 + 8, "Memory per chunk should not grow with the number of chunks"
+    logger.info("✅ Memory per chunk stays constant")
+
+
+def test_single_flight():
+    asyncio.run(check_late_subscriber())
+    asyncio.run(check_slow_subscriber())
+    asyncio.run(check_memory_per_chunk())
+
+
+if __name__ == "__main__":
+    test_single_flight()
+    logger.info("Single-flight checks passed")
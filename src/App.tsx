@@ -9,11 +9,11 @@ import LoadingIndicator from './components/LoadingIndicator';
 import ConnectionStatus from './components/ConnectionStatus';
 import { Message, ModelType, ChatSession, FileAttachment } from './types/chat';
 // Импортируем функции из нового сервиса, использующего бэкенд
-import { sendMessage, getAvailableModels, testConnection } from './services/ollamaBackendApi';
+import { streamMessage, getAvailableModels, testConnection } from './services/ollamaBackendApi';
 import { exportSessionsToFile, importSessionsFromFile } from './services/storageService';
 import Auth from './components/Auth';
 import UserProfile from './components/UserProfile';
-import { authAPI, chatAPI } from './services/backendApi';
+import { authAPI, chatAPI, diffMessages, MessagesDelta } from './services/backendApi';
 
 function App() {
   // Authentication state
@@ -32,6 +32,8 @@ function App() {
   const [models, setModels] = useState<{id: string, name: string}[]>([]);
   const [connectionStatus, setConnectionStatus] = useState<'connected' | 'disconnected' | 'checking'>('checking');
   const chatHistoryRef = useRef<HTMLDivElement>(null);
+  // Последнее сохраненное на бэкенде состояние сессий: версия и сообщения
+  const savedSessionsRef = useRef<Record<string, { version: number; messages: Message[] }>>({});
 
   // Load user profile on authentication
   useEffect(() => {
@@ -80,6 +82,12 @@ function App() {
           updatedAt: new Date(session.updated_at)
         }));
         
+        convertedSessions.forEach((session, i) => {
+          savedSessionsRef.current[session.id] = {
+            version: backendSessions[i].version ?? 0,
+            messages: session.messages
+          };
+        });
         setSessions(convertedSessions);
         
         // Set active session to the most recently updated one
@@ -192,8 +200,8 @@ function App() {
         if (activeSession) {
           await chatAPI.updateSession(activeSessionId, activeSession.title, model);
           
-          // Update messages for this session
-          await chatAPI.updateSessionMessages(activeSessionId, messages);
+          // Send only the changes since the last saved version
+          await syncMessages(activeSessionId, messages);
         }
       } catch (error) {
         console.error('Error updating session in backend:', error);
@@ -206,6 +214,47 @@ function App() {
     return () => clearTimeout(updateTimer);
   }, [messages, activeSessionId, model, isAuthenticated]);
 
+  // Sync messages with backend as a delta against the last saved version
+  const syncMessages = async (sessionId: string, currentMessages: Message[]) => {
+    let saved = savedSessionsRef.current[sessionId];
+    let delta: MessagesDelta | null;
+    if (saved) {
+      delta = diffMessages(saved.messages, currentMessages);
+      if (!delta) return;
+    } else {
+      // Nothing known about this session yet: replace all of its messages
+      const sessionData = await chatAPI.getSessionById(sessionId);
+      saved = { version: sessionData.version ?? 0, messages: [] };
+      delta = { truncate_from: 0, edits: [], append: currentMessages };
+    }
+    
+    let result = await chatAPI.syncSessionMessages(sessionId, saved.version, delta);
+    if (!result) {
+      // Session was changed elsewhere: diff against what the server has now
+      // instead of overwriting it, so only the messages that really differ are sent
+      const sessionData = await chatAPI.getSessionById(sessionId);
+      const serverMessages: Message[] = sessionData.messages.map((msg: any) => ({
+        id: msg.id,
+        role: msg.role,
+        content: msg.content,
+        timestamp: new Date(msg.timestamp),
+        error: msg.error,
+        attachments: msg.attachments || []
+      }));
+      const serverVersion = sessionData.version ?? 0;
+      delta = diffMessages(serverMessages, currentMessages, false);
+      result = delta
+        ? await chatAPI.syncSessionMessages(sessionId, serverVersion, delta)
+        : { version: serverVersion, message_count: serverMessages.length };
+      if (!result) {
+        // Changed again in the meantime: the next change will re-read and diff again
+        throw new Error('Session was modified concurrently');
+      }
+    }
+    
+    savedSessionsRef.current[sessionId] = { version: result.version, messages: currentMessages };
+  };
+
   // Update active session in local state
   const updateActiveSession = () => {
     if (!activeSessionId) return;
@@ -242,6 +291,7 @@ function App() {
         updatedAt: new Date(response.updated_at)
       };
       
+      savedSessionsRef.current[newSession.id] = { version: response.version ?? 0, messages: [] };
       setSessions(prev => [...prev, newSession]);
       setActiveSessionId(newSession.id);
       setMessages([]);
@@ -274,6 +324,10 @@ function App() {
           attachments: msg.attachments || []
         }));
         
+        savedSessionsRef.current[sessionId] = {
+          version: sessionData.version ?? 0,
+          messages: convertedMessages
+        };
         setActiveSessionId(sessionId);
         setMessages(convertedMessages);
         setModel(sessionData.model);
@@ -344,17 +398,35 @@ function App() {
     setIsLoading(true);
     
     try {
-      // Call Ollama API through backend
-      const response = await sendMessage(model, [...messages, userMessage]);
-      
+      // Call Ollama API through backend, showing the answer token by token
       const assistantMessage: Message = {
         id: uuidv4(),
         role: 'assistant',
-        content: response,
+        content: '',
         timestamp: new Date()
       };
+      let assistantShown = false;
       
-      setMessages(messages => [...messages, assistantMessage]);
+      const showPartialResponse = (content: string) => {
+        if (!assistantShown) {
+          assistantShown = true;
+          setIsLoading(false);
+          setMessages(messages => [...messages, { ...assistantMessage, content }]);
+          return;
+        }
+        setMessages(messages => messages.map(msg => 
+          msg.id === assistantMessage.id ? { ...msg, content } : msg
+        ));
+      };
+      
+      try {
+        const response = await streamMessage(model, [...messages, userMessage], showPartialResponse, activeSessionId);
+        showPartialResponse(response);
+      } catch (streamError) {
+        // Убираем частично показанный ответ, ошибка будет показана ниже
+        setMessages(messages => messages.filter(msg => msg.id !== assistantMessage.id));
+        throw streamError;
+      }
       
       // Generate title for new sessions based on first message
       if (sessions.find(s => s.id === activeSessionId)?.messages.length === 0) {
@@ -87,6 +87,30 @@ const ConnectionStatus: React.FC<ConnectionStatusProps> = ({ backendUrl }) => {
     checkConnection();
   }, [backendUrl]);
 
+  // Подписываемся на изменения статуса Ollama вместо периодического опроса
+  useEffect(() => {
+    const events = new EventSource(`${backendUrl}/api/v1/ollama/status/stream`);
+
+    events.onmessage = (event) => {
+      try {
+        const data = JSON.parse(event.data);
+        if (data.status === 'connected') {
+          setStatus('connected');
+          setMessage(models.length > 0
+            ? `Successfully connected to backend and Ollama. Found ${models.length} models.`
+            : 'Successfully connected to backend and Ollama');
+        } else if (data.status === 'disconnected') {
+          setStatus('disconnected');
+          setMessage(`Backend is available but Ollama is disconnected: ${data.error || 'Unknown error. Make sure Ollama is running with "ollama serve" command.'}`);
+        }
+      } catch (parseError) {
+        console.error('Error parsing status event:', parseError);
+      }
+    };
+
+    return () => events.close();
+  }, [backendUrl, models.length]);
+
   return (
     <div className="connection-status" style={{ padding: '10px', borderRadius: '4px', margin: '10px 0' }}>
       {status === 'checking' && (
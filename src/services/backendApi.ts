@@ -31,6 +31,48 @@ export interface UserProfile {
   updated_at: string;
 }
 
+// Изменения сообщений сессии относительно последней сохраненной версии
+export interface MessagesDelta {
+  truncate_from?: number;
+  edits: { index: number; content?: string; error?: boolean; attachments?: any[] }[];
+  append: Message[];
+}
+
+// Разница между сохраненными и текущими сообщениями: общий префикс не отправляется,
+// сообщения с той же ролью - правки, новые - добавление в конец, остальное - усечение.
+// compareIds = false - для сообщений, перечитанных с сервера: их id не совпадают с локальными
+export const diffMessages = (saved: Message[], current: Message[], compareIds = true): MessagesDelta | null => {
+  const delta: MessagesDelta = { edits: [], append: [] };
+  const common = Math.min(saved.length, current.length);
+  let index = 0;
+
+  for (; index < common; index++) {
+    const before = saved[index];
+    const after = current[index];
+    if (before.role !== after.role || (compareIds && before.id !== after.id)) {
+      break;
+    }
+    if (before.content !== after.content || Boolean(before.error) !== Boolean(after.error) || JSON.stringify(before.attachments || []) !== JSON.stringify(after.attachments || [])) {
+      delta.edits.push({
+        index,
+        content: after.content,
+        error: Boolean(after.error),
+        attachments: after.attachments || []
+      });
+    }
+  }
+
+  if (index < saved.length) {
+    delta.truncate_from = index;
+  }
+  delta.append = current.slice(index);
+
+  if (delta.truncate_from === undefined && delta.edits.length === 0 && delta.append.length === 0) {
+    return null;
+  }
+  return delta;
+};
+
 // Сервис аутентификации
 export const authAPI = {
   // Регистрация нового пользователя
@@ -290,6 +332,41 @@ export const chatAPI = {
     }
   },
 
+  // Отправка изменений сообщений относительно известной версии сессии.
+  // Возвращает null, если сессию уже изменили (412) - нужно перечитать ее и отправить заново.
+  async syncSessionMessages(sessionId: string, version: number, delta: MessagesDelta): Promise<{ version: number; message_count: number } | null> {
+    try {
+      const response = await fetch(`${API_BASE_URL}/chat-sessions/${sessionId}/messages`, {
+        method: 'PATCH',
+        headers: { ...getHeaders(), 'If-Match': `"${version}"` },
+        body: JSON.stringify({
+          truncate_from: delta.truncate_from,
+          edits: delta.edits,
+          append: delta.append.map(msg => ({
+            role: msg.role,
+            content: msg.content,
+            timestamp: msg.timestamp,
+            error: msg.error,
+            attachments: msg.attachments || []
+          }))
+        }),
+      });
+
+      if (response.status === 412) {
+        return null;
+      }
+
+      if (!response.ok) {
+        throw new Error('Ошибка при синхронизации сообщений');
+      }
+
+      return await response.json();
+    } catch (error) {
+      console.error('Ошибка синхронизации сообщений:', error);
+      throw error;
+    }
+  },
+
   // Добавление нового сообщения в сессию
   async addMessage(sessionId: string, message: any) {
     try {
@@ -130,6 +130,71 @@ export async function sendMessage(
   }
 }
 
+// Потоковая отправка сообщения: onChunk вызывается для каждого фрагмента ответа
+export async function streamMessage(
+  model: ModelType,
+  messages: Message[],
+  onChunk: (content: string) => void,
+  sessionId?: string | null
+): Promise<string> {
+  const formattedMessages = messages.map(msg => ({
+    role: msg.role,
+    content: msg.content
+  }));
+
+  const response = await fetch(`${API_BASE_URL}/ollama/chat/stream`, {
+    method: 'POST',
+    headers: { ...getHeaders(), 'Accept': 'application/x-ndjson' },
+    body: JSON.stringify({
+      model,
+      messages: formattedMessages,
+      // Позволяет бэкенду переиспользовать контекст модели с прошлого хода сессии
+      session_id: sessionId ?? undefined
+    }),
+    credentials: 'include',
+  });
+
+  if (!response.ok || !response.body) {
+    let errorMessage = `Error: ${response.status}`;
+    try {
+      const errorData = await response.json();
+      errorMessage = errorData.detail || errorMessage;
+    } catch (e) {
+      // Ответ не в формате JSON
+    }
+    throw new Error(errorMessage);
+  }
+
+  // Читаем NDJSON построчно по мере поступления данных
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let fullResponse = '';
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+
+    buffer += decoder.decode(value, { stream: true });
+    const lines = buffer.split('\n');
+    buffer = lines.pop() || '';
+
+    for (const line of lines) {
+      if (!line.trim()) continue;
+      const chunk = JSON.parse(line);
+      if (chunk.error) {
+        throw new Error(chunk.error);
+      }
+      if (chunk.content) {
+        fullResponse += chunk.content;
+        onChunk(fullResponse);
+      }
+    }
+  }
+
+  return fullResponse;
+}
+
 export async function getAvailableModels(): Promise<{ id: string, name: string }[]> {
   try {
     // Получаем модели через бэкенд